@@ -0,0 +1,709 @@
+import argparse
+import contextlib
+import csv
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import types
+from decimal import Decimal
+
+import module_2_solution
+import pnl_lots
+import pnl_out_of_core
+import pnl_reconcile
+
+"""
+Purpose:
+Benchmarks for the loaders and PNL calculations in module_2_solution.py and the modules built on it.
+Each benchmark writes its own input files to a temporary directory and runs every
+variant in a fresh process, so the peak memory reported for one variant is not
+affected by the variants that ran before it.
+
+Usage:
+ python benchmarks.py streaming --rows 1000000
+ python benchmarks.py snapshot --rows 1000000
+ python benchmarks.py sharded --rows 1000000 --shards 1 2 4 8
+ python benchmarks.py fixed-point --rows 1000000
+ python benchmarks.py reconcile --rows 1000000
+ python benchmarks.py out-of-core --rows 20000000 --memory-limit-mb 256
+ python benchmarks.py functions --sizes 1000 10000 100000 --update-baseline
+ python benchmarks.py functions --sizes 1000 10000 100000
+ python benchmarks.py generate /tmp/portfolio --rows 100000000 --lots-per-security 10
+"""
+
+BENCHMARK_SEED = 2024
+ACTIONS = ('BUY', 'SELL')
+MALFORMED_ACTIONS = ('', 'sell', 'buy', 'HOLD')
+PRICE_SHOCKS = (-0.2, -0.1, -0.05, 0.05, 0.1, 0.2)
+CLIENTS = 1000 # registry clients planned by the functions benchmark
+BENCHMARK_BASELINE_FILENAME = 'benchmark_baseline.json'
+BENCHMARKED_MODULES = (module_2_solution, pnl_lots, pnl_out_of_core, pnl_reconcile) # the modules whose public functions the functions benchmark times
+# Public functions that only run the fixed workshop files or need a whole process pool, they are not timed per size
+NOT_BENCHMARKED = {'run_report', 'run_client_reports', 'render_client_report', 'get_report_context', 'file_version',
+                   'instrumented', 'iter_csv_chunks', 'write_holdings_snapshot', 'read_holdings_snapshot', 'write_reports',
+                   'format_validation_summary', 'csv_shards', 'iter_csv_shards', 'is_fixed_point', 'load_security_attributes',
+                   'reconcile_sorted_files', 'load_client_registry', 'get_client_registry', 'run_registered_reports',
+                   'check_same_master', 'shared_master', 'resolve_filename', 'check_fixed_point', 'merge_by_security'}
+
+"""
+Name: peak_rss_bytes
+Returns: the peak resident memory of the current process in bytes (int)
+"""
+def peak_rss_bytes():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def _run_and_measure(function, args, results):
+    start = time.perf_counter()
+    function(*args)
+    results.put((time.perf_counter() - start, peak_rss_bytes()))
+
+"""
+Name: measure_in_child
+Runs function(*args) in a fresh process and measures it
+
+Returns: (seconds, peak_rss) (tuple) - the wall time of the call and the peak memory of the process in bytes
+Parameters:
+ 'function' - a module level function (it must be picklable)
+ 'args' (tuple) - the arguments to call it with
+"""
+def measure_in_child(function, args):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_and_measure, args=(function, args, results))
+    process.start()
+    measurement = results.get()
+    process.join()
+    return measurement
+
+def _run_limited_and_measure(function, args, memory_limit, connection):
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    start = time.perf_counter()
+    try:
+        function(*args)
+    except MemoryError:
+        # A pipe rather than a queue, as a queue starts a feeder thread which may not fit under the limit
+        connection.send((None, peak_rss_bytes()))
+        return
+    connection.send((time.perf_counter() - start, peak_rss_bytes()))
+
+"""
+Name: measure_in_limited_child
+Runs function(*args) in a fresh process whose address space is capped at memory_limit bytes (RLIMIT_AS)
+
+Returns: (seconds, peak_rss) (tuple) - the wall time of the call (None if it ran out of memory) and the peak memory in bytes
+Parameters:
+ 'function' - a module level function (it must be picklable)
+ 'args' (tuple) - the arguments to call it with
+ 'memory_limit' (int) - the most memory the process may map, in bytes
+"""
+def measure_in_limited_child(function, args, memory_limit):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_limited_and_measure, args=(function, args, memory_limit, sender))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        # The process died without reporting, which is how some allocations fail under the limit
+        return None, None
+    finally:
+        process.join()
+
+"""
+Name: print_results
+Prints one line per benchmarked variant
+
+Returns: nothing
+Parameters:
+ 'title' (string) - the name of the benchmark
+ 'rows' (int) - the number of rows processed by each variant
+ 'results' (list) - (variant name, seconds, peak_rss) for each variant
+"""
+def print_results(title, rows, results):
+    print(f'{title} - {rows} rows')
+    str_fmt = "{:<30} {:>15} {:>15} {:>15}"
+    print(str_fmt.format('Variant', 'Seconds', 'Rows/sec', 'Peak RSS (MB)'))
+    for variant, seconds, peak_rss in results:
+        print(str_fmt.format(variant, f'{seconds:.3f}', f'{rows / seconds:,.0f}', f'{peak_rss / 2**20:.1f}'))
+
+# Streaming benchmark variants - each one calculates the transactions pnl from the files
+def dictreader_transactions_pnl(transactions_filename, holdings_filename):
+    current_holdings_portfolio = module_2_solution.load_holdings_portfolio(holdings_filename)
+    all_transactions = []
+    with open(transactions_filename, 'r') as f:
+        for row in csv.DictReader(f):
+            all_transactions.append(row)
+    transactions_pnl = {}
+    for transaction in all_transactions:
+        security = transaction['SecurityName']
+        if security in current_holdings_portfolio:
+            sign = module_2_solution.ACTION_SIGNS[transaction['Action']]
+            current_eod_price = current_holdings_portfolio[security]['price']
+            fill_pnl = sign * int(transaction['Quantity']) * (current_eod_price - float(transaction['TransactionPrice']))
+            transactions_pnl[security] = transactions_pnl.get(security, 0) + fill_pnl
+    return transactions_pnl
+
+def ledger_transactions_pnl(transactions_filename, holdings_filename):
+    current_holdings = module_2_solution.load_holdings_columns(holdings_filename)
+    ledger = module_2_solution.load_transactions_ledger(transactions_filename)
+    return module_2_solution.calculate_transactions_pnl(ledger, current_holdings)
+
+def streaming_transactions_pnl(transactions_filename, holdings_filename):
+    current_holdings = module_2_solution.load_holdings_columns(holdings_filename)
+    return module_2_solution.stream_transactions_pnl(transactions_filename, current_holdings)
+
+"""
+Name: benchmark_streaming
+Compares loading every transaction with csv.DictReader, loading the transaction ledger,
+and streaming the file in chunks with stream_transactions_pnl.
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of transactions to generate
+ 'securities' (int) - the number of securities the transactions are spread over
+"""
+def benchmark_streaming(rows, securities):
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = generate_portfolio_files(directory, rows, lots_per_security=max(1, rows // securities))
+        holdings_filename, transactions_filename = filenames['current_holdings'], filenames['transactions']
+        results = []
+        for variant, function in (('csv.DictReader', dictreader_transactions_pnl),
+                                  ('load_transactions_ledger', ledger_transactions_pnl),
+                                  ('stream_transactions_pnl', streaming_transactions_pnl)):
+            seconds, peak_rss = measure_in_child(function, (transactions_filename, holdings_filename))
+            results.append((variant, seconds, peak_rss))
+    print_results('Transactions PNL', rows, results)
+
+"""
+Name: benchmark_snapshot
+Compares parsing a holdings csv with load_holdings_columns against load_holdings_snapshot,
+both cold (no snapshot yet, so it parses the csv and writes the snapshot) and warm (memory maps the snapshot).
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of holdings rows to generate
+ 'repeats' (int) - the number of times each load is timed, the best time is reported
+"""
+def benchmark_snapshot(rows, repeats):
+    with tempfile.TemporaryDirectory() as directory:
+        # One transaction per security, so the holdings files get one row per security
+        holdings_filename = generate_portfolio_files(directory, rows)['current_holdings']
+        snapshot_filename = holdings_filename + module_2_solution.SNAPSHOT_SUFFIX
+
+        def time_load(load, before_each=None):
+            best = float('inf')
+            for _ in range(repeats):
+                if before_each:
+                    before_each()
+                start = time.perf_counter()
+                load(holdings_filename)
+                best = min(best, time.perf_counter() - start)
+            return best
+
+        def remove_snapshot():
+            if os.path.exists(snapshot_filename):
+                os.remove(snapshot_filename)
+
+        results = [('csv (load_holdings_columns)', time_load(module_2_solution.load_holdings_columns)),
+                   ('snapshot cold', time_load(module_2_solution.load_holdings_snapshot, remove_snapshot)),
+                   ('snapshot warm', time_load(module_2_solution.load_holdings_snapshot))]
+        print(f'Holdings load - {rows} rows, csv {os.path.getsize(holdings_filename) / 2**20:.1f} MB, '
+              f'snapshot {os.path.getsize(snapshot_filename) / 2**20:.1f} MB')
+        str_fmt = "{:<30} {:>15} {:>15}"
+        print(str_fmt.format('Variant', 'Seconds', 'Rows/sec'))
+        for variant, seconds in results:
+            print(str_fmt.format(variant, f'{seconds:.3f}', f'{rows / seconds:,.0f}'))
+
+"""
+Name: benchmark_sharded
+Times loading a transactions ledger with load_transactions_ledger split over a growing number of shards,
+one worker process per shard, to show how the parse scales with the number of cores.
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of transactions to generate
+ 'shard_counts' (list) - the numbers of shards to time, 1 is the single process loader
+ 'repeats' (int) - the number of times each load is timed, the best time is reported
+"""
+def benchmark_sharded(rows, shard_counts, repeats):
+    with tempfile.TemporaryDirectory() as directory:
+        transactions_filename = generate_portfolio_files(directory, rows, lots_per_security=5)['transactions']
+        results = []
+        for shards in shard_counts:
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                module_2_solution.load_transactions_ledger(transactions_filename, shards)
+                best = min(best, time.perf_counter() - start)
+            results.append((shards, best))
+        print(f'Sharded transactions load - {rows} rows, csv {os.path.getsize(transactions_filename) / 2**20:.1f} MB, '
+              f'{os.cpu_count()} CPUs')
+        str_fmt = "{:<10} {:>15} {:>15} {:>10}"
+        print(str_fmt.format('Shards', 'Seconds', 'Rows/sec', 'Speedup'))
+        for shards, seconds in results:
+            print(str_fmt.format(shards, f'{seconds:.3f}', f'{rows / seconds:,.0f}', f'{results[0][1] / seconds:.2f}x'))
+
+# Fixed point benchmark variants - each one calculates the total pnl by security name from the files
+def columns_total_pnl(filenames, fixed_point):
+    m = module_2_solution
+    current_holdings = m.load_holdings_columns(filenames['current_holdings'], fixed_point=fixed_point)
+    previous_holdings = m.load_holdings_columns(filenames['previous_holdings'], fixed_point=fixed_point)
+    ledger = m.load_transactions_ledger(filenames['transactions'], fixed_point=fixed_point)
+    total_pnl = m.pnl_by_name(m.calculate_total_pnl(m.calculate_holdings_pnl_by_id(current_holdings, previous_holdings),
+                                                    m.calculate_transactions_pnl_by_id(ledger, current_holdings)))
+    return m.pnl_from_ticks(total_pnl) if fixed_point else total_pnl
+
+def decimal_total_pnl(filenames):
+    m = module_2_solution
+    # The same columnar portfolios and calculations as the other variants, with a list of Decimal prices instead of an array
+    current_holdings, previous_holdings = m.HoldingsColumns(), m.HoldingsColumns()
+    for holdings, name in ((current_holdings, 'current_holdings'), (previous_holdings, 'previous_holdings')):
+        holdings.prices = []
+        for columns in m.iter_csv_chunks(filenames[name], m.HOLDINGS_COLUMNS, (None, None, int, Decimal)):
+            holdings.extend(*columns)
+    ledger = m.TransactionLedger()
+    ledger.prices = []
+    for columns in m.iter_csv_chunks(filenames['transactions'], m.TRANSACTIONS_COLUMNS, (None, None, int, Decimal, None)):
+        ledger.extend(*columns)
+    return m.pnl_by_name(m.calculate_total_pnl(m.calculate_holdings_pnl_by_id(current_holdings, previous_holdings),
+                                               m.calculate_transactions_pnl_by_id(ledger, current_holdings)))
+
+"""
+Name: benchmark_fixed_point
+Compares the total pnl calculated with float prices, with decimal.Decimal prices and with fixed point int64 ticks.
+The Decimal result is exact, the other two are checked against it: how many securities round to a different number
+of cents, and how far the sum of the whole portfolio is from the exact sum.
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of transactions to generate
+ 'repeats' (int) - the number of times each variant is timed, the best time is reported
+"""
+def benchmark_fixed_point(rows, repeats):
+    cent = Decimal(1).scaleb(-module_2_solution.ROUNDING_DECIMAL)
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = generate_portfolio_files(directory, rows, lots_per_security=5)
+        variants = (('float', lambda: columns_total_pnl(filenames, False)),
+                    ('decimal.Decimal', lambda: decimal_total_pnl(filenames)),
+                    ('fixed point', lambda: columns_total_pnl(filenames, True)))
+        results = []
+        for variant, calculate in variants:
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                total_pnl = calculate()
+                best = min(best, time.perf_counter() - start)
+            results.append((variant, best, total_pnl))
+
+    exact_pnl = results[1][2]
+    exact_sum = sum(exact_pnl.values())
+    print(f'Total PNL - {rows} rows, {len(exact_pnl)} securities')
+    str_fmt = "{:<20} {:>12} {:>15} {:>16} {:>22}"
+    print(str_fmt.format('Variant', 'Seconds', 'Rows/sec', 'Cent mismatches', 'Portfolio sum drift'))
+    for variant, seconds, total_pnl in results:
+        mismatches = sum(Decimal(total_pnl[security]).quantize(cent) != pnl.quantize(cent) for security, pnl in exact_pnl.items())
+        # Decimal(float) is the exact value of the float, so the drift of the float sum is shown in full
+        drift = Decimal(sum(total_pnl.values())) - exact_sum
+        print(str_fmt.format(variant, f'{seconds:.3f}', f'{rows / seconds:,.0f}', mismatches, f'{drift:.3E}'))
+
+"""
+Name: sort_csv_file
+Writes a copy of a csv file with its rows sorted by SecurityName, rows of the same security keep their order
+
+Returns: nothing
+Parameters:
+ 'filename' (string) - the file to sort
+ 'sorted_filename' (string) - the sorted copy
+"""
+def sort_csv_file(filename, sorted_filename):
+    with open(filename, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        security_column = header.index('SecurityName')
+        rows = sorted(reader, key=lambda row: row[security_column])
+    with open(sorted_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+"""
+Name: benchmark_reconcile
+Times the position reconciliation as a hash join (reconcile_positions, on portfolios already in memory, and with the loads)
+and as a sort-merge join streaming files sorted by SecurityName (reconcile_sorted_files).
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of transactions to generate
+ 'repeats' (int) - the number of times each variant is timed, the best time is reported
+"""
+def benchmark_reconcile(rows, repeats):
+    m = module_2_solution
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = generate_portfolio_files(directory, rows, lots_per_security=5)
+        names = ('current_holdings', 'previous_holdings', 'transactions')
+        sorted_filenames = [os.path.join(directory, f'sorted_{name}.csv') for name in names]
+        for name, sorted_filename in zip(names, sorted_filenames):
+            sort_csv_file(filenames[name], sorted_filename)
+        current_holdings, previous_holdings = (m.load_holdings_columns(filenames[name]) for name in names[:2])
+        ledger = m.load_transactions_ledger(filenames['transactions'])
+        total_rows = len(current_holdings) + len(previous_holdings) + len(ledger)
+
+        def load_and_reconcile():
+            return pnl_reconcile.reconcile_positions(*(m.load_holdings_columns(filenames[name]) for name in names[:2]),
+                                                     m.load_transactions_ledger(filenames['transactions']))
+
+        variants = (('hash join', lambda: pnl_reconcile.reconcile_positions(current_holdings, previous_holdings, ledger)),
+                    ('hash join with loads', load_and_reconcile),
+                    ('sort-merge join', lambda: list(pnl_reconcile.reconcile_sorted_files(*sorted_filenames))))
+        results = []
+        for variant, reconcile in variants:
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                breaks = reconcile()
+                best = min(best, time.perf_counter() - start)
+            results.append((variant, best, len(breaks)))
+
+    print(f'Position reconciliation - {total_rows} rows ({rows} transactions)')
+    str_fmt = "{:<25} {:>12} {:>18} {:>10}"
+    print(str_fmt.format('Variant', 'Seconds', 'Million rows/min', 'Breaks'))
+    for variant, seconds, break_count in results:
+        print(str_fmt.format(variant, f'{seconds:.3f}', f'{total_rows / seconds * 60 / 1e6:.1f}', break_count))
+
+# Out of core benchmark variants - each one calculates the total pnl of every security from the files
+def in_memory_total_pnl(current_holdings_filename, previous_holdings_filename, transactions_filename):
+    m = module_2_solution
+    current_holdings = m.load_holdings_columns(current_holdings_filename)
+    holdings_pnl = m.calculate_holdings_pnl_by_id(current_holdings, m.load_holdings_columns(previous_holdings_filename))
+    transactions_pnl = m.calculate_transactions_pnl_by_id(m.load_transactions_ledger(transactions_filename), current_holdings)
+    return len(m.calculate_total_pnl(holdings_pnl, transactions_pnl))
+
+def out_of_core_total_pnl(current_holdings_filename, previous_holdings_filename, transactions_filename, spill_rows, temp_dir):
+    pnl_rows = pnl_out_of_core.stream_pnl_out_of_core(current_holdings_filename, previous_holdings_filename,
+                                                      transactions_filename, spill_rows, temp_dir)
+    return pnl_out_of_core.write_out_of_core_pnl(pnl_rows, os.devnull)
+
+"""
+Name: OutOfCorePnlRows
+The rows of stream_pnl_out_of_core for the functions benchmark. Every iteration starts a new stream,
+so each timed call of write_out_of_core_pnl writes every row instead of finding the stream already used up.
+Parameters:
+ 'filenames' (strings) - the current holdings, previous holdings and transactions files
+"""
+class OutOfCorePnlRows:
+    def __init__(self, *filenames):
+        self.filenames = filenames
+
+    def __iter__(self):
+        return pnl_out_of_core.stream_pnl_out_of_core(*self.filenames)
+
+"""
+Name: benchmark_out_of_core
+Calculates the total pnl of a generated book in a child process capped at memory_limit_mb, in memory and out of core.
+Choose rows so that the input files are several times larger than the limit: the in memory variant then runs out
+of memory while the out of core variant finishes, its memory bounded by spill_rows.
+
+Returns: nothing
+Parameters:
+ 'rows' (int) - the number of transactions to generate
+ 'memory_limit_mb' (int) - the address space limit of the child process in MB
+ 'spill_rows' (int) - the number of rows per sorted run
+ 'temp_dir' (string) - where the input files and the sorted runs are written, None for the system temporary directory
+"""
+def benchmark_out_of_core(rows, memory_limit_mb, spill_rows, temp_dir):
+    with tempfile.TemporaryDirectory(dir=temp_dir) as directory:
+        filenames = generate_portfolio_files(directory, rows, lots_per_security=5)
+        files = (filenames['current_holdings'], filenames['previous_holdings'], filenames['transactions'])
+        input_size = sum(map(os.path.getsize, files))
+        results = []
+        for variant, function, args in (('in memory', in_memory_total_pnl, files),
+                                        ('out of core', out_of_core_total_pnl, files + (spill_rows, directory))):
+            results.append((variant,) + measure_in_limited_child(function, args, memory_limit_mb * 2**20))
+
+    print(f'Out of core total PNL - {rows} rows, input {input_size / 2**20:.0f} MB, '
+          f'memory limit {memory_limit_mb} MB, {spill_rows} rows per run')
+    str_fmt = "{:<15} {:>15} {:>15} {:>15}"
+    print(str_fmt.format('Variant', 'Seconds', 'Rows/sec', 'Peak RSS (MB)'))
+    for variant, seconds, peak_rss in results:
+        if seconds is None:
+            print(str_fmt.format(variant, 'out of memory', '-', '-' if peak_rss is None else f'{peak_rss / 2**20:.1f}'))
+        else:
+            print(str_fmt.format(variant, f'{seconds:.3f}', f'{rows / seconds:,.0f}', f'{peak_rss / 2**20:.1f}'))
+
+"""
+Name: generate_portfolio_files
+Writes a deterministic synthetic portfolio in the same layouts as the files in data_files/:
+holdings_current_eod_positions.csv, holdings_previous_eod_positions.csv and transactions.csv.
+Rows are written as they are generated, so files of any size (10^3 up to 10^8 rows) can be written.
+
+Returns: filenames (dict) - A map of 'current_holdings', 'previous_holdings' and 'transactions' to the written filename
+Parameters:
+ 'directory' (string) - the directory to write the files to
+ 'rows' (int) - the number of transactions; the holdings files get one row per security
+ 'lots_per_security' (int) - the average number of transactions per security
+ 'malformed_action_rate' (float) - the share of transactions with an empty, lower case or unknown action
+ 'seed' (int) - the random seed, the same arguments always write the same files
+"""
+def generate_portfolio_files(directory, rows, lots_per_security=1, malformed_action_rate=0.0, seed=BENCHMARK_SEED):
+    rng = random.Random(seed)
+    securities = max(1, rows // lots_per_security)
+    os.makedirs(directory, exist_ok=True)
+    filenames = {'current_holdings': os.path.join(directory, 'holdings_current_eod_positions.csv'),
+                 'previous_holdings': os.path.join(directory, 'holdings_previous_eod_positions.csv'),
+                 'transactions': os.path.join(directory, 'transactions.csv')}
+
+    with open(filenames['current_holdings'], 'w', newline='') as current_file, \
+         open(filenames['previous_holdings'], 'w', newline='') as previous_file:
+        current_writer, previous_writer = csv.writer(current_file), csv.writer(previous_file)
+        current_writer.writerow(module_2_solution.HOLDINGS_COLUMNS)
+        previous_writer.writerow(module_2_solution.HOLDINGS_COLUMNS)
+        for number in range(securities):
+            quantity = rng.randint(1, 5000)
+            previous_price = round(rng.uniform(1, 500), 2)
+            current_writer.writerow([f'SECURITY{number}', f'T{number}', quantity,
+                                     round(previous_price * rng.uniform(0.95, 1.05), 2)])
+            # About 1 in 20 securities is new today and is not in the previous holdings
+            if rng.random() >= 0.05:
+                previous_writer.writerow([f'SECURITY{number}', f'T{number}', quantity, previous_price])
+
+    with open(filenames['transactions'], 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(module_2_solution.TRANSACTIONS_COLUMNS)
+        for _ in range(rows):
+            number = rng.randrange(securities)
+            if rng.random() < malformed_action_rate:
+                action = rng.choice(MALFORMED_ACTIONS)
+            else:
+                action = rng.choice(ACTIONS)
+            writer.writerow([f'SECURITY{number}', f'T{number}', rng.randint(1, 1000), round(rng.uniform(1, 500), 2), action])
+    return filenames
+
+"""
+Name: benchmark_arguments
+Loads the generated portfolio once and builds the arguments each benchmarked function is called with.
+
+Returns: arguments (dict) - A map of function name to the tuple of arguments to call it with
+Parameters:
+ 'filenames' (dict) - the files returned by generate_portfolio_files
+"""
+def benchmark_arguments(filenames):
+    m = module_2_solution
+    current_holdings = m.load_holdings_columns(filenames['current_holdings'])
+    previous_holdings = m.load_holdings_columns(filenames['previous_holdings'])
+    ledger = m.load_transactions_ledger(filenames['transactions'])
+    fixed_point_holdings = m.load_holdings_columns(filenames['current_holdings'], fixed_point=True)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        holdings_pnl = m.calculate_holdings_pnl(current_holdings, previous_holdings)
+        transactions_pnl = m.calculate_transactions_pnl(ledger, current_holdings)
+    total_pnl = m.calculate_total_pnl(holdings_pnl, transactions_pnl)
+    securities = current_holdings.securities
+    price_snapshots = m.price_shock_snapshots(current_holdings, securities, PRICE_SHOCKS)
+    client_files = {'current_holdings_filename': filenames['current_holdings'],
+                    'previous_holdings_filename': filenames['previous_holdings'],
+                    'transactions_filename': filenames['transactions']}
+    groupings = {'Sector': {security: f'SECTOR{number % 11}' for number, security in enumerate(securities)},
+                 'Desk': {security: f'DESK{number % 37}' for number, security in enumerate(securities)}}
+    groupings.update(m.pnl_groupings(total_pnl, current_holdings, ledger))
+    registry = {f'Client_{number}': dict(client_files, reports=(m.REPORT_TYPES[number % len(m.REPORT_TYPES)],))
+                for number in range(CLIENTS)}
+    return {
+        'csv_checksum': (filenames['current_holdings'],),
+        'load_holdings_columns': (filenames['current_holdings'],),
+        'load_holdings_portfolio': (filenames['current_holdings'],),
+        'load_holdings_snapshot': (filenames['current_holdings'],),
+        'load_market_prices': (filenames['current_holdings'],),
+        'load_transactions_ledger': (filenames['transactions'],),
+        'load_transactions_portfolio': (filenames['transactions'],),
+        'validate_transactions': (filenames['transactions'], os.path.join(os.path.dirname(filenames['transactions']), 'quarantine.csv')),
+        'holdings_portfolio_from_columns': (current_holdings,),
+        'as_holdings_columns': (m.holdings_portfolio_from_columns(current_holdings),),
+        'as_transaction_ledger': (m.load_transactions_portfolio(filenames['transactions']),),
+        'calculate_holdings_pnl': (current_holdings, previous_holdings),
+        'calculate_holdings_pnl_by_id': (current_holdings, previous_holdings),
+        'calculate_transactions_pnl': (ledger, current_holdings),
+        'calculate_transactions_pnl_by_id': (ledger, current_holdings),
+        'stream_transactions_pnl': (filenames['transactions'], current_holdings),
+        'calculate_total_pnl': (holdings_pnl, transactions_pnl),
+        'pnl_by_name': (m.calculate_holdings_pnl_by_id(current_holdings, previous_holdings),),
+        'normalize_action': (' sell ',),
+        'action_sign': (' sell ',),
+        'normalize_actions': (ledger.actions,),
+        'parse_price_ticks': ('103.25',),
+        'prices_to_ticks': (current_holdings.prices,),
+        'pnl_from_ticks': (m.calculate_holdings_pnl_by_id(fixed_point_holdings, m.load_holdings_columns(
+            filenames['previous_holdings'], fixed_point=True)),),
+        'price_shock_snapshots': (current_holdings, securities, PRICE_SHOCKS),
+        'revalue_pnl': (price_snapshots, securities, current_holdings, previous_holdings, ledger),
+        'reprice_holdings': (current_holdings, m.load_market_prices(filenames['current_holdings'])),
+        'render_reports': (total_pnl, tuple(m.REPORT_FORMATS)),
+        'format_report': (total_pnl,),
+        'generate_report': (total_pnl,),
+        'top_pnl': (total_pnl, 100),
+        'calculate_lot_pnl': (current_holdings, previous_holdings, ledger),
+        'reconcile_positions': (current_holdings, previous_holdings, ledger),
+        'stream_pnl_out_of_core': (filenames['current_holdings'], filenames['previous_holdings'], filenames['transactions']),
+        'write_out_of_core_pnl': (OutOfCorePnlRows(filenames['current_holdings'], filenames['previous_holdings'],
+                                                   filenames['transactions']), os.devnull),
+        'iter_external_sort': (filenames['transactions'], m.TRANSACTIONS_COLUMNS),
+        'write_breaks': (pnl_reconcile.reconcile_positions(current_holdings, previous_holdings, ledger),
+                         os.path.join(os.path.dirname(filenames['transactions']), 'breaks.csv')),
+        'pnl_groupings': (total_pnl, current_holdings, ledger),
+        'aggregate_pnl': (total_pnl, groupings),
+        'format_aggregates': (m.aggregate_pnl(total_pnl, groupings),),
+        'format_change_report': (m.DeltaReport(filenames['current_holdings'], filenames['previous_holdings'],
+                                                filenames['transactions']).refresh(),),
+        'plan_client_reports': (registry,),
+        'execute_report_plan': (m.plan_client_reports(registry),),
+    }
+
+"""
+Name: time_function
+Returns: seconds (float) - the best wall time of calling function(*args) over a number of repeats
+Parameters:
+ 'function' - the function to time
+ 'args' (tuple) - the arguments to call it with
+ 'repeats' (int) - the number of calls
+"""
+def time_function(function, args, repeats):
+    best = float('inf')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = function(*args)
+            if isinstance(result, types.GeneratorType):
+                for _ in result:
+                    pass
+            best = min(best, time.perf_counter() - start)
+    return best
+
+"""
+Name: public_functions
+Returns: functions (dict) - A map of function name to every public function defined in BENCHMARKED_MODULES
+"""
+def public_functions():
+    return {name: value for module in BENCHMARKED_MODULES for name, value in vars(module).items()
+            if inspect.isfunction(value) and not name.startswith('_') and value.__module__ == module.__name__}
+
+"""
+Name: benchmark_functions
+Times every benchmarked public function of BENCHMARKED_MODULES on synthetic portfolios of each size,
+and compares the times against a stored baseline.
+A function is flagged as a regression when it is slower than its baseline time by more than the tolerance.
+
+Returns: regressions (list) - (size, function name, seconds, baseline seconds) for every flagged function
+Parameters:
+ 'sizes' (list) - the number of transaction rows of each synthetic portfolio
+ 'lots_per_security' (int) - the average number of transactions per security
+ 'malformed_action_rate' (float) - the share of transactions with a malformed action
+ 'baseline_filename' (string) - the json file with the baseline times
+ 'update_baseline' (bool) - write this run's times to the baseline file instead of comparing against it
+ 'tolerance' (float) - the allowed slow down before a function is flagged (ex. 0.25 for 25% slower)
+ 'repeats' (int) - the number of times each function is timed, the best time is used
+"""
+def benchmark_functions(sizes, lots_per_security, malformed_action_rate, baseline_filename, update_baseline, tolerance, repeats):
+    functions = public_functions()
+    untimed = sorted(name for name in functions if name not in NOT_BENCHMARKED)
+    baseline = {}
+    if os.path.exists(baseline_filename) and not update_baseline:
+        with open(baseline_filename) as f:
+            baseline = json.load(f)
+
+    results, regressions = {}, []
+    str_fmt = "{:<35} {:>12} {:>15} {:>10}"
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = generate_portfolio_files(directory, size, lots_per_security, malformed_action_rate)
+            arguments = benchmark_arguments(filenames)
+            print(f'\n{size} rows')
+            print(str_fmt.format('Function', 'Seconds', 'Baseline', 'Change'))
+            size_results = results[str(size)] = {}
+            for name, args in arguments.items():
+                seconds = size_results[name] = time_function(functions[name], args, repeats)
+                baseline_seconds = baseline.get(str(size), {}).get(name)
+                change = ''
+                if baseline_seconds:
+                    change = f'{seconds / baseline_seconds - 1:+.0%}'
+                    if seconds > baseline_seconds * (1 + tolerance):
+                        regressions.append((size, name, seconds, baseline_seconds))
+                        change += ' REGRESSION'
+                print(str_fmt.format(name, f'{seconds:.6f}', '' if baseline_seconds is None else f'{baseline_seconds:.6f}', change))
+        untimed = [name for name in untimed if name not in arguments]
+
+    if untimed:
+        print(f"\nNot benchmarked: {', '.join(untimed)}")
+    if update_baseline:
+        with open(baseline_filename, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nBaseline written to {baseline_filename}')
+    elif regressions:
+        print(f'\n{len(regressions)} regression(s) against {baseline_filename}')
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for module_2_solution.py')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    streaming_parser = subparsers.add_parser('streaming', help='DictReader vs ledger vs streaming transactions pnl')
+    streaming_parser.add_argument('--rows', type=int, default=1_000_000)
+    streaming_parser.add_argument('--securities', type=int, default=1000)
+    snapshot_parser = subparsers.add_parser('snapshot', help='csv vs cold and warm binary snapshot holdings loads')
+    snapshot_parser.add_argument('--rows', type=int, default=1_000_000)
+    snapshot_parser.add_argument('--repeats', type=int, default=3)
+    sharded_parser = subparsers.add_parser('sharded', help='transactions load time against the number of shards')
+    sharded_parser.add_argument('--rows', type=int, default=1_000_000)
+    sharded_parser.add_argument('--shards', type=int, nargs='+',
+                                default=sorted({1, 2, 4, 8, os.cpu_count() or 1}))
+    sharded_parser.add_argument('--repeats', type=int, default=3)
+    fixed_point_parser = subparsers.add_parser('fixed-point', help='float vs Decimal vs fixed point total pnl')
+    fixed_point_parser.add_argument('--rows', type=int, default=1_000_000)
+    fixed_point_parser.add_argument('--repeats', type=int, default=3)
+    reconcile_parser = subparsers.add_parser('reconcile', help='hash join vs sort-merge join position reconciliation')
+    reconcile_parser.add_argument('--rows', type=int, default=1_000_000)
+    reconcile_parser.add_argument('--repeats', type=int, default=3)
+    out_of_core_parser = subparsers.add_parser('out-of-core', help='in memory vs out of core total pnl under a memory limit')
+    out_of_core_parser.add_argument('--rows', type=int, default=20_000_000)
+    out_of_core_parser.add_argument('--memory-limit-mb', type=int, default=256)
+    out_of_core_parser.add_argument('--spill-rows', type=int, default=100_000)
+    out_of_core_parser.add_argument('--temp-dir')
+    functions_parser = subparsers.add_parser('functions', help='time every public function and compare against a baseline')
+    functions_parser.add_argument('--sizes', type=int, nargs='+', default=[10**3, 10**4, 10**5],
+                                  help='transaction rows of each synthetic portfolio, from 10^3 up to 10^8')
+    functions_parser.add_argument('--lots-per-security', type=int, default=5)
+    functions_parser.add_argument('--malformed-action-rate', type=float, default=0.01)
+    functions_parser.add_argument('--baseline', default=BENCHMARK_BASELINE_FILENAME)
+    functions_parser.add_argument('--update-baseline', action='store_true')
+    functions_parser.add_argument('--tolerance', type=float, default=0.25)
+    functions_parser.add_argument('--repeats', type=int, default=3)
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic portfolio to a directory')
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('--rows', type=int, default=10**6)
+    generate_parser.add_argument('--lots-per-security', type=int, default=5)
+    generate_parser.add_argument('--malformed-action-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.benchmark == 'streaming':
+        benchmark_streaming(args.rows, args.securities)
+    elif args.benchmark == 'snapshot':
+        benchmark_snapshot(args.rows, args.repeats)
+    elif args.benchmark == 'sharded':
+        benchmark_sharded(args.rows, args.shards, args.repeats)
+    elif args.benchmark == 'fixed-point':
+        benchmark_fixed_point(args.rows, args.repeats)
+    elif args.benchmark == 'reconcile':
+        benchmark_reconcile(args.rows, args.repeats)
+    elif args.benchmark == 'out-of-core':
+        benchmark_out_of_core(args.rows, args.memory_limit_mb, args.spill_rows, args.temp_dir)
+    elif args.benchmark == 'functions':
+        regressions = benchmark_functions(args.sizes, args.lots_per_security, args.malformed_action_rate, args.baseline,
+                                          args.update_baseline, args.tolerance, args.repeats)
+        sys.exit(1 if regressions else 0)
+    elif args.benchmark == 'generate':
+        print(generate_portfolio_files(args.directory, args.rows, args.lots_per_security, args.malformed_action_rate))
@@ -1,11 +1,730 @@
+import atexit
 import csv
+import hashlib
+import heapq
+import io
+import json
+import math
+import mmap
+import operator
+import os
+import struct
 import sys
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from decimal import Decimal
+from functools import partial, wraps
+from itertools import groupby, islice, repeat
 
 ## Important filenames and constants
-CURRENT_HOLDINGS_FILENAME = '/content/ntbb-ghc2024/data_files/holdings_current_eod_positions.csv'
-PREVIOUS_HOLDINGS_FILENAME = '/content/ntbb-ghc2024/data_files/holdings_previous_eod_positions.csv'
-TRANSACTIONS_FILENAME = '/content/ntbb-ghc2024/data_files/transactions.csv'
 ROUNDING_DECIMAL = 2
+PRICE_DECIMALS = 6 # fixed point prices are whole numbers of 10^-6 (ticks), see prices_to_ticks
+PRICE_TICKS = 10 ** PRICE_DECIMALS
+MAX_FLOAT_TICKS = 2 ** 50 # below this, a float price times PRICE_TICKS is at most a quarter tick from the exact value
+REPORT_TYPES = ('holdings', 'transactions', 'total')
+CLIENT_REGISTRY_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clients.json') # the clients, their files and reports
+CLIENT_FILE_KEYS = ('current_holdings_filename', 'previous_holdings_filename', 'transactions_filename')
+REPORT_FILE_KEYS = {'holdings': ('current_holdings_filename', 'previous_holdings_filename'),
+                    'transactions': ('transactions_filename', 'current_holdings_filename'),
+                    'total': CLIENT_FILE_KEYS} # the client files each report type is calculated from
+ACTION_SIGNS = {'BUY': 1, 'SELL': -1} # BUY gains when the eod price rises, SELL when it falls
+CSV_CHUNK_SIZE = 1024 # rows parsed at a time by the streaming loaders
+HOLDINGS_COLUMNS = ('SecurityName', 'Ticker', 'Quantity', 'Price')
+TRANSACTIONS_COLUMNS = ('SecurityName', 'Ticker', 'Quantity', 'TransactionPrice', 'Action')
+UNASSIGNED_GROUP = 'Unassigned' # the group of a security that has no value for a grouping
+
+## Reason codes for transactions rejected by validate_transactions, in the order they are checked
+REJECT_MISSING_FIELD = 'MISSING_FIELD' # the row has fewer columns than the header
+REJECT_EMPTY_ACTION = 'EMPTY_ACTION'
+REJECT_UNKNOWN_ACTION = 'UNKNOWN_ACTION' # not BUY or SELL in any case
+REJECT_BAD_QUANTITY = 'BAD_QUANTITY' # not a whole number above 0
+REJECT_BAD_PRICE = 'BAD_PRICE' # not a finite number above 0
+REJECT_REASONS = (REJECT_MISSING_FIELD, REJECT_EMPTY_ACTION, REJECT_UNKNOWN_ACTION, REJECT_BAD_QUANTITY, REJECT_BAD_PRICE)
+QUARANTINE_COLUMNS = ('RowNumber', 'Reason') + TRANSACTIONS_COLUMNS
+
+## Binary holdings snapshot format, see write_holdings_snapshot
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'PNLSNAP\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_BYTE_ORDERS = {'little': 0, 'big': 1}
+SNAPSHOT_HEADER = struct.Struct('<8sIIQ32s8x') # magic, version, byte order, row count, csv checksum - 64 bytes
+
+## Pipeline profiling, see PipelineProfiler
+PROFILE_ENV_VARIABLE = 'PNL_PROFILE' # set to a json filename to profile every stage of the run
+PROFILE_MEMORY_ENV_VARIABLE = 'PNL_PROFILE_MEMORY' # set to 1 to also trace allocated bytes
+
+"""
+Name: PipelineProfiler
+Records the wall time, row count and (optionally) allocated bytes of every stage of the report flow.
+Stages are timed with the stage context manager or the instrumented decorator.
+When the profiler is disabled a stage costs one attribute check, so it can stay in the code in production.
+
+Attributes:
+ enabled (bool) - whether stages are being recorded
+ trace_memory (bool) - whether the bytes allocated by each stage are traced with tracemalloc
+ records (list) - one map per finished stage
+    Ex. records = [{'stage': 'calculate_holdings_pnl', 'depth': 1, 'seconds': 0.001, 'rows': 7, 'allocated_bytes': 1024}]
+"""
+class PipelineProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = []
+        self._depth = 0
+        # Only stop tracemalloc on disable if the profiler started it, someone else may have been tracing before
+        self._started_tracemalloc = False
+
+    def enable(self, trace_memory=False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def disable(self):
+        self.enabled = False
+        self.trace_memory = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    """
+    Name: stage
+    A context manager that records one stage. Set record['rows'] inside the block to count the rows it processed.
+    Parameters:
+     'name' (string) - the name of the stage
+    """
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield {}
+            return
+        record = {'stage': name, 'depth': self._depth, 'seconds': 0.0, 'rows': None}
+        # Added when the stage starts, so nested stages are listed after the stage that contains them
+        self.records.append(record)
+        allocated_before = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self._depth -= 1
+            if self.trace_memory:
+                record['allocated_bytes'] = tracemalloc.get_traced_memory()[0] - allocated_before
+
+    """
+    Name: summary
+    Returns: summary (string) - a table with one line per recorded stage, nested stages are indented
+    """
+    def summary(self):
+        str_fmt = "{:<45} {:>12} {:>12} {:>16}"
+        lines = ['Pipeline Profile:', str_fmt.format('Stage', 'Seconds', 'Rows', 'Allocated bytes')]
+        for record in self.records:
+            lines.append(str_fmt.format('  ' * record['depth'] + record['stage'], f"{record['seconds']:.6f}",
+                                        '' if record['rows'] is None else record['rows'],
+                                        record.get('allocated_bytes', '')))
+        return '\n'.join(lines)
+
+    """
+    Name: write_profile
+    Writes every recorded stage to a json file
+    Parameters:
+     'filename' (string) - the file to write
+    """
+    def write_profile(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'stages': self.records}, f, indent=2)
+
+PROFILER = PipelineProfiler()
+
+"""
+Name: instrumented
+A decorator that records every call of the decorated function as a stage of PROFILER.
+The row count of the stage is the len() of the value the function returns, or of one of its arguments.
+Parameters:
+ 'stage_name' (string) - the name of the stage, defaults to the function name
+ 'rows_argument' (int) - the position of the argument whose len() is the row count, None to count the returned value
+"""
+def instrumented(stage_name=None, rows_argument=None):
+    def decorate(function):
+        name = stage_name or function.__name__
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            with PROFILER.stage(name) as record:
+                result = function(*args, **kwargs)
+                counted = result if rows_argument is None else args[rows_argument]
+                if hasattr(counted, '__len__'):
+                    record['rows'] = len(counted)
+                return result
+        return wrapper
+    return decorate
+
+def _write_profile_at_exit(filename):
+    print(PROFILER.summary(), file=sys.stderr)
+    PROFILER.write_profile(filename)
+
+if os.environ.get(PROFILE_ENV_VARIABLE):
+    PROFILER.enable(trace_memory=os.environ.get(PROFILE_MEMORY_ENV_VARIABLE) == '1')
+    atexit.register(_write_profile_at_exit, os.environ[PROFILE_ENV_VARIABLE])
+
+"""
+Name: normalize_action
+Returns: action (string) - the action the way every PNL calculation reads it: upper case with the spaces around it removed,
+    '' for a missing action. Only BUY and SELL are valid (see ACTION_SIGNS), other actions are kept so they can be reported.
+    Ex. normalize_action(' sell') == 'SELL'
+Parameters:
+ 'action' (string) - the action as written in a transactions file, or None
+"""
+def normalize_action(action):
+    return sys.intern(action.strip().upper()) if action else ''
+
+"""
+Name: normalize_actions
+Returns: actions (list) - a column of actions normalized like normalize_action, one pass in C for the whole column
+Parameters:
+ 'actions' (iterable) - the actions (string) as written in a transactions file
+"""
+def normalize_actions(actions):
+    # Interned, so a ledger holds one string per distinct action instead of one per fill
+    return list(map(sys.intern, map(str.upper, map(str.strip, actions))))
+
+"""
+Name: action_sign
+Returns: sign (int) - 1 for a BUY and -1 for a SELL in any case, None for an empty or unknown action
+Parameters:
+ 'action' (string) - the action of a fill, or None
+"""
+def action_sign(action):
+    return ACTION_SIGNS.get(normalize_action(action))
+
+"""
+Name: iter_csv_chunks
+Reads a csv file in chunks of at most chunk_size rows, so only one chunk is in memory at a time.
+Each chunk is a tuple with one list per requested column, already converted to its type.
+    Ex. (['Imaginary Company', 'Other Company'], [2, 5], [100.0, 20.5])
+
+Returns: a generator of chunks (tuple of lists)
+Parameters:
+ 'filename' (string) - the filename being processed
+ 'columns' (tuple) - the header names of the columns to read, in the order they are returned
+ 'converters' (tuple) - the type to convert each column to (ex. int), or None to keep the text
+ 'chunk_size' (int) - the maximum number of rows in each chunk
+"""
+def iter_csv_chunks(filename, columns, converters, chunk_size=CSV_CHUNK_SIZE):
+    with open(filename, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        pick_columns = operator.itemgetter(*(header.index(column) for column in columns))
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            # Skip blank lines, then convert the chunk one column at a time
+            picked_rows = [pick_columns(row) for row in rows if row]
+            if not picked_rows:
+                continue
+            yield _convert_columns(picked_rows, converters)
+
+def _convert_columns(picked_rows, converters):
+    return tuple(list(values) if convert is None else list(map(convert, values))
+                 for values, convert in zip(zip(*picked_rows), converters))
+
+"""
+Name: merge_by_security
+Merges row streams that are each sorted by security name (the first field of every row) in one pass,
+so only the rows of one security are in memory at a time.
+
+Returns: a generator of (security, rows) (tuple) - every security in name order, with a list of its rows from each stream
+    Ex. ('Imaginary Company', [[current rows], [previous rows], [transaction rows]])
+Parameters:
+ 'sources' (iterables) - the row streams, each sorted by security name
+"""
+def merge_by_security(*sources):
+    tagged_sources = [zip(source, repeat(tag)) for tag, source in enumerate(sources)]
+    security_name = lambda entry: entry[0][0]
+    for security, entries in groupby(heapq.merge(*tagged_sources, key=security_name), key=security_name):
+        rows = [[] for _ in sources]
+        for row, tag in entries:
+            rows[tag].append(row)
+        yield security, rows
+
+"""
+Name: prices_to_ticks
+Converts a column of prices parsed with float() to whole numbers of ticks (10^-PRICE_DECIMALS) in one pass.
+float(text) is the closest float to the decimal in the file, so for a price with at most PRICE_DECIMALS decimals
+price * PRICE_TICKS is within a tiny fraction of a whole number of ticks and rounding it gives the exact tick count.
+Prices with more decimals are rounded to the nearest tick.
+
+Returns: ticks (list) - the price of each row in ticks (int)
+Parameters:
+ 'prices' (list) - the prices (float)
+"""
+def prices_to_ticks(prices):
+    try:
+        # map keeps the whole column in C, a Python function per price would cost several times more than float() itself
+        ticks = list(map(round, map(float(PRICE_TICKS).__mul__, prices)))
+    except (ValueError, OverflowError):
+        raise ValueError("Prices MUST be finite numbers to be held as ticks") from None
+    if ticks and max(map(abs, ticks)) >= MAX_FLOAT_TICKS:
+        raise ValueError(f"Prices MUST be below {MAX_FLOAT_TICKS // PRICE_TICKS} to be held exactly as ticks")
+    return ticks
+
+"""
+Name: parse_price_ticks
+Returns: ticks (int) - a price as written in a csv file, in ticks (see prices_to_ticks)
+    Ex. parse_price_ticks('103.25') == 103250000
+Parameters:
+ 'text' (string) - the price
+"""
+def parse_price_ticks(text):
+    return prices_to_ticks([float(text)])[0]
+
+"""
+Name: pnl_from_ticks
+Returns: pnl (dict) - the same map with every pnl value in ticks turned into an exact Decimal amount
+Parameters:
+ 'pnl' (dict) - A map of security name (or id) to its pnl value in ticks, calculated from fixed point portfolios
+"""
+def pnl_from_ticks(pnl):
+    return {security: Decimal(ticks).scaleb(-PRICE_DECIMALS) for security, ticks in pnl.items()}
+
+"""
+Name: csv_shards
+Splits the rows of a csv file into byte ranges of about the same size. Each range starts at the beginning
+of a row and ends just after a newline, so every range can be parsed on its own.
+
+Returns: ranges (list) - (start, end) byte offsets of each range in file order, together covering every row after the header
+Parameters:
+ 'filename' (string) - the csv file
+ 'shards' (int) - the number of ranges wanted, small files get fewer
+
+Note - a row is never split between two ranges as long as no quoted field holds a newline, which is true of every input file
+"""
+def csv_shards(filename, shards):
+    with open(filename, 'rb') as f:
+        f.readline()
+        boundaries = [f.tell()]
+        file_size = os.fstat(f.fileno()).st_size
+        data_size = file_size - boundaries[0]
+        for shard in range(1, shards):
+            # Move each split point forward to the start of the next row
+            f.seek(boundaries[0] + data_size * shard // shards - 1)
+            f.readline()
+            if boundaries[-1] < f.tell() < file_size:
+                boundaries.append(f.tell())
+        boundaries.append(file_size)
+    return list(zip(boundaries, boundaries[1:]))
+
+def _parse_csv_shard(filename, start, end, columns, converters):
+    with open(filename, 'r', newline='') as f:
+        header = next(csv.reader([f.readline()]))
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+    pick_columns = operator.itemgetter(*(header.index(column) for column in columns))
+    picked_rows = [pick_columns(row) for row in csv.reader(io.StringIO(text, newline='')) if row]
+    if not picked_rows:
+        return tuple([] for _ in columns)
+    return _convert_columns(picked_rows, converters)
+
+"""
+Name: iter_csv_shards
+Parses a csv file in byte range shards (see csv_shards) on a pool of processes, one process per shard
+
+Returns: a generator of (column values, ...) tuples, one per shard in file order, like iter_csv_chunks
+Parameters:
+ 'filename' (string) - the csv file
+ 'columns' (tuple) - the names of the columns to read
+ 'converters' (tuple) - a function to convert each column's values (ex. int), or None to keep the strings
+ 'shards' (int) - the number of shards and worker processes
+"""
+def iter_csv_shards(filename, columns, converters, shards):
+    ranges = csv_shards(filename, shards)
+    if len(ranges) == 1:
+        yield from iter_csv_chunks(filename, columns, converters)
+        return
+    starts, ends = zip(*ranges)
+    with ProcessPoolExecutor(len(ranges)) as executor:
+        # map returns the shards in order, so the rows are merged in file order
+        yield from executor.map(_parse_csv_shard, repeat(filename), starts, ends, repeat(columns), repeat(converters))
+
+def _intern_strings(strings, table, ids):
+    # Add the strings not seen yet in one pass over the distinct values, then look every row up in C
+    new_strings = [string for string in dict.fromkeys(strings) if string not in ids]
+    ids.update(zip(new_strings, range(len(table), len(table) + len(new_strings))))
+    table.extend(new_strings)
+    return array('q', map(ids.__getitem__, strings))
+
+"""
+Name: SecurityMaster
+Gives every security name and every ticker a dense integer id (0, 1, 2, ...) the first time it is seen.
+Portfolios and ledgers keep only these ids per row, so each name is held once however many rows use it,
+joins are on small integers instead of hashing long security names,
+and names are only looked up again when a report is written.
+
+Attributes:
+ names (list) - the security name of each security id
+ ids (dict) - A map of security name to its id
+    Ex. ids = {'Imaginary Company': 0}
+ tickers (list) - the ticker of each ticker id
+ ticker_ids (dict) - A map of ticker to its id
+
+Note - loaders use the shared SECURITY_MASTER unless they are given another one. Ids only mean the same security
+within one master, so portfolios and ledgers joined by id MUST come from the same master.
+A long running process can give each generation of its input files a new master (see ReportContext),
+so the names of securities that left the files are not kept forever. Maps of holdings or transactions,
+report plans and client reports are each converted or loaded into a new master for the same reason.
+"""
+class SecurityMaster:
+    __slots__ = ('names', 'ids', 'tickers', 'ticker_ids')
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.tickers = []
+        self.ticker_ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, security):
+        security_id = self.ids.get(security)
+        if security_id is None:
+            security_id = self.ids[security] = len(self.names)
+            self.names.append(security)
+        return security_id
+
+    def intern_ticker(self, ticker):
+        ticker_id = self.ticker_ids.get(ticker)
+        if ticker_id is None:
+            ticker_id = self.ticker_ids[ticker] = len(self.tickers)
+            self.tickers.append(ticker)
+        return ticker_id
+
+    def intern_all(self, securities):
+        return _intern_strings(securities, self.names, self.ids)
+
+    def intern_tickers(self, tickers):
+        return _intern_strings(tickers, self.tickers, self.ticker_ids)
+
+SECURITY_MASTER = SecurityMaster()
+
+"""
+Name: pnl_by_name
+Returns: pnl (dict) - A map of security name to its pnl value, in the same order
+Parameters:
+ 'pnl_by_id' (dict) - A map of security id (see SecurityMaster) to its pnl value
+ 'master' (SecurityMaster) - the master the ids come from, defaults to SECURITY_MASTER
+"""
+def pnl_by_name(pnl_by_id, master=None):
+    names = (SECURITY_MASTER if master is None else master).names
+    return {names[security_id]: pnl for security_id, pnl in pnl_by_id.items()}
+
+"""
+Name: check_same_master
+Returns: master (SecurityMaster) - the master shared by every portfolio and ledger given
+Parameters:
+ 'columns' (HoldingsColumns or TransactionLedger) - the portfolios and ledgers that are joined by security id
+
+Note - a ValueError is raised if they were loaded into different masters, as their ids cannot be compared
+"""
+def check_same_master(*columns):
+    master = columns[0].master
+    if any(other.master is not master for other in columns[1:]):
+        raise ValueError("Portfolios and ledgers joined by security id MUST be loaded into the same SecurityMaster")
+    return master
+
+"""
+Name: HoldingsColumns
+A columnar holdings portfolio. Instead of one small dictionary per security, every column of the
+holdings file is kept in its own list/array and row i of each column describes the same position.
+This keeps the memory per position to a few bytes and lets the PNL calculations work column by column.
+
+Attributes:
+ master (SecurityMaster) - the master the security and ticker ids come from
+ security_ids (array of int64) - the security id of each row
+ ticker_ids (array of int64) - the ticker id of each row
+ quantities (array of int64) - the quantity of each row
+ prices (array of float64) - the eod price of each row, or of int64 ticks for a fixed point portfolio (see prices_to_ticks)
+ id_index (dict) - A map of security id to its row number
+    Ex. id_index = {0: 0}
+ index (dict) - A map of security name to its row number, built from id_index the first time it is used
+    Ex. index = {'Imaginary Company': 0}
+ securities, tickers (list) - the security name and ticker of each row, looked up in the master on every use
+
+Parameters:
+ 'fixed_point' (bool) - keep the prices as int64 ticks instead of floats
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+
+Note - if a security appears in more than one row, the index points at its last row.
+This matches the dictionary returned by load_holdings_portfolio.
+"""
+class HoldingsColumns:
+    __slots__ = ('master', 'security_ids', 'ticker_ids', 'quantities', 'prices', 'id_index', '_index')
+
+    def __init__(self, fixed_point=False, master=None):
+        self.master = SECURITY_MASTER if master is None else master
+        self.security_ids = array('q')
+        self.ticker_ids = array('q')
+        self.quantities = array('q')
+        self.prices = array('q' if fixed_point else 'd')
+        self.id_index = {}
+        self._index = None
+
+    def __len__(self):
+        return len(self.security_ids)
+
+    @property
+    def index(self):
+        if self._index is None:
+            names = self.master.names
+            self._index = {names[security_id]: row for security_id, row in self.id_index.items()}
+        return self._index
+
+    @property
+    def securities(self):
+        return list(map(self.master.names.__getitem__, self.security_ids))
+
+    @property
+    def tickers(self):
+        return list(map(self.master.tickers.__getitem__, self.ticker_ids))
+
+    def append(self, security, ticker, quantity, price):
+        security_id = self.master.intern(security)
+        self.id_index[security_id] = len(self.security_ids)
+        self._index = None
+        self.security_ids.append(security_id)
+        self.ticker_ids.append(self.master.intern_ticker(ticker))
+        self.quantities.append(quantity)
+        self.prices.append(price)
+
+    def extend(self, securities, tickers, quantities, prices):
+        security_ids = self.master.intern_all(securities)
+        self.id_index.update(zip(security_ids, range(len(self.security_ids), len(self.security_ids) + len(securities))))
+        self._index = None
+        self.security_ids.extend(security_ids)
+        self.ticker_ids.extend(self.master.intern_tickers(tickers))
+        self.quantities.extend(quantities)
+        self.prices.extend(prices)
+
+"""
+Name: load_holdings_columns
+Returns: holdings (HoldingsColumns) - the columnar holdings portfolio read from the file
+Parameters:
+ 'filename' (string) - the filename being processed
+ 'shards' (int) - parse the file in this many pieces on as many processes (see iter_csv_shards), 1 parses it in this process
+ 'fixed_point' (bool) - parse the prices to int64 ticks (see prices_to_ticks), every pnl calculated from them is in ticks
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+@instrumented()
+def load_holdings_columns(filename, shards=1, fixed_point=False, master=None):
+    holdings = HoldingsColumns(fixed_point, master)
+    converters = (None, None, int, float)
+    chunks = iter_csv_shards(filename, HOLDINGS_COLUMNS, converters, shards) if shards > 1 else \
+        iter_csv_chunks(filename, HOLDINGS_COLUMNS, converters)
+    for securities, tickers, quantities, prices in chunks:
+        holdings.extend(securities, tickers, quantities, prices_to_ticks(prices) if fixed_point else prices)
+    return holdings
+
+"""
+Name: holdings_portfolio_from_columns
+Returns: all_holdings (dict) - A map of security name to a map of its metadata (ticker, quantity, and price)
+    Ex. all_holdings = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100}}
+Parameters:
+ 'holdings' (HoldingsColumns) - the columnar holdings portfolio to convert
+"""
+def holdings_portfolio_from_columns(holdings):
+    tickers, ticker_ids, quantities, prices = holdings.master.tickers, holdings.ticker_ids, holdings.quantities, holdings.prices
+    return {security: {'ticker': tickers[ticker_ids[row]], 'quantity': quantities[row], 'price': prices[row]}
+            for security, row in holdings.index.items()}
+
+"""
+Name: as_holdings_columns
+Returns: holdings (HoldingsColumns) - the given portfolio in columnar form
+Parameters:
+ 'portfolio' (HoldingsColumns or dict) - a columnar portfolio (returned as is) or a map of holdings data
+    Ex. portfolio = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100}}
+ 'master' (SecurityMaster) - the master a map of holdings data is interned in, defaults to a new SecurityMaster
+    so converting a map does not grow SECURITY_MASTER
+"""
+def as_holdings_columns(portfolio, master=None):
+    if isinstance(portfolio, HoldingsColumns):
+        return portfolio
+    holdings = HoldingsColumns(master=SecurityMaster() if master is None else master)
+    for security, position in portfolio.items():
+        holdings.append(security, position['ticker'], position['quantity'], position['price'])
+    return holdings
+
+"""
+Name: is_fixed_point
+Returns: fixed_point (bool) - whether the prices of a columnar portfolio or ledger are int64 ticks
+Parameters:
+ 'columns' (HoldingsColumns or TransactionLedger) - the portfolio or ledger to check
+"""
+def is_fixed_point(columns):
+    return isinstance(columns.prices, array) and columns.prices.typecode == 'q'
+
+"""
+Name: check_fixed_point
+Returns: fixed_point (bool) - whether the prices of every portfolio and ledger given are int64 ticks
+Parameters:
+ 'columns' (HoldingsColumns or TransactionLedger) - the portfolios and ledgers whose prices are used together
+
+Note - a ValueError is raised if some prices are ticks and others are floats, as the pnl would mix the two units
+"""
+def check_fixed_point(*columns):
+    fixed_point = is_fixed_point(columns[0])
+    if any(is_fixed_point(other) != fixed_point for other in columns[1:]):
+        raise ValueError("Portfolios and ledgers used together MUST all have fixed point prices or all have float prices")
+    return fixed_point
+
+"""
+Name: csv_checksum
+Returns: checksum (bytes) - a 32 byte hash of the file contents
+Parameters:
+ 'filename' (string) - the file to hash
+"""
+def csv_checksum(filename):
+    file_hash = hashlib.blake2b(digest_size=32)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.digest()
+
+"""
+Name: write_holdings_snapshot
+Writes holdings to a binary snapshot file with the layout below (all numbers in the byte order of this machine)
+    header            - 64 bytes, see SNAPSHOT_HEADER: magic, version, byte order, row count, checksum of the source csv
+    quantities        - row count * int64
+    prices            - row count * float64
+    security ids      - row count * uint32, the position of the row's security name in the string table
+    ticker ids        - row count * uint32, the position of the row's ticker in the string table
+    string table      - uint64 length of the text, then the utf-8 text of every string separated by a NUL character
+Each column is a fixed width block, so the numeric columns can be used straight from a memory map.
+
+Returns: nothing
+Parameters:
+ 'holdings' (HoldingsColumns) - the holdings to write
+ 'snapshot_filename' (string) - the snapshot file to write
+ 'checksum' (bytes) - the csv_checksum of the csv file the holdings were loaded from
+"""
+def write_holdings_snapshot(holdings, snapshot_filename, checksum):
+    if is_fixed_point(holdings):
+        raise ValueError("Snapshots store float prices, a fixed point portfolio cannot be written to one")
+    strings, string_ids = [], {}
+    def string_id(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+    security_ids = array('I', map(string_id, holdings.securities))
+    ticker_ids = array('I', map(string_id, holdings.tickers))
+    string_table = '\0'.join(strings).encode('utf-8')
+
+    byte_order = SNAPSHOT_BYTE_ORDERS[sys.byteorder]
+    temporary_filename = snapshot_filename + '.tmp'
+    try:
+        with open(temporary_filename, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, byte_order, len(holdings), checksum))
+            f.write(array('q', holdings.quantities).tobytes())
+            f.write(array('d', holdings.prices).tobytes())
+            f.write(security_ids.tobytes())
+            f.write(ticker_ids.tobytes())
+            f.write(array('Q', [len(string_table)]).tobytes())
+            f.write(string_table)
+    except BaseException:
+        # Do not leave a half written file behind when the write fails (ex. the disk is full)
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    # Replace the old snapshot in one step so a reader never sees a half written file
+    os.replace(temporary_filename, snapshot_filename)
+
+"""
+Name: read_holdings_snapshot
+Returns: holdings (HoldingsColumns) - the holdings in the snapshot, or None if the snapshot is missing, stale or truncated.
+    The quantities and prices columns are read only views of the memory mapped file, they are not copied.
+Parameters:
+ 'snapshot_filename' (string) - the snapshot file to read
+ 'checksum' (bytes) - the csv_checksum of the csv file, the snapshot is stale if it was written for another checksum
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+def read_holdings_snapshot(snapshot_filename, checksum, master=None):
+    try:
+        with open(snapshot_filename, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(snapshot) < SNAPSHOT_HEADER.size:
+        return None
+    magic, version, byte_order, row_count, snapshot_checksum = SNAPSHOT_HEADER.unpack_from(snapshot)
+    if (magic, version, byte_order, snapshot_checksum) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_BYTE_ORDERS[sys.byteorder], checksum):
+        return None
+
+    # The fixed width columns and the string table length must all be there before anything is read from them
+    string_table_offset = SNAPSHOT_HEADER.size + 24 * row_count + 8
+    if len(snapshot) < string_table_offset:
+        return None
+    string_table_size = struct.unpack_from('=Q', snapshot, string_table_offset - 8)[0]
+    if len(snapshot) != string_table_offset + string_table_size:
+        return None
+
+    view = memoryview(snapshot)
+    offset = SNAPSHOT_HEADER.size
+    def next_block(size, type_code):
+        nonlocal offset
+        block = view[offset:offset + size].cast(type_code)
+        offset += size
+        return block
+    quantities = next_block(8 * row_count, 'q')
+    prices = next_block(8 * row_count, 'd')
+    security_ids = next_block(4 * row_count, 'I')
+    ticker_ids = next_block(4 * row_count, 'I')
+    offset += 8
+    strings = str(view[offset:offset + string_table_size], 'utf-8').split('\0') if row_count else []
+
+    holdings = HoldingsColumns(master=master)
+    holdings.security_ids = holdings.master.intern_all(list(map(strings.__getitem__, security_ids)))
+    holdings.ticker_ids = holdings.master.intern_tickers(list(map(strings.__getitem__, ticker_ids)))
+    holdings.quantities = quantities
+    holdings.prices = prices
+    holdings.id_index = dict(zip(holdings.security_ids, range(row_count)))
+    return holdings
+
+"""
+Name: load_holdings_snapshot
+Loads a holdings file through its binary snapshot (the csv filename + SNAPSHOT_SUFFIX).
+The first load parses the csv and writes the snapshot, later loads memory map the snapshot instead of parsing the csv.
+The snapshot is rewritten whenever the checksum of the csv changes.
+
+Returns: holdings (HoldingsColumns) - the holdings read from the file. Its columns are read only when they come from a snapshot.
+Parameters:
+ 'filename' (string) - the holdings csv file being processed
+ 'snapshot_filename' (string) - where the snapshot is kept, defaults to the csv filename + SNAPSHOT_SUFFIX
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+@instrumented()
+def load_holdings_snapshot(filename, snapshot_filename=None, master=None):
+    if snapshot_filename is None:
+        snapshot_filename = filename + SNAPSHOT_SUFFIX
+    checksum = csv_checksum(filename)
+    holdings = read_holdings_snapshot(snapshot_filename, checksum, master)
+    if holdings is None:
+        holdings = load_holdings_columns(filename, master=master)
+        try:
+            write_holdings_snapshot(holdings, snapshot_filename, checksum)
+        except OSError as error:
+            # The snapshot is only a cache, the holdings are still correct without it
+            print(f"Could not write snapshot {snapshot_filename}: {error}")
+    return holdings
 
 """
 Name: load_holdings_portfolio
@@ -13,21 +732,143 @@ Returns: all_holdings (dict) - A map of security name to a map of its metadata (
     Ex. all_holdings = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100}}
 Parameters:
  'filename' (string) - the filename being processed
+ 'shards' (int) - the number of processes parsing the file, see load_holdings_columns
 
-Note - this can load both the current and previous holdings portfolios into the same dictionary data structure
+Note - this can load both the current and previous holdings portfolios into the same dictionary data structure.
+Use load_holdings_columns directly for large files, this is a thin adapter over it.
 """
-def load_holdings_portfolio(filename):
-    all_holdings = {}
-    with open(filename, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            # For each security, read the position and price
-            security = row['SecurityName']
-            ticker = row['Ticker']
-            quantity = int(row['Quantity'])
-            price = float(row['Price'])
-            all_holdings[security] = {'ticker': ticker, 'quantity': quantity, 'price': price}
-    return all_holdings
+def load_holdings_portfolio(filename, shards=1):
+    return holdings_portfolio_from_columns(load_holdings_columns(filename, shards))
+
+"""
+Name: TransactionLedger
+An append-only ledger of every fill in a transactions file. Fills are stored in parallel columns
+(row i of each column is the i-th fill in the file) so any number of trades in the same security are kept.
+
+Attributes:
+ master (SecurityMaster) - the master the security and ticker ids come from
+ security_ids (array of int64) - the security id of each fill
+ ticker_ids (array of int64) - the ticker id of each fill
+ quantities (array of int64) - the quantity of each fill
+ prices (array of float64) - the transaction price of each fill
+ actions (list) - the action of each fill normalized by normalize_action (ex. 'BUY' or 'SELL'), an unknown action is kept
+ id_index (dict) - A map of security id to the row numbers of its fills, in file order
+    Ex. id_index = {0: array('q', [0, 3])}
+ index (dict) - A map of security name to the row numbers of its fills, built from id_index the first time it is used
+    Ex. index = {'Imaginary Company': array('q', [0, 3])}
+ securities, tickers (list) - the security name and ticker of each fill, looked up in the master on every use
+
+Parameters:
+ 'fixed_point' (bool) - keep the prices as int64 ticks instead of floats
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+class TransactionLedger:
+    __slots__ = ('master', 'security_ids', 'ticker_ids', 'quantities', 'prices', 'actions', 'id_index', '_index')
+
+    def __init__(self, fixed_point=False, master=None):
+        self.master = SECURITY_MASTER if master is None else master
+        self.security_ids = array('q')
+        self.ticker_ids = array('q')
+        self.quantities = array('q')
+        self.prices = array('q' if fixed_point else 'd')
+        self.actions = []
+        self.id_index = {}
+        self._index = None
+
+    def __len__(self):
+        return len(self.security_ids)
+
+    @property
+    def index(self):
+        if self._index is None:
+            names = self.master.names
+            self._index = {names[security_id]: rows for security_id, rows in self.id_index.items()}
+        return self._index
+
+    @property
+    def securities(self):
+        return list(map(self.master.names.__getitem__, self.security_ids))
+
+    @property
+    def tickers(self):
+        return list(map(self.master.tickers.__getitem__, self.ticker_ids))
+
+    def append(self, security, ticker, quantity, price, action):
+        security_id = self.master.intern(security)
+        rows = self.id_index.get(security_id)
+        if rows is None:
+            rows = self.id_index[security_id] = array('q')
+        rows.append(len(self.security_ids))
+        self._index = None
+        self.security_ids.append(security_id)
+        self.ticker_ids.append(self.master.intern_ticker(ticker))
+        self.quantities.append(quantity)
+        self.prices.append(price)
+        self.actions.append(normalize_action(action))
+
+    def extend(self, securities, tickers, quantities, prices, actions):
+        security_ids = self.master.intern_all(securities)
+        id_index = self.id_index
+        for row, security_id in enumerate(security_ids, len(self.security_ids)):
+            rows = id_index.get(security_id)
+            if rows is None:
+                rows = id_index[security_id] = array('q')
+            rows.append(row)
+        self._index = None
+        self.security_ids.extend(security_ids)
+        self.ticker_ids.extend(self.master.intern_tickers(tickers))
+        self.quantities.extend(quantities)
+        self.prices.extend(prices)
+        self.actions.extend(normalize_actions(actions))
+
+"""
+Name: load_transactions_ledger
+Returns: ledger (TransactionLedger) - every fill read from the file, in file order
+Parameters:
+ 'filename' (string) - the filename being processed
+ 'shards' (int) - parse the file in this many pieces on as many processes (see iter_csv_shards), 1 parses it in this process
+ 'fixed_point' (bool) - parse the prices to int64 ticks (see prices_to_ticks), every pnl calculated from them is in ticks
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+@instrumented()
+def load_transactions_ledger(filename, shards=1, fixed_point=False, master=None):
+    ledger = TransactionLedger(fixed_point, master)
+    converters = (None, None, int, float, None)
+    chunks = iter_csv_shards(filename, TRANSACTIONS_COLUMNS, converters, shards) if shards > 1 else \
+        iter_csv_chunks(filename, TRANSACTIONS_COLUMNS, converters)
+    for securities, tickers, quantities, prices, actions in chunks:
+        ledger.extend(securities, tickers, quantities, prices_to_ticks(prices) if fixed_point else prices, actions)
+    return ledger
+
+"""
+Name: as_transaction_ledger
+Returns: ledger (TransactionLedger) - the given transactions as a ledger
+Parameters:
+ 'all_transactions' (TransactionLedger or dict) - a ledger (returned as is) or a map of one transaction per security
+    Ex. all_transactions = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100, 'action': 'SELL'}}
+ 'master' (SecurityMaster) - the master a map of transactions is interned in, defaults to a new SecurityMaster
+    so converting a map does not grow SECURITY_MASTER
+"""
+def as_transaction_ledger(all_transactions, master=None):
+    if isinstance(all_transactions, TransactionLedger):
+        return all_transactions
+    ledger = TransactionLedger(master=SecurityMaster() if master is None else master)
+    for security, transaction in all_transactions.items():
+        ledger.append(security, transaction['ticker'], transaction['quantity'], transaction['price'], transaction['action'])
+    return ledger
+
+"""
+Name: shared_master
+Returns: master (SecurityMaster) - the master to convert a set of portfolios and ledgers in, so they can be joined by security id:
+    the master of the first columnar portfolio or ledger given, or a new SecurityMaster when they are all maps
+Parameters:
+ '*inputs' (HoldingsColumns, TransactionLedger or dict) - the portfolios and ledgers
+"""
+def shared_master(*inputs):
+    for columns in inputs:
+        if isinstance(columns, (HoldingsColumns, TransactionLedger)):
+            return columns.master
+    return SecurityMaster()
 
 """
 Name: load_transactions_portfolio
@@ -35,23 +876,161 @@ Returns: all_transactions (dict) - A map of security name to a map of its metada
     Ex. all_transactions = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100, 'action': 'SELL'}}
 Parameters:
  'filename' - a string, for the filename being processed
+ 'shards' (int) - the number of processes parsing the file, see load_transactions_ledger
 
-Note - the only difference between this and holdings portfolio is adding 'action'
+Note - the only difference between this and holdings portfolio is adding 'action'.
+This map only keeps the last transaction of each security, use load_transactions_ledger to keep every fill.
 """
-def load_transactions_portfolio(filename):
+def load_transactions_portfolio(filename, shards=1):
+    ledger = load_transactions_ledger(filename, shards)
+    tickers, ticker_ids = ledger.master.tickers, ledger.ticker_ids
+    quantities, prices, actions = ledger.quantities, ledger.prices, ledger.actions
     all_transactions = {}
-    with open(filename, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            # For each security, read the position, price and transaction type
-            security = row['SecurityName']
-            ticker = row['Ticker']
-            quantity = int(row['Quantity'])
-            transaction_price = float(row['TransactionPrice'])
-            transaction_type = row['Action']
-            all_transactions[security] = {'ticker': ticker, 'quantity': quantity, 'price': transaction_price, 'action': transaction_type}
+    for security, rows in ledger.index.items():
+        row = rows[-1]
+        all_transactions[security] = {'ticker': tickers[ticker_ids[row]], 'quantity': quantities[row], 'price': prices[row],
+                                      'action': actions[row]}
     return all_transactions
 
+def _parse_quantity(text):
+    try:
+        quantity = int(text)
+    except ValueError:
+        return None
+    return quantity if quantity > 0 else None
+
+def _parse_price(text):
+    try:
+        price = float(text)
+    except ValueError:
+        return None
+    return price if math.isfinite(price) and price > 0 else None
+
+def _parse_price_ticks(text):
+    price = _parse_price(text)
+    return round(price * PRICE_TICKS) if price is not None and price * PRICE_TICKS < MAX_FLOAT_TICKS else None
+
+"""
+Name: validate_transactions
+Loads a transactions file, keeping only the rows that pass validation.
+Actions are normalized with normalize_actions, quantities and prices are checked column by column for each chunk of rows.
+Every rejected row is written to the quarantine file with its row number and reason code (see REJECT_REASONS)
+instead of printing a warning per row.
+
+Returns: (ledger, summary) (tuple)
+ ledger (TransactionLedger) - every valid fill, in file order
+ summary (dict) - the number of rows read, accepted and rejected per reason code
+    Ex. summary = {'rows': 6, 'accepted': 4, 'rejected': {'EMPTY_ACTION': 1, 'UNKNOWN_ACTION': 1, ...}}
+Parameters:
+ 'filename' (string) - the transactions filename being processed
+ 'quarantine_filename' (string) - the csv file the rejected rows are written to, None to only count them
+ 'chunk_size' (int) - the number of rows validated at a time
+ 'fixed_point' (bool) - parse the prices to int64 ticks (see prices_to_ticks)
+ 'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+"""
+def validate_transactions(filename, quarantine_filename=None, chunk_size=CSV_CHUNK_SIZE, fixed_point=False, master=None):
+    with PROFILER.stage('validate_transactions') as record:
+        ledger, summary = _validate_transactions(filename, quarantine_filename, chunk_size, fixed_point, master)
+        record['rows'] = summary['rows']
+    return ledger, summary
+
+def _validate_transactions(filename, quarantine_filename, chunk_size, fixed_point, master):
+    ledger = TransactionLedger(fixed_point, master)
+    parse_price = _parse_price_ticks if fixed_point else _parse_price
+    summary = {'rows': 0, 'accepted': 0, 'rejected': dict.fromkeys(REJECT_REASONS, 0)}
+    with open(filename, 'r', newline='') as f, \
+         (open(quarantine_filename, 'w', newline='') if quarantine_filename else nullcontext()) as quarantine_file:
+        quarantine_writer = csv.writer(quarantine_file) if quarantine_file else None
+        if quarantine_writer:
+            quarantine_writer.writerow(QUARANTINE_COLUMNS)
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return ledger, summary
+        positions = [header.index(column) for column in TRANSACTIONS_COLUMNS]
+        pick_columns = operator.itemgetter(*positions)
+        row_width = max(positions) + 1
+        row_number = 0
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+            numbered_rows = [(number, row) for number, row in enumerate(rows, row_number + 1) if row]
+            row_number += len(rows)
+            # Short rows are padded so every column can be checked in one pass
+            picked_rows = [pick_columns(row if len(row) >= row_width else row + [''] * (row_width - len(row)))
+                           for _, row in numbered_rows]
+            if not picked_rows:
+                continue
+            securities, tickers, quantity_texts, price_texts, action_texts = zip(*picked_rows)
+            actions = normalize_actions(action_texts)
+            signs = list(map(ACTION_SIGNS.get, actions))
+            quantities = list(map(_parse_quantity, quantity_texts))
+            prices = list(map(parse_price, price_texts))
+
+            accepted_rows = []
+            for position, (number, row) in enumerate(numbered_rows):
+                if len(row) < row_width:
+                    reason = REJECT_MISSING_FIELD
+                elif signs[position] is None:
+                    reason = REJECT_UNKNOWN_ACTION if actions[position] else REJECT_EMPTY_ACTION
+                elif quantities[position] is None:
+                    reason = REJECT_BAD_QUANTITY
+                elif prices[position] is None:
+                    reason = REJECT_BAD_PRICE
+                else:
+                    accepted_rows.append(position)
+                    continue
+                summary['rejected'][reason] += 1
+                if quarantine_writer:
+                    quarantine_writer.writerow((number, reason) + picked_rows[position])
+
+            summary['rows'] += len(numbered_rows)
+            summary['accepted'] += len(accepted_rows)
+            ledger.extend([securities[position] for position in accepted_rows], [tickers[position] for position in accepted_rows],
+                          [quantities[position] for position in accepted_rows], [prices[position] for position in accepted_rows],
+                          [actions[position] for position in accepted_rows])
+    return ledger, summary
+
+"""
+Name: format_validation_summary
+Returns: summary (string) - one line describing how many transactions were rejected and why
+    Ex. 'Quarantined 2 of 6 transactions: EMPTY_ACTION=1, UNKNOWN_ACTION=1'
+Parameters:
+ 'summary' (dict) - the summary returned by validate_transactions
+"""
+def format_validation_summary(summary):
+    rejected = {reason: count for reason, count in summary['rejected'].items() if count}
+    reasons = ', '.join(f'{reason}={count}' for reason, count in rejected.items())
+    return f"Quarantined {sum(rejected.values())} of {summary['rows']} transactions" + (f': {reasons}' if reasons else '')
+
+"""
+Name: calculate_holdings_pnl_by_id
+The same as calculate_holdings_pnl, keyed by security id (see SecurityMaster)
+
+Returns: holdings_pnl (dict) - A map of security id to its holding pnl value
+Parameters:
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
+
+Note - both portfolios are joined on their security ids and the pnl is taken over the matched rows
+"""
+@instrumented()
+def calculate_holdings_pnl_by_id(current_holdings_portfolio, previous_holdings_portfolio):
+    master = shared_master(current_holdings_portfolio, previous_holdings_portfolio)
+    current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+    previous_holdings = as_holdings_columns(previous_holdings_portfolio, master)
+    check_same_master(current_holdings, previous_holdings)
+    check_fixed_point(current_holdings, previous_holdings)
+    previous_id_index = previous_holdings.id_index
+    # Join: (security id, current row, previous row) for every security held on both dates
+    matched_rows = [(security_id, current_row, previous_id_index[security_id])
+                    for security_id, current_row in current_holdings.id_index.items() if security_id in previous_id_index]
+    current_prices = current_holdings.prices
+    previous_quantities, previous_prices = previous_holdings.quantities, previous_holdings.prices
+    return {security_id: previous_quantities[previous_row] * (current_prices[current_row] - previous_prices[previous_row])
+            for security_id, current_row, previous_row in matched_rows}
+
 """
 Name: calculate_holdings_pnl
 This function calculates the holdings_pnl for each security given a current and previous holdings portfolio.
@@ -61,47 +1040,115 @@ This reperesents the market price difference between current eod and previous eo
 Returns: holdings_pnl (dict) - A map of security name to its holding pnl value (int)
     Ex. holdings_pnl = {'Imaginary Company': -10}
 Parameters:
- 'current_holdings_portfolio' (dict) - a map of holdings data from the current date
- 'previous_holdings_portfolio' (dict) - a map of holdings data from the previous date
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
 """
+@instrumented()
 def calculate_holdings_pnl(current_holdings_portfolio, previous_holdings_portfolio):
-    holdings_pnl = {}
-    for security, current_position in current_holdings_portfolio.items():
-        if security in previous_holdings_portfolio:
-            previous_position = previous_holdings_portfolio[security]
-            quantity = previous_position['quantity']
-            current_price = current_position['price']
-            previous_price = previous_position['price']
-            holdings_pnl[security] = quantity * (current_price - previous_price)
-    return holdings_pnl
+    master = shared_master(current_holdings_portfolio, previous_holdings_portfolio)
+    current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+    return pnl_by_name(calculate_holdings_pnl_by_id(current_holdings, previous_holdings_portfolio), master)
+
+def _report_invalid_actions(count):
+    # One line for the whole file instead of a warning per fill
+    if count:
+        print(f"Skipped {count} transactions with an action that is not valid, it MUST be either SELL or BUY")
+
+"""
+Name: calculate_transactions_pnl_by_id
+The same as calculate_transactions_pnl, keyed by security id (see SecurityMaster)
+
+Returns: transactions_pnl (dict) - A map of security id to its transaction pnl value
+Parameters:
+ 'all_transactions' (TransactionLedger or dict) - every fill, or a map of one transaction per security
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data for all securities from the current date
+"""
+@instrumented()
+def calculate_transactions_pnl_by_id(all_transactions, current_holdings_portfolio):
+    master = shared_master(current_holdings_portfolio, all_transactions)
+    current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+    ledger = as_transaction_ledger(all_transactions, master)
+    check_same_master(current_holdings, ledger)
+    check_fixed_point(current_holdings, ledger)
+    current_id_index, current_prices = current_holdings.id_index, current_holdings.prices
+    quantities, prices = ledger.quantities, ledger.prices
+    # The sign of every fill, column by column: BUY adds quantity * (eod - price), SELL subtracts it, 0 for an invalid action
+    signs = list(map(ACTION_SIGNS.get, ledger.actions, repeat(0)))
+    transactions_pnl = {}
+    invalid_actions = 0
+    for security_id, rows in ledger.id_index.items():
+        if security_id not in current_id_index:
+            continue
+        fill_signs = list(map(signs.__getitem__, rows))
+        skipped = fill_signs.count(0)
+        invalid_actions += skipped
+        if skipped == len(rows):
+            continue
+        # The pnl of every fill of the security with map over its rows, added left to right like adding the fills one by one
+        signed_quantities = map(operator.mul, fill_signs, map(quantities.__getitem__, rows))
+        price_moves = map(operator.sub, repeat(current_prices[current_id_index[security_id]]), map(prices.__getitem__, rows))
+        transactions_pnl[security_id] = sum(map(operator.mul, signed_quantities, price_moves))
+    _report_invalid_actions(invalid_actions)
+    return transactions_pnl
 
 """
 Name: calculate_transactions_pnl
 This function calculates the transactions_pnl for each security given a transactions and current holdings portfolio.
 Transactions PNL is only calculated for securities that exist in the current portfolio.
 This reperesents the market price difference between the transaction price and the current eod price.
+When a security has several fills, its transactions_pnl is the sum of the pnl of each fill.
 
 Returns: transactions_pnl (dict) - A map of security name to its transaction pnl value (int)
     Ex. transactions_pnl = {'Imaginary Company': -10}
 Parameters:
- 'all_transactions' (dict) - a map of transactions data for all securities
+ 'all_transactions' (TransactionLedger or dict) - every fill, or a map of one transaction per security
     Ex. all_transactions = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 2, 'price': 100, 'action': 'SELL'}}
- 'current_holdings_portfolio' (dict) - a map of holdings data for all securities from the current date
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data for all securities from the current date
     Ex. current_holdings_portfolio = {'Imaginary Company': {'ticker': 'BOP', 'quantity': 1, 'price': 200}}
 """
+@instrumented()
 def calculate_transactions_pnl(all_transactions, current_holdings_portfolio):
+    master = shared_master(current_holdings_portfolio, all_transactions)
+    current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+    return pnl_by_name(calculate_transactions_pnl_by_id(all_transactions, current_holdings), master)
+
+"""
+Name: stream_transactions_pnl
+This function calculates the same transactions_pnl as calculate_transactions_pnl, but reads the transactions
+file in chunks and adds each fill into a running total per security instead of loading the whole ledger.
+Memory use depends on the number of securities, not on the number of transactions in the file.
+
+Returns: transactions_pnl (dict) - A map of security name to its transaction pnl value (int),
+    in ticks when the holdings have fixed point prices (the transaction prices are then parsed as ticks too)
+    Ex. transactions_pnl = {'Imaginary Company': -10}
+Parameters:
+ 'filename' (string) - the transactions filename being processed
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data for all securities from the current date
+ 'chunk_size' (int) - the number of transactions parsed at a time
+"""
+@instrumented()
+def stream_transactions_pnl(filename, current_holdings_portfolio, chunk_size=CSV_CHUNK_SIZE):
+    current_holdings = as_holdings_columns(current_holdings_portfolio)
+    current_index, current_prices = current_holdings.index, current_holdings.prices
+    parse_price = parse_price_ticks if is_fixed_point(current_holdings) else float
     transactions_pnl = {}
-    for security, transaction in all_transactions.items():
-        transaction_quantity = transaction['quantity']
-        transaction_price = transaction['price']
-        if security in current_holdings_portfolio:
-            current_eod_price = current_holdings_portfolio[security]['price']
-            if transaction['action'] == "SELL":
-                transactions_pnl[security] = transaction_quantity * (transaction_price - current_eod_price)
-            elif transaction['action'] == "BUY":
-                transactions_pnl[security] = transaction_quantity * (current_eod_price - transaction_price)
+    invalid_actions = 0
+    for securities, quantities, prices, actions in iter_csv_chunks(
+            filename, ('SecurityName', 'Quantity', 'TransactionPrice', 'Action'), (None, int, parse_price, None), chunk_size):
+        for security, quantity, transaction_price, action in zip(securities, quantities, prices, normalize_actions(actions)):
+            current_row = current_index.get(security)
+            if current_row is None:
+                continue
+            sign = ACTION_SIGNS.get(action)
+            if sign is None:
+                invalid_actions += 1
+                continue
+            fill_pnl = sign * quantity * (current_prices[current_row] - transaction_price)
+            if security in transactions_pnl:
+                transactions_pnl[security] += fill_pnl
             else:
-                print(f"Transaction type: {transaction['action']} is not valid, it MUST be either SELL or BUY")
+                transactions_pnl[security] = fill_pnl
+    _report_invalid_actions(invalid_actions)
     return transactions_pnl
 
 """
@@ -109,19 +1156,422 @@ Name: calculate_total_pnl
 This function adds the holding and transaction pnl of each security if it exists.
 If the security does not exist in either, the value used for that security is 0
 
-Returns: total_pnl (dict) - A map of security name to its total pnl value (int)
+Returns: total_pnl (dict) - A map of security name (or id) to its total pnl value (int)
 Parameters:
- holdings_pnl (dict) - A map of security name to its holding pnl value (int)
- transactions_pnl (dict) - A map of security name to its transaction pnl value (int)
+ holdings_pnl (dict) - A map of security name (or id) to its holding pnl value (int)
+ transactions_pnl (dict) - A map of security name (or id) to its transaction pnl value (int)
+
+Note - securities are listed in holdings order, followed by the securities that only have transactions
 """
+@instrumented()
 def calculate_total_pnl(holdings_pnl, transactions_pnl):
-    total_pnl = {}
-    # Get the set of keys in both holdings and transactions
-    all_securities = holdings_pnl.keys() | transactions_pnl.keys()
-    for security in all_securities:
-        total_pnl[security] = holdings_pnl.get(security, 0) + transactions_pnl.get(security, 0)
+    # Start from the holdings and merge the transactions in, no set of all keys is needed
+    total_pnl = dict(holdings_pnl)
+    for security, transaction_pnl in transactions_pnl.items():
+        total_pnl[security] = total_pnl.get(security, 0) + transaction_pnl
     return total_pnl
 
+"""
+Name: price_shock_snapshots
+Builds a grid of what-if prices by moving every current eod price by the same percentage, once per shock
+
+Returns: price_snapshots (list) - one array of prices per shock, aligned with securities.
+    A security that is not in the current holdings gets 0, the same way revalue_pnl leaves it at 0.
+    For fixed point holdings the prices are int64 ticks, each shocked price rounded to the nearest tick.
+Parameters:
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date, its prices are the base prices
+ 'securities' (list) - the security names, in the order of the prices in each snapshot
+ 'shocks' (list) - the price moves to apply (ex. -0.1 for prices 10% lower)
+"""
+def price_shock_snapshots(current_holdings_portfolio, securities, shocks):
+    current_holdings = as_holdings_columns(current_holdings_portfolio)
+    index, prices = current_holdings.index, current_holdings.prices
+    if is_fixed_point(current_holdings):
+        base_prices = [prices[index[security]] if security in index else 0 for security in securities]
+        # The shock is taken as the decimal it is written as, so every shocked price is an exact number of ticks
+        return [array('q', [round(price * (1 + Decimal(str(shock)))) for price in base_prices]) for shock in shocks]
+    base_prices = [prices[index[security]] if security in index else 0.0 for security in securities]
+    return [array('d', [price * (1 + shock) for price in base_prices]) for shock in shocks]
+
+"""
+Name: revalue_pnl
+This function revalues the holdings and transactions pnl of the whole book against many price snapshots at once,
+for example an intraday tick file or a grid of what-if price shocks.
+Everything that does not depend on the price is worked out once per security, so each snapshot only costs
+one multiply and subtract per security:
+    holdings_pnl = previous quantity * (price - previous price)
+    transactions_pnl = price * (sum of BUY quantities - sum of SELL quantities) - (the same sums of quantity * transaction price)
+
+Returns: (holdings_pnl, transactions_pnl) (tuple) - two lists with one array of pnl per snapshot, aligned with securities.
+    A security gets 0 where calculate_holdings_pnl / calculate_transactions_pnl would leave it out.
+    For fixed point portfolios each snapshot's pnl is a list of exact int ticks instead of an array of floats.
+Parameters:
+ 'price_snapshots' (list) - one sequence of prices per snapshot (snapshots x securities), in the units of the holdings prices
+    (int ticks for fixed point portfolios, see price_shock_snapshots)
+ 'securities' (list) - the security names, in the order of the prices in each snapshot
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
+ 'all_transactions' (TransactionLedger or dict) - the transactions to revalue
+
+Note - a ValueError is raised if the portfolios and transactions do not all have fixed point prices or all float prices,
+or if the portfolios are fixed point and a snapshot has a price that is not in ticks
+"""
+def revalue_pnl(price_snapshots, securities, current_holdings_portfolio, previous_holdings_portfolio, all_transactions):
+    master = shared_master(current_holdings_portfolio, previous_holdings_portfolio, all_transactions)
+    current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+    previous_holdings = as_holdings_columns(previous_holdings_portfolio, master)
+    ledger = as_transaction_ledger(all_transactions, master)
+    fixed_point = check_fixed_point(current_holdings, previous_holdings, ledger)
+    if fixed_point and not all(isinstance(price, int) for prices in price_snapshots for price in prices):
+        raise ValueError("The price snapshots of fixed point portfolios MUST be in ticks (int), see price_shock_snapshots")
+    current_index = current_holdings.index
+    # Fixed point sums are kept as Python ints, so they stay exact however large the notionals get
+    column = list if fixed_point else partial(array, 'd')
+
+    previous_quantities, previous_prices = column(), column()
+    signed_quantities, signed_notionals = column(), column()
+    for security in securities:
+        previous_row = previous_holdings.index.get(security) if security in current_index else None
+        previous_quantities.append(0 if previous_row is None else previous_holdings.quantities[previous_row])
+        previous_prices.append(0 if previous_row is None else previous_holdings.prices[previous_row])
+        signed_quantity = signed_notional = 0
+        if security in current_index:
+            for row in ledger.index.get(security, ()):
+                sign = ACTION_SIGNS.get(ledger.actions[row])
+                if sign is not None:
+                    signed_quantity += sign * ledger.quantities[row]
+                    signed_notional += sign * ledger.quantities[row] * ledger.prices[row]
+        signed_quantities.append(signed_quantity)
+        signed_notionals.append(signed_notional)
+
+    holdings_pnl = [column([quantity * (price - previous_price)
+                            for quantity, price, previous_price in zip(previous_quantities, prices, previous_prices)])
+                    for prices in price_snapshots]
+    transactions_pnl = [column([price * quantity - notional
+                                for quantity, price, notional in zip(signed_quantities, prices, signed_notionals)])
+                        for prices in price_snapshots]
+    return holdings_pnl, transactions_pnl
+
+"""
+Name: PnlBook
+Keeps the holdings, transactions and total pnl of every security up to date as fills and price ticks arrive during the day.
+Each fill or price tick only updates the security it is for, so reading the pnl never needs a full recalculation.
+The pnl maps follow the same rules as calculate_holdings_pnl, calculate_transactions_pnl and calculate_total_pnl:
+transactions pnl is only counted once the security has an eod price.
+
+Attributes:
+ holdings_pnl (dict) - A map of security name to its holding pnl value
+ transactions_pnl (dict) - A map of security name to its transaction pnl value
+ total_pnl (dict) - A map of security name to its total pnl value
+ portfolio_pnl (float) - the total pnl of all securities
+ fixed_point (bool) - whether the prices of the book are int64 ticks, the prices given to apply_transaction and apply_price
+    MUST be in the same units
+Parameters:
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date, its prices are the starting eod prices
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
+ 'all_transactions' (TransactionLedger or dict) - transactions to apply straight away, if any
+
+Note - the maps are read only, update the book with apply_transaction and apply_price.
+A ValueError is raised if the portfolios and transactions do not all have fixed point prices or all float prices.
+"""
+class PnlBook:
+    def __init__(self, current_holdings_portfolio, previous_holdings_portfolio, all_transactions=None):
+        master = shared_master(current_holdings_portfolio, previous_holdings_portfolio,
+                               *(() if all_transactions is None else (all_transactions,)))
+        current_holdings = as_holdings_columns(current_holdings_portfolio, master)
+        previous_holdings = as_holdings_columns(previous_holdings_portfolio, master)
+        ledger = None if all_transactions is None else as_transaction_ledger(all_transactions, master)
+        self.fixed_point = check_fixed_point(current_holdings, previous_holdings, *(() if ledger is None else (ledger,)))
+        self.eod_prices = {security: current_holdings.prices[row] for security, row in current_holdings.index.items()}
+        self.previous_positions = {security: (previous_holdings.quantities[row], previous_holdings.prices[row])
+                                   for security, row in previous_holdings.index.items()}
+        # Per security sum of (sign * quantity) and (sign * quantity * transaction price) over its fills,
+        # so that transactions pnl = eod price * signed quantity - signed notional
+        self.signed_quantities = {}
+        self.signed_notionals = {}
+        self.holdings_pnl = calculate_holdings_pnl(current_holdings, previous_holdings)
+        self.transactions_pnl = {}
+        self.total_pnl = dict(self.holdings_pnl)
+        self.portfolio_pnl = sum(self.total_pnl.values())
+        if ledger is not None:
+            for row, security in enumerate(ledger.securities):
+                self.apply_transaction(security, ledger.quantities[row], ledger.prices[row], ledger.actions[row])
+
+    def _set_pnl(self, pnl_map, security, pnl):
+        change = pnl - pnl_map.get(security, 0)
+        pnl_map[security] = pnl
+        self.total_pnl[security] = self.total_pnl.get(security, 0) + change
+        self.portfolio_pnl += change
+
+    def _update_transactions_pnl(self, security):
+        pnl = self.eod_prices[security] * self.signed_quantities[security] - self.signed_notionals[security]
+        self._set_pnl(self.transactions_pnl, security, pnl)
+
+    """
+    Name: apply_transaction
+    Adds one fill to the book. The action is not case sensitive, fills with an empty or unknown action are ignored.
+
+    Returns: applied (bool) - whether the fill was added
+    Parameters:
+     'security' (string) - the security name
+     'quantity' (int) - the transaction quantity
+     'price' (float) - the transaction price
+     'action' (string) - BUY or SELL
+    """
+    def apply_transaction(self, security, quantity, price, action):
+        sign = action_sign(action)
+        if sign is None:
+            return False
+        self.signed_quantities[security] = self.signed_quantities.get(security, 0) + sign * quantity
+        self.signed_notionals[security] = self.signed_notionals.get(security, 0) + sign * quantity * price
+        if security in self.eod_prices:
+            self._update_transactions_pnl(security)
+        return True
+
+    """
+    Name: apply_price
+    Moves the eod price of a security and revalues its holdings and transactions pnl
+
+    Returns: nothing
+    Parameters:
+     'security' (string) - the security name
+     'price' (float) - the new price
+    """
+    def apply_price(self, security, price):
+        self.eod_prices[security] = price
+        if security in self.previous_positions:
+            previous_quantity, previous_price = self.previous_positions[security]
+            self._set_pnl(self.holdings_pnl, security, previous_quantity * (price - previous_price))
+        if security in self.signed_quantities:
+            self._update_transactions_pnl(security)
+
+    """
+    Name: security_pnl
+    Returns: total pnl (float) - the total pnl of one security, 0 if the book has no pnl for it
+    Parameters:
+     'security' (string) - the security name
+    """
+    def security_pnl(self, security):
+        return self.total_pnl.get(security, 0)
+
+"""
+Name: load_security_attributes
+Reads a security attributes file: a SecurityName column followed by one column per attribute (ex. Sector, Desk, Account)
+
+Returns: attributes (dict) - A map of attribute name to a map of security name to its value, ready to use as groupings
+    Ex. attributes = {'Sector': {'Imaginary Company': 'Energy'}, 'Desk': {'Imaginary Company': 'Commodities'}}
+Parameters:
+ 'filename' (string) - the attributes file, defaults to the client registry's default security_attributes_filename
+"""
+def load_security_attributes(filename=None):
+    with open(resolve_filename('security_attributes_filename', filename), 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return {}
+        security_column = header.index('SecurityName')
+        attribute_columns = [(column, name) for column, name in enumerate(header) if column != security_column]
+        attributes = {name: {} for _, name in attribute_columns}
+        for row in reader:
+            if not row:
+                continue
+            for column, name in attribute_columns:
+                # An empty value leaves the security unassigned for that attribute
+                if column < len(row) and row[column]:
+                    attributes[name][row[security_column]] = row[column]
+    return attributes
+
+"""
+Name: pnl_groupings
+Derives the groupings that come from the portfolio itself rather than from an attributes file
+
+Returns: groupings (dict) - A map of grouping name to a map of security name to its group
+    'Side' - LONG or SHORT from the sign of the current holdings quantity
+    'Action' - BUY or SELL when every fill of the security has that action, MIXED when it has both
+    'Direction' - GAINER or LOSER from the sign of the pnl, FLAT for no pnl
+Parameters:
+ 'pnl' (dict) - A map of security name to its pnl value, the pnl being grouped
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date, None to leave out 'Side'
+ 'all_transactions' (TransactionLedger or dict) - the fills, None to leave out 'Action'
+"""
+def pnl_groupings(pnl, current_holdings_portfolio=None, all_transactions=None):
+    groupings = {}
+    if current_holdings_portfolio is not None:
+        current_holdings = as_holdings_columns(current_holdings_portfolio)
+        quantities = current_holdings.quantities
+        groupings['Side'] = {security: 'SHORT' if quantities[row] < 0 else 'LONG' for security, row in current_holdings.index.items()}
+    if all_transactions is not None:
+        ledger = as_transaction_ledger(all_transactions)
+        actions = ledger.actions
+        groupings['Action'] = {}
+        for security, rows in ledger.index.items():
+            security_actions = {actions[row] for row in rows} & ACTION_SIGNS.keys()
+            if security_actions:
+                groupings['Action'][security] = security_actions.pop() if len(security_actions) == 1 else 'MIXED'
+    groupings['Direction'] = {security: 'GAINER' if gain_loss > 0 else 'LOSER' if gain_loss < 0 else 'FLAT'
+                              for security, gain_loss in pnl.items()}
+    return groupings
+
+"""
+Name: aggregate_pnl
+Rolls a pnl map up by any number of groupings at once. Every security is visited once and updates
+the sum, count, min, max and top contributors of its group in every grouping, instead of one loop per rollup.
+
+Returns: aggregates (dict) - A map of grouping name to a map of group to its aggregates, groups in order of first appearance
+    Ex. aggregates = {'Sector': {'Energy': {'sum': 30, 'count': 2, 'min': -10, 'max': 40,
+                                            'top': [('Imaginary Company', 40), ('Other Company', -10)]}}}
+    'top' lists the securities with the largest absolute pnl in the group, largest first
+Parameters:
+ 'pnl' (dict) - A map of security name to its pnl value (holdings, transactions or total)
+ 'groupings' (dict) - A map of grouping name to a map of security name to its group (see load_security_attributes
+    and pnl_groupings). Securities missing from a grouping are put in UNASSIGNED_GROUP.
+ 'top_n' (int) - the number of top contributors kept per group
+"""
+@instrumented(rows_argument=0)
+def aggregate_pnl(pnl, groupings, top_n=5):
+    securities, values = list(pnl), list(pnl.values())
+    # The group of every security in every grouping, looked up column by column before the pass
+    group_columns = [list(map(groups.get, securities, repeat(UNASSIGNED_GROUP))) for groups in groupings.values()]
+    accumulators = [{} for _ in groupings]
+    for row, gain_loss in enumerate(values):
+        contribution = (abs(gain_loss), -row)
+        for group_column, group_accumulators in zip(group_columns, accumulators):
+            accumulator = group_accumulators.get(group_column[row])
+            if accumulator is None:
+                group_accumulators[group_column[row]] = [gain_loss, 1, gain_loss, gain_loss, [contribution]]
+                continue
+            accumulator[0] += gain_loss
+            accumulator[1] += 1
+            if gain_loss < accumulator[2]:
+                accumulator[2] = gain_loss
+            elif gain_loss > accumulator[3]:
+                accumulator[3] = gain_loss
+            # A min heap of the top_n largest contributions, ties go to the security seen first
+            top = accumulator[4]
+            if len(top) < top_n:
+                heapq.heappush(top, contribution)
+            elif contribution > top[0]:
+                heapq.heapreplace(top, contribution)
+
+    aggregates = {}
+    for grouping, group_accumulators in zip(groupings, accumulators):
+        aggregates[grouping] = {
+            group: {'sum': total, 'count': count, 'min': minimum, 'max': maximum,
+                    'top': [(securities[-negative_row], values[-negative_row]) for _, negative_row in sorted(top, reverse=True)]}
+            for group, (total, count, minimum, maximum, top) in group_accumulators.items()}
+    return aggregates
+
+"""
+Name: format_aggregates
+Returns: report (string) - one table per grouping with the sum, count, min and max of each group and its top contributor
+Parameters:
+ 'aggregates' (dict) - the aggregates returned by aggregate_pnl
+"""
+def format_aggregates(aggregates):
+    str_fmt = "{:<25} {:>15} {:>7} {:>15} {:>15}   {}"
+    lines = []
+    for grouping, groups in aggregates.items():
+        lines.append(f'PNL by {grouping}')
+        lines.append(str_fmt.format('Group', 'Sum', 'Count', 'Min', 'Max', 'Top contributor'))
+        for group, aggregate in groups.items():
+            total, minimum, maximum = (round(aggregate[name], ROUNDING_DECIMAL) for name in ('sum', 'min', 'max'))
+            top = ', '.join(f'{security} ({round(gain_loss, ROUNDING_DECIMAL)})' for security, gain_loss in aggregate['top'][:1])
+            lines.append(str_fmt.format(group, total, aggregate['count'], minimum, maximum, top))
+        lines.append('')
+    return '\n'.join(lines)
+
+def _console_row(security, gain_loss):
+    return "{:<30} {:<35}\n".format(security, gain_loss)
+
+def _csv_row(security, gain_loss):
+    if any(character in security for character in ',"\r\n'):
+        security = '"' + security.replace('"', '""') + '"'
+    return f'{security},{gain_loss}\n'
+
+def _jsonl_row(security, gain_loss):
+    if isinstance(gain_loss, Decimal):
+        # json has no decimal type, write the exact digits as the number
+        return f'{{"security": {json.dumps(security)}, "pnl": {gain_loss}}}\n'
+    return json.dumps({'security': security, 'pnl': gain_loss}) + '\n'
+
+_CONSOLE_SEPARATOR = '------------------------------------------------\n'
+
+"""
+REPORT_FORMATS - A map of report format name to how that format is written:
+ 'header' (string) - the text before the first row
+ 'row' (function) - takes a security name and its rounded pnl and returns the text of that row
+ 'footer' (string) - the text after the last row
+Add an entry to support another output format.
+"""
+REPORT_FORMATS = {
+    'console': {'header': _CONSOLE_SEPARATOR + _console_row('Security', 'PNL') + _CONSOLE_SEPARATOR,
+                'row': _console_row, 'footer': _CONSOLE_SEPARATOR},
+    'csv': {'header': 'Security,PNL\n', 'row': _csv_row, 'footer': ''},
+    'jsonl': {'header': '', 'row': _jsonl_row, 'footer': ''},
+}
+
+"""
+Name: render_reports
+This function formats a PNL report in several formats with one pass over the pnl map.
+Each format is built up in its own buffer and joined into a single string at the end.
+
+Returns: reports (dict) - A map of format name to the formatted report (string)
+Parameters:
+ pnl (dict) - A map of security name to its pnl value (int)
+ formats (iterable) - the names of the formats to render, see REPORT_FORMATS
+"""
+def render_reports(pnl, formats):
+    report_formats = {name: REPORT_FORMATS[name] for name in formats}
+    buffers = {name: [report_format['header']] for name, report_format in report_formats.items()}
+    row_writers = [(buffers[name].append, report_format['row']) for name, report_format in report_formats.items()]
+    for security, gain_loss in pnl.items():
+        rounded_gain_loss = round(gain_loss, ROUNDING_DECIMAL)
+        for append, format_row in row_writers:
+            append(format_row(security, rounded_gain_loss))
+    for name, report_format in report_formats.items():
+        buffers[name].append(report_format['footer'])
+    return {name: ''.join(buffer) for name, buffer in buffers.items()}
+
+"""
+Name: write_reports
+This function writes a PNL report to several outputs at once, with a single write per output
+
+Returns: nothing
+Parameters:
+ pnl (dict) - A map of security name to its pnl value (int)
+ outputs (dict) - A map of format name to the open text file it is written to
+    Ex. outputs = {'console': sys.stdout, 'csv': open('pnl.csv', 'w', newline='')}
+"""
+def write_reports(pnl, outputs):
+    reports = render_reports(pnl, outputs.keys())
+    for name, output in outputs.items():
+        output.write(reports[name])
+
+"""
+Name: top_pnl
+This function picks the n securities with the largest losses (or gains) without sorting the whole pnl map
+
+Returns: top_pnl (dict) - A map of security name to its pnl value for the n picked securities, ordered from the largest loss (or gain)
+Parameters:
+ pnl (dict) - A map of security name to its pnl value (int)
+ n (int) - the number of securities to pick
+ largest_losses (bool) - pick the largest losses when True, the largest gains when False
+"""
+def top_pnl(pnl, n, largest_losses=True):
+    select = heapq.nsmallest if largest_losses else heapq.nlargest
+    return dict(select(n, pnl.items(), key=operator.itemgetter(1)))
+
+"""
+Name: format_report
+This function formats a PNL report as text, with the same layout generate_report prints
+
+Returns: report (string) - the formatted report
+Parameters:
+ pnl (dict) - A map of security name to its pnl value (int)
+"""
+def format_report(pnl):
+    return render_reports(pnl, ('console',))['console'][:-1]
+
 """
 Name: generate_report
 This function prints the formatted PNL report to the console
@@ -132,14 +1582,526 @@ Parameters:
 
 Note - This can be used to print any PNL report (holdings/transactions/total)
 """
+@instrumented(rows_argument=0)
 def generate_report(pnl):
-    print('------------------------------------------------')
-    str_fmt = "{:<30} {:<35}"
-    print(str_fmt.format('Security','PNL'))
-    print('------------------------------------------------')
-    for security, gain_loss in pnl.items():
-        print(str_fmt.format(security, round(gain_loss, ROUNDING_DECIMAL)))
-    print('------------------------------------------------')
+    write_reports(pnl, {'console': sys.stdout})
+
+"""
+Name: file_version
+Returns: version (tuple) - the modification time (ns) and size of the file, this changes whenever the file is rewritten
+Parameters:
+ 'filename' (string) - the file to check
+"""
+def file_version(filename):
+    file_stat = os.stat(filename)
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+"""
+Name: ReportContext
+Loads each input file at most once and remembers every portfolio and pnl map calculated from them,
+so any number of client reports can share the same work.
+Every cached value is reloaded or recalculated when the modification time or size of one of the files changes,
+so a long running process picks up a new end of day file. The files are only checked when a call starts,
+so every load a calculation depends on uses the same master even if a file changes while it runs.
+The files are loaded into a SecurityMaster of the context's own, which is replaced with the cache,
+so names that are no longer in the files do not stay in memory.
+
+Parameters:
+ 'current_holdings_filename' (string) - the current eod holdings file, defaults to the client registry's default
+ 'previous_holdings_filename' (string) - the previous eod holdings file, defaults to the client registry's default
+ 'transactions_filename' (string) - the transactions file, defaults to the client registry's default
+ 'use_snapshots' (bool) - load the holdings files through their binary snapshots (see load_holdings_snapshot)
+ 'quarantine_filename' (string) - where rejected transactions are written (see validate_transactions), None to only count them
+ 'fixed_point' (bool) - load every price as int64 ticks (see prices_to_ticks), the *_pnl_by_id maps are then in ticks
+    and the pnl maps by security name hold exact Decimal amounts
+
+Attributes:
+ master (SecurityMaster) - the master the files are loaded into, a new one for every change of the files
+ transactions_summary (dict) - the summary of the last load of the transactions, see validate_transactions
+
+Note - transactions are validated when they are loaded
+"""
+class ReportContext:
+    def __init__(self, current_holdings_filename=None, previous_holdings_filename=None, transactions_filename=None,
+                 use_snapshots=False, quarantine_filename=None, fixed_point=False):
+        if use_snapshots and fixed_point:
+            raise ValueError("Snapshots store float prices, use_snapshots and fixed_point cannot be used together")
+        self.current_holdings_filename = resolve_filename('current_holdings_filename', current_holdings_filename)
+        self.previous_holdings_filename = resolve_filename('previous_holdings_filename', previous_holdings_filename)
+        self.transactions_filename = resolve_filename('transactions_filename', transactions_filename)
+        self.use_snapshots = use_snapshots
+        self.quarantine_filename = quarantine_filename
+        self.fixed_point = fixed_point
+        self.master = SecurityMaster()
+        self.transactions_summary = None
+        # The versions of the files the cache was filled from, and a map of cached value name to its value
+        self._versions = None
+        self._cache = {}
+        # The number of cached values being calculated, the files are only checked when a calculation starts
+        self._depth = 0
+
+    def _cached(self, name, calculate):
+        # Values a calculation depends on keep the versions and master it started with, so a file that lands
+        # part way through never mixes two masters. The next call sees the new versions and starts over.
+        if self._depth == 0:
+            versions = self.file_versions()
+            if versions != self._versions:
+                # Every value is keyed by ids of the old master, so they are all dropped with it
+                self._cache.clear()
+                self.master = SecurityMaster()
+                self._versions = versions
+        if name not in self._cache:
+            self._depth += 1
+            try:
+                self._cache[name] = calculate()
+            finally:
+                self._depth -= 1
+        return self._cache[name]
+
+    def _load_holdings(self, filename):
+        if self.use_snapshots:
+            return load_holdings_snapshot(filename, master=self.master)
+        return load_holdings_columns(filename, fixed_point=self.fixed_point, master=self.master)
+
+    def current_holdings(self):
+        return self._cached('current_holdings', lambda: self._load_holdings(self.current_holdings_filename))
+
+    def previous_holdings(self):
+        return self._cached('previous_holdings', lambda: self._load_holdings(self.previous_holdings_filename))
+
+    def transactions(self):
+        return self._cached('transactions', self._load_transactions)
+
+    def _load_transactions(self):
+        ledger, self.transactions_summary = validate_transactions(self.transactions_filename, self.quarantine_filename,
+                                                                  fixed_point=self.fixed_point, master=self.master)
+        if self.transactions_summary['accepted'] < self.transactions_summary['rows']:
+            print(format_validation_summary(self.transactions_summary))
+        return ledger
+
+    def holdings_pnl_by_id(self):
+        return self._cached('holdings_pnl_by_id', lambda: calculate_holdings_pnl_by_id(self.current_holdings(), self.previous_holdings()))
+
+    def transactions_pnl_by_id(self):
+        return self._cached('transactions_pnl_by_id', lambda: calculate_transactions_pnl_by_id(self.transactions(), self.current_holdings()))
+
+    def total_pnl_by_id(self):
+        return self._cached('total_pnl_by_id', lambda: calculate_total_pnl(self.holdings_pnl_by_id(), self.transactions_pnl_by_id()))
+
+    # The pnl maps by security name, only resolved from the ids when a report asks for them
+    def pnl(self, report):
+        if report not in REPORT_TYPES:
+            raise ValueError(f"Report type: {report} is not valid, it MUST be holdings, transactions or total")
+        return getattr(self, f'{report}_pnl')()
+
+    def file_versions(self):
+        return tuple(file_version(filename) for filename in
+                     (self.current_holdings_filename, self.previous_holdings_filename, self.transactions_filename))
+
+    def _amounts(self, pnl):
+        return pnl_from_ticks(pnl) if self.fixed_point else pnl
+
+    def holdings_pnl(self):
+        return self._cached('holdings_pnl', lambda: self._amounts(pnl_by_name(self.holdings_pnl_by_id(), self.master)))
+
+    def transactions_pnl(self):
+        return self._cached('transactions_pnl', lambda: self._amounts(pnl_by_name(self.transactions_pnl_by_id(), self.master)))
+
+    def total_pnl(self):
+        return self._cached('total_pnl', lambda: self._amounts(pnl_by_name(self.total_pnl_by_id(), self.master)))
+
+"""
+Name: DeltaReport
+Keeps the holdings, transactions and total pnl of a set of input files up to date, recalculating only the securities
+whose rows changed when a corrected file lands. A file is only read again when its modification time or size changes.
+Its rows are grouped by SecurityName and each security's rows are hashed, so a rerun compares one hash per security
+with the previous load and the pnl work is proportional to the number of securities that changed.
+The pnl values match calculate_holdings_pnl, calculate_transactions_pnl and calculate_total_pnl, with transactions
+validated the same way as validate_transactions (rejected rows are skipped).
+
+Attributes:
+ holdings_pnl (dict) - A map of security name to its holding pnl value
+ transactions_pnl (dict) - A map of security name to its transaction pnl value
+ total_pnl (dict) - A map of security name to its total pnl value
+Parameters:
+ 'current_holdings_filename' (string) - the current eod holdings file, defaults to the client registry's default
+ 'previous_holdings_filename' (string) - the previous eod holdings file, defaults to the client registry's default
+ 'transactions_filename' (string) - the transactions file, defaults to the client registry's default
+
+Note - the maps are empty until the first refresh. Securities that first appear on a rerun are added at the end of the maps.
+"""
+class DeltaReport:
+    def __init__(self, current_holdings_filename=None, previous_holdings_filename=None, transactions_filename=None):
+        self.filenames = {'current_holdings': resolve_filename('current_holdings_filename', current_holdings_filename),
+                          'previous_holdings': resolve_filename('previous_holdings_filename', previous_holdings_filename),
+                          'transactions': resolve_filename('transactions_filename', transactions_filename)}
+        self.versions = {}
+        # A map of input name to a map of security name to the hash of its rows in that file
+        self.row_hashes = {name: {} for name in self.filenames}
+        # A map of security name to (quantity, price) of its last row in each holdings file
+        self.positions = {'current_holdings': {}, 'previous_holdings': {}}
+        # A map of security name to (sign * quantity, transaction price) of each of its valid fills, in file order
+        self.fills = {}
+        self.holdings_pnl = {}
+        self.transactions_pnl = {}
+        self.total_pnl = {}
+
+    def _read_rows(self, filename, columns):
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return
+            positions = [header.index(column) for column in columns]
+            pick_columns = operator.itemgetter(*positions)
+            row_width = max(positions) + 1
+            for row in reader:
+                if row:
+                    yield pick_columns(row if len(row) >= row_width else row + [''] * (row_width - len(row)))
+
+    # Returns (changed, version, hashes): a map of security name to its new rows (None if the security left the file)
+    # for every security that changed, and the file version and row hashes to save once the changes are applied
+    def _changed_rows(self, name):
+        filename = self.filenames[name]
+        version = file_version(filename)
+        if self.versions.get(name) == version:
+            return {}, None, None
+        rows_by_security = {}
+        if name == 'transactions':
+            for row in self._read_rows(filename, TRANSACTIONS_COLUMNS):
+                rows = rows_by_security.get(row[0])
+                if rows is None:
+                    rows_by_security[row[0]] = [row]
+                else:
+                    rows.append(row)
+            hashes = {security: hash(tuple(rows)) for security, rows in rows_by_security.items()}
+        else:
+            # Only the last row of a security counts, like HoldingsColumns.index
+            rows_by_security = {row[0]: row for row in self._read_rows(filename, HOLDINGS_COLUMNS)}
+            hashes = {security: hash(row) for security, row in rows_by_security.items()}
+
+        previous_hashes = self.row_hashes[name]
+        changed = {security: rows_by_security[security] for security, row_hash in hashes.items()
+                   if previous_hashes.get(security) != row_hash}
+        changed.update(dict.fromkeys(previous_hashes.keys() - hashes.keys()))
+        return changed, version, hashes
+
+    # Returns a map of security name to its new (quantity, price), None if the security left the file
+    def _parse_holdings(self, changed):
+        return {security: None if row is None else (int(row[2]), float(row[3])) for security, row in changed.items()}
+
+    # Returns a map of security name to its valid fills, an empty list if it has none left
+    def _parse_transactions(self, changed):
+        fills_by_security = {}
+        for security, rows in changed.items():
+            fills = fills_by_security[security] = []
+            for _, _, quantity_text, price_text, action_text in rows or ():
+                sign = action_sign(action_text)
+                quantity, price = _parse_quantity(quantity_text), _parse_price(price_text)
+                if sign is not None and quantity is not None and price is not None:
+                    fills.append((sign * quantity, price))
+        return fills_by_security
+
+    def _apply_holdings(self, name, parsed_positions):
+        positions = self.positions[name]
+        for security, position in parsed_positions.items():
+            if position is None:
+                del positions[security]
+            else:
+                positions[security] = position
+
+    def _apply_transactions(self, fills_by_security):
+        for security, fills in fills_by_security.items():
+            if fills:
+                self.fills[security] = fills
+            else:
+                self.fills.pop(security, None)
+
+    def _recalculate(self, security):
+        current_position = self.positions['current_holdings'].get(security)
+        previous_position = self.positions['previous_holdings'].get(security)
+        fills = self.fills.get(security)
+        holdings_pnl = transactions_pnl = None
+        if current_position is not None:
+            current_eod_price = current_position[1]
+            if previous_position is not None:
+                holdings_pnl = previous_position[0] * (current_eod_price - previous_position[1])
+            if fills:
+                transactions_pnl = sum([signed_quantity * (current_eod_price - price) for signed_quantity, price in fills])
+        for pnl_map, pnl in ((self.holdings_pnl, holdings_pnl), (self.transactions_pnl, transactions_pnl)):
+            if pnl is None:
+                pnl_map.pop(security, None)
+            else:
+                pnl_map[security] = pnl
+        if holdings_pnl is None and transactions_pnl is None:
+            self.total_pnl.pop(security, None)
+        else:
+            self.total_pnl[security] = holdings_pnl if transactions_pnl is None else (holdings_pnl or 0) + transactions_pnl
+
+    """
+    Name: refresh
+    Rereads the input files that changed since the last refresh and recalculates the pnl of the securities whose rows changed
+
+    Returns: changes (dict) -
+        'changed' (dict) - A map of input name ('current_holdings', 'previous_holdings', 'transactions') to the
+            securities whose rows were added, changed or removed in that file
+        'moved' (dict) - A map of security name to (previous total pnl, new total pnl) for every security whose total
+            pnl changed, None when the security had or has no total pnl
+
+    Note - every changed row is parsed before the report is updated, so a malformed row raises a ValueError and leaves
+    the report as it was, and the same rows are read again on the next refresh
+    """
+    def refresh(self):
+        with PROFILER.stage('refresh') as record:
+            reads = {name: self._changed_rows(name) for name in self.filenames}
+            changed = {name: changed_rows for name, (changed_rows, _, _) in reads.items()}
+            positions = {name: self._parse_holdings(changed[name]) for name in self.positions}
+            fills_by_security = self._parse_transactions(changed['transactions'])
+
+            for name, parsed_positions in positions.items():
+                self._apply_holdings(name, parsed_positions)
+            self._apply_transactions(fills_by_security)
+            # Only remembered once the changes are applied, so a failed refresh does not hide them from the next one
+            for name, (_, version, hashes) in reads.items():
+                if version is not None:
+                    self.versions[name] = version
+                    self.row_hashes[name] = hashes
+
+            moved = {}
+            recalculated = {security for changed_rows in changed.values() for security in changed_rows}
+            for security in recalculated:
+                previous_total_pnl = self.total_pnl.get(security)
+                self._recalculate(security)
+                total_pnl = self.total_pnl.get(security)
+                if total_pnl != previous_total_pnl:
+                    moved[security] = (previous_total_pnl, total_pnl)
+            record['rows'] = len(recalculated)
+        return {'changed': {name: list(changed_rows) for name, changed_rows in changed.items()}, 'moved': moved}
+
+"""
+Name: format_change_report
+Returns: report (string) - how many securities changed in each input file, then the old and new total pnl
+    of every security whose total pnl moved, largest move first
+Parameters:
+ 'changes' (dict) - the changes returned by DeltaReport.refresh
+"""
+def format_change_report(changes):
+    lines = ['Changed securities - ' + ', '.join(f"{name.replace('_', ' ')}: {len(securities)}"
+                                                 for name, securities in changes['changed'].items())]
+    str_fmt = "{:<30} {:>15} {:>15} {:>15}"
+    lines.append(str_fmt.format('Security', 'Previous PNL', 'New PNL', 'Change'))
+    moves = [(security, previous_total_pnl, total_pnl, (total_pnl or 0) - (previous_total_pnl or 0))
+             for security, (previous_total_pnl, total_pnl) in changes['moved'].items()]
+    for security, *pnls in sorted(moves, key=lambda move: -abs(move[3])):
+        lines.append(str_fmt.format(security, *('-' if pnl is None else round(pnl, ROUNDING_DECIMAL) for pnl in pnls)))
+    return '\n'.join(lines)
+
+# A map of (current, previous, transactions) filenames to the context shared by every run_report call on those files
+_report_contexts = {}
+
+"""
+Name: get_report_context
+Returns: context (ReportContext) - the context shared by every run_report call on the same files that does not pass its own
+Parameters:
+ 'current_holdings_filename', 'previous_holdings_filename', 'transactions_filename' (string) - the input files of the context
+"""
+def get_report_context(current_holdings_filename=None, previous_holdings_filename=None, transactions_filename=None):
+    filenames = tuple(map(resolve_filename, CLIENT_FILE_KEYS,
+                          (current_holdings_filename, previous_holdings_filename, transactions_filename)))
+    if filenames not in _report_contexts:
+        _report_contexts[filenames] = ReportContext(*filenames)
+    return _report_contexts[filenames]
+
+"""
+Name: load_client_registry
+Reads the client registry, a json file that maps every client to its input files and the reports it wants.
+File names are relative to the registry's data_dir, which is relative to the registry file itself.
+A file or report list that a client does not set is taken from the registry's defaults.
+    Ex. {"data_dir": "../data_files",
+         "defaults": {"current_holdings_filename": "holdings_current_eod_positions.csv", ...},
+         "clients": {"Client_A": {"reports": ["holdings"]}, ...}}
+
+Returns: registry (dict) - A map of client name to its absolute filenames and reports (tuple)
+    Ex. registry = {'Client_A': {'current_holdings_filename': '/.../holdings_current_eod_positions.csv', ...,
+                                 'reports': ('holdings',)}}
+Parameters:
+ 'filename' (string) - the registry file
+"""
+def load_client_registry(filename=CLIENT_REGISTRY_FILENAME):
+    with open(filename) as f:
+        config = json.load(f)
+    data_dir = _registry_data_dir(filename, config)
+    defaults = config.get('defaults', {})
+    registry = {}
+    for client_name, client in config['clients'].items():
+        entry = {}
+        for key in CLIENT_FILE_KEYS + ('reports',):
+            if key not in client and key not in defaults:
+                raise ValueError(f"Client: {client_name} in {filename} has no {key} and there is no default")
+        for key in CLIENT_FILE_KEYS:
+            entry[key] = os.path.normpath(os.path.join(data_dir, client.get(key, defaults.get(key))))
+        entry['reports'] = tuple(client.get('reports', defaults.get('reports')))
+        for report in entry['reports']:
+            if report not in REPORT_TYPES:
+                raise ValueError(f"Report type: {report} of client: {client_name} is not valid, it MUST be holdings, transactions or total")
+        registry[client_name] = entry
+    return registry
+
+def _registry_data_dir(filename, config):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), config.get('data_dir', '.'))
+
+# (version of the registry file, registry) of the last get_client_registry call
+_client_registry = None
+
+"""
+Name: get_client_registry
+Returns: registry (dict) - the registry in CLIENT_REGISTRY_FILENAME, read again only when the file changes
+"""
+def get_client_registry():
+    global _client_registry
+    version = file_version(CLIENT_REGISTRY_FILENAME)
+    if _client_registry is None or _client_registry[0] != version:
+        _client_registry = (version, load_client_registry(CLIENT_REGISTRY_FILENAME))
+    return _client_registry[1]
+
+# (version of the registry file, map of file key to absolute filename) of the registry's defaults
+_registry_defaults = None
+
+"""
+Name: resolve_filename
+Returns: filename (string) - the given filename, or the registry's default file for the key when it is None
+Parameters:
+ 'key' (string) - the file key in the registry's defaults (ex. 'current_holdings_filename')
+ 'filename' (string) - the filename to use, None for the registry's default
+"""
+def resolve_filename(key, filename=None):
+    global _registry_defaults
+    if filename is not None:
+        return filename
+    version = file_version(CLIENT_REGISTRY_FILENAME)
+    if _registry_defaults is None or _registry_defaults[0] != version:
+        with open(CLIENT_REGISTRY_FILENAME) as f:
+            config = json.load(f)
+        data_dir = _registry_data_dir(CLIENT_REGISTRY_FILENAME, config)
+        _registry_defaults = (version, {default_key: os.path.normpath(os.path.join(data_dir, default_filename))
+                                        for default_key, default_filename in config.get('defaults', {}).items()
+                                        if default_key.endswith('_filename')})
+    if key not in _registry_defaults[1]:
+        raise ValueError(f"There is no default {key} in the client registry {CLIENT_REGISTRY_FILENAME}, the filename MUST be given")
+    return _registry_defaults[1][key]
+
+# The inputs of the reports calculated straight from files, as the kind of file loaded for each filename
+REPORT_INPUTS = {'holdings': ('holdings', 'holdings'), 'transactions': ('transactions', 'holdings')}
+
+def _plan_computation(report, filenames, loads, computations):
+    computation = (report, filenames)
+    if computation not in computations:
+        if report == 'total':
+            current_holdings_filename, previous_holdings_filename, transactions_filename = filenames
+            dependencies = (_plan_computation('holdings', (current_holdings_filename, previous_holdings_filename), loads, computations),
+                            _plan_computation('transactions', (transactions_filename, current_holdings_filename), loads, computations))
+        else:
+            dependencies = ()
+            for kind, filename in zip(REPORT_INPUTS[report], filenames):
+                loads[(kind, filename)] = None
+        # Dependencies are added first, so running the computations in order never needs a result that is not there yet
+        computations[computation] = dependencies
+    return computation
+
+"""
+Name: plan_client_reports
+Works out the smallest set of file loads and pnl calculations that covers every report of every client.
+A file used by many clients is loaded once, and a report wanted by many clients on the same files
+(or needed for their total report) is calculated once.
+
+Returns: plan (dict) -
+    'loads' (list) - (kind, filename) of every file to load, kind is 'holdings' or 'transactions'
+    'computations' (dict) - A map of (report, filenames) to the computations it is calculated from, in the order to run them
+    'clients' (dict) - A map of client name to its (report, computation) pairs
+Parameters:
+ 'registry' (dict) - the clients, see load_client_registry
+ 'client_names' (list) - the clients to plan for, defaults to every client in the registry
+"""
+def plan_client_reports(registry, client_names=None):
+    loads, computations, clients = {}, {}, {}
+    for client_name in (registry if client_names is None else client_names):
+        if client_name not in registry:
+            raise ValueError(f"Client: {client_name} is not in the client registry")
+        client = registry[client_name]
+        clients[client_name] = [(report, _plan_computation(report, tuple(client[key] for key in REPORT_FILE_KEYS[report]),
+                                                           loads, computations))
+                                for report in client['reports']]
+    return {'loads': list(loads), 'computations': computations, 'clients': clients}
+
+def _load_validated_transactions(filename, master):
+    ledger, summary = validate_transactions(filename, master=master)
+    if summary['accepted'] < summary['rows']:
+        print(format_validation_summary(summary))
+    return ledger
+
+"""
+Name: execute_report_plan
+Runs every load and calculation of a plan exactly once
+
+Returns: reports (dict) - A map of client name to a map of report type to its pnl map (security name to pnl)
+    Clients that want the same report on the same files share one pnl map
+Parameters:
+ 'plan' (dict) - the plan from plan_client_reports
+ 'use_snapshots' (bool) - load the holdings files through their binary snapshots (see load_holdings_snapshot)
+"""
+@instrumented()
+def execute_report_plan(plan, use_snapshots=False):
+    loaders = {'holdings': load_holdings_snapshot if use_snapshots else load_holdings_columns,
+               'transactions': _load_validated_transactions}
+    # Every file of the plan is loaded into a master of its own, so running plans does not grow SECURITY_MASTER
+    master = SecurityMaster()
+    loaded = {(kind, filename): loaders[kind](filename, master=master) for kind, filename in plan['loads']}
+
+    pnl_by_id = {}
+    for computation, dependencies in plan['computations'].items():
+        report, filenames = computation
+        if report == 'total':
+            pnl_by_id[computation] = calculate_total_pnl(*(pnl_by_id[dependency] for dependency in dependencies))
+        else:
+            inputs = [loaded[load] for load in zip(REPORT_INPUTS[report], filenames)]
+            if report == 'holdings':
+                pnl_by_id[computation] = calculate_holdings_pnl_by_id(*inputs)
+            else:
+                pnl_by_id[computation] = calculate_transactions_pnl_by_id(*inputs)
+
+    # Only the pnl maps a client asked for are resolved to security names
+    pnl = {}
+    reports = {}
+    for client_name, client_reports in plan['clients'].items():
+        reports[client_name] = {}
+        for report, computation in client_reports:
+            if computation not in pnl:
+                pnl[computation] = pnl_by_name(pnl_by_id[computation], master)
+            reports[client_name][report] = pnl[computation]
+    return reports
+
+def _print_client_report(client_name, report, pnl):
+    print(f"Generating {report.capitalize()} Profit & Loss Report for {client_name.replace('_', ' ')}\n")
+    generate_report(pnl)
+
+"""
+Name: run_registered_reports
+This function plans and prints the reports of every client in the registry (or the clients given),
+loading each file and calculating each pnl map only once across all of them
+
+Returns: nothing
+Parameters:
+ client_names (list) - the clients to report on, defaults to every client in the registry
+ registry (dict) - the clients, defaults to the registry in CLIENT_REGISTRY_FILENAME
+"""
+def run_registered_reports(client_names=None, registry=None):
+    plan = plan_client_reports(registry or get_client_registry(), client_names)
+    for client_name, reports in execute_report_plan(plan).items():
+        print('===========================================================')
+        print(f'{client_name} PNL Report')
+        for report, pnl in reports.items():
+            _print_client_report(client_name, report, pnl)
+        print(f'\nFinished generating PNL Report for {client_name}\n')
 
 """
 Name: run_report
@@ -147,45 +2109,132 @@ This function takes in a client_name and runs the necessary calculations and pri
 
 Returns: nothing
 Parameters:
- client_name (string) - Name of the client for which we want to create the report
+ client_name (string) - Name of the client for which we want to create the report, MUST be in the client registry
+ context (ReportContext) - where the input files and pnl maps are taken from,
+    defaults to the context shared by every client on the same files as this client
 
-Note
+Note - the files are only loaded once for all clients on the same files, each client picks the pnl maps it needs from the context
 """
-def run_report(client_name):
-    if client_name == 'Client_A':
-        # Client A only wants the Holdings PNL Report
-        print("Generating Holdings Profit & Loss Report for Client A\n") # debug string - can be removed
-        current_holdings_portfolio = load_holdings_portfolio(CURRENT_HOLDINGS_FILENAME)
-        previous_holdings_portfolio = load_holdings_portfolio(PREVIOUS_HOLDINGS_FILENAME)
+@instrumented()
+def run_report(client_name, context=None):
+    registry = get_client_registry()
+    if client_name not in registry:
+        raise ValueError(f"Client: {client_name} is not in the client registry {CLIENT_REGISTRY_FILENAME}")
+    client = registry[client_name]
+    if context is None:
+        context = get_report_context(*(client[key] for key in CLIENT_FILE_KEYS))
 
-        holdings_pnl = calculate_holdings_pnl(current_holdings_portfolio, previous_holdings_portfolio)
-        generate_report(holdings_pnl)
+    for report in client['reports']:
+        _print_client_report(client_name, report, context.pnl(report))
 
-    elif client_name == 'Client_B':
-        # Client B only wants the Transactions PNL Report
-        print("Generating Transactions Profit & Loss Report for Client B\n")
-        current_holdings_portfolio = load_holdings_portfolio(CURRENT_HOLDINGS_FILENAME)
-        all_transactions = load_transactions_portfolio(TRANSACTIONS_FILENAME)
+"""
+Name: load_market_prices
+Returns: market_prices (dict) - A map of security name to its eod price, read from a holdings file
+    Ex. market_prices = {'Imaginary Company': 100.0}
+Parameters:
+ 'filename' (string) - the holdings file with the eod prices
+"""
+def load_market_prices(filename):
+    holdings = load_holdings_columns(filename, master=SecurityMaster())
+    prices = holdings.prices
+    return {security: prices[row] for security, row in holdings.index.items()}
 
-        transactions_pnl = calculate_transactions_pnl(all_transactions, current_holdings_portfolio)
-        generate_report(transactions_pnl)
+"""
+Name: reprice_holdings
+Returns: holdings (HoldingsColumns) - a copy of the holdings where every security found in market_prices uses that price
+Parameters:
+ 'holdings' (HoldingsColumns) - the holdings to reprice
+ 'market_prices' (dict) - A map of security name to its eod price
+"""
+def reprice_holdings(holdings, market_prices):
+    repriced_holdings = HoldingsColumns(master=holdings.master)
+    repriced_holdings.security_ids = holdings.security_ids
+    repriced_holdings.ticker_ids = holdings.ticker_ids
+    repriced_holdings.quantities = holdings.quantities
+    repriced_holdings.prices = array('d', [market_prices.get(security, price)
+                                           for security, price in zip(holdings.securities, holdings.prices)])
+    repriced_holdings.id_index = holdings.id_index
+    return repriced_holdings
 
-    elif client_name == "Client_C":
-        # Client C only wants the Total PNL Report
-        print("Generating Total Profit & Loss Report for Client C\n")
-        current_holdings_portfolio = load_holdings_portfolio(CURRENT_HOLDINGS_FILENAME)
-        previous_holdings_portfolio = load_holdings_portfolio(PREVIOUS_HOLDINGS_FILENAME)
-        all_transactions = load_transactions_portfolio(TRANSACTIONS_FILENAME)
+# The market price table of a worker process, set once per process by _init_report_worker instead of being sent with every client.
+# Only process workers set it: threads share this module with the caller, so they are given the table directly.
+_worker_market_prices = None
 
-        holdings_pnl = calculate_holdings_pnl(current_holdings_portfolio, previous_holdings_portfolio)
-        transactions_pnl = calculate_transactions_pnl(all_transactions, current_holdings_portfolio)
-        total_pnl = calculate_total_pnl(holdings_pnl, transactions_pnl)
-        generate_report(total_pnl)
+def _init_report_worker(market_prices):
+    global _worker_market_prices
+    _worker_market_prices = market_prices
 
+"""
+Name: render_client_report
+This function calculates the PNL report a client asked for from the client's own files and formats it
+
+Returns: (client_name, report) (tuple) - the client name and the formatted report (string)
+Parameters:
+ client (dict) - the client and its files. Any file that is not given uses the client registry's default.
+    Ex. client = {'client_name': 'Client_A', 'report': 'holdings',
+                  'current_holdings_filename': '...', 'previous_holdings_filename': '...', 'transactions_filename': '...'}
+    'report' is one of 'holdings', 'transactions' or 'total'
+ market_prices (dict) - A map of security name to the eod price used for the client's current holdings,
+    defaults to the table set up for this worker process by run_client_reports
+"""
+def render_client_report(client, market_prices=None):
+    if market_prices is None:
+        market_prices = _worker_market_prices
+    report = client['report']
+    # The client's files are loaded into a master of their own, so a worker does not keep the names of every client it rendered
+    master = SecurityMaster()
+    current_holdings = load_holdings_columns(resolve_filename('current_holdings_filename', client.get('current_holdings_filename')),
+                                             master=master)
+    if market_prices is not None:
+        current_holdings = reprice_holdings(current_holdings, market_prices)
+
+    if report in ('holdings', 'total'):
+        previous_holdings = load_holdings_columns(resolve_filename('previous_holdings_filename', client.get('previous_holdings_filename')),
+                                                  master=master)
+        holdings_pnl = calculate_holdings_pnl(current_holdings, previous_holdings)
+    if report in ('transactions', 'total'):
+        all_transactions = load_transactions_ledger(resolve_filename('transactions_filename', client.get('transactions_filename')),
+                                                    master=master)
+        transactions_pnl = calculate_transactions_pnl(all_transactions, current_holdings)
+
+    if report == 'holdings':
+        pnl = holdings_pnl
+    elif report == 'transactions':
+        pnl = transactions_pnl
+    elif report == 'total':
+        pnl = calculate_total_pnl(holdings_pnl, transactions_pnl)
+    else:
+        raise ValueError(f"Report type: {report} is not valid, it MUST be holdings, transactions or total")
+    return client['client_name'], format_report(pnl)
+
+"""
+Name: run_client_reports
+This function renders the reports of many clients in parallel.
+Each client is independent, so the clients are spread over a pool of worker processes
+(or threads, when the work is mostly waiting on file reads).
+The market price table is sent to each worker process once when the process starts, not with every client.
+Threads are given the table directly, so no module state outlives the call.
+
+Returns: reports (list) - (client_name, report) for every client, in the same order as clients
+Parameters:
+ clients (list) - the clients to report on, see render_client_report for the format of each client
+ market_prices_filename (string) - the holdings file the market eod prices are read from, None to use each client's own prices
+ max_workers (int) - the size of the pool, defaults to the number of CPUs
+ use_threads (bool) - use a thread pool instead of a process pool
+"""
+def run_client_reports(clients, market_prices_filename, max_workers=None, use_threads=False):
+    market_prices = load_market_prices(market_prices_filename) if market_prices_filename else None
+    if use_threads:
+        executor = ThreadPoolExecutor(max_workers)
+        render = partial(render_client_report, market_prices=market_prices)
+        chunksize = 1
     else:
-        # We should not reach this case in the provided code
-        print("Invalid client provided! Exiting Program.")
-        exit(1)
+        executor = ProcessPoolExecutor(max_workers, initializer=_init_report_worker, initargs=(market_prices,))
+        render = render_client_report
+        # Send the clients in batches so thousands of small reports do not pay one round trip each
+        chunksize = max(1, len(clients) // (4 * (max_workers or os.cpu_count() or 1)))
+    with executor:
+        return list(executor.map(render, clients, chunksize=chunksize))
 
 # DO NOT EDIT THE MAIN FUNCTION BELOW
 if __name__ == "__main__":
@@ -0,0 +1,262 @@
+import argparse
+import bisect
+import datetime
+import json
+import math
+import mmap
+import os
+from array import array
+from itertools import compress
+
+import module_2_solution
+
+"""
+Purpose:
+A store of end of day holdings files, one partition per date, so holdings PNL over any
+date range (month to date, year to date, ...) can be read without parsing the csv files again.
+
+Layout of the store directory:
+ index.json                     - the dates in the store and the files of each date's partition
+ securities.txt                 - every security name ever stored, one per line; the line number is the security's store id
+ YYYY-MM-DD/holdings.snapshot   - that day's holdings, in the binary snapshot format of module_2_solution.py
+ YYYY-MM-DD/security_ids.u32    - the store id (uint32) of each row of holdings.snapshot
+ YYYY-MM-DD/holdings_pnl.f64    - that day's holdings pnl (float64), one per row of holdings.snapshot,
+                                  NaN when the security was not held on the previous date in the store
+ YYYY-MM-DD/mtd_ids.u32         - the store id (uint32) of every security with holdings pnl this month up to that day
+ YYYY-MM-DD/mtd_pnl.f64         - the month to date holdings pnl (float64) of each security in mtd_ids.u32
+ YYYY-MM-DD/ytd_ids.u32         - the store ids of the year to date rollup, laid out like mtd_ids.u32
+ YYYY-MM-DD/ytd_pnl.f64         - the year to date holdings pnl, laid out like mtd_pnl.f64
+
+Days are appended in date order. Appending a day reads only that day's csv and the previous day's
+partition, and the rollups only hold the securities with pnl in their month / year, so it costs the size
+of one day (and its period's rollups) no matter how long the history is.
+Range queries only read the fixed width id and pnl columns, never the snapshots or their string tables,
+and month / year to date are a single read of the rollup of the last day in the range.
+
+Usage:
+ python pnl_history.py ingest history/ 2024-10-01 ../data_files/holdings_previous_eod_positions.csv
+ python pnl_history.py ingest history/ 2024-10-02 ../data_files/holdings_current_eod_positions.csv
+ python pnl_history.py query history/ --mtd 2024-10-02
+"""
+
+INDEX_FILENAME = 'index.json'
+SECURITIES_FILENAME = 'securities.txt'
+HOLDINGS_PARTITION_FILENAME = 'holdings.snapshot'
+SECURITY_IDS_PARTITION_FILENAME = 'security_ids.u32'
+PNL_PARTITION_FILENAME = 'holdings_pnl.f64'
+MTD_IDS_PARTITION_FILENAME = 'mtd_ids.u32'
+MTD_PNL_PARTITION_FILENAME = 'mtd_pnl.f64'
+YTD_IDS_PARTITION_FILENAME = 'ytd_ids.u32'
+YTD_PNL_PARTITION_FILENAME = 'ytd_pnl.f64'
+# The length of the date prefix ('YYYY-MM-' and 'YYYY-') two dates share when they are in the same month / year
+MONTH_PREFIX_LENGTH = 8
+YEAR_PREFIX_LENGTH = 5
+
+"""
+Name: PnlHistoryStore
+Parameters:
+ 'directory' (string) - the directory of the store, created if it does not exist
+"""
+class PnlHistoryStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        index_filename = os.path.join(directory, INDEX_FILENAME)
+        if os.path.exists(index_filename):
+            with open(index_filename) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'partitions': {}}
+        self.dates = sorted(self.index['partitions'])
+        # The store ids of the security names, so a query never decodes a partition's string table
+        securities_filename = os.path.join(directory, SECURITIES_FILENAME)
+        if os.path.exists(securities_filename):
+            with open(securities_filename, encoding='utf-8', newline='') as f:
+                self.securities = f.read().split('\n')[:-1]
+        else:
+            self.securities = []
+        self.security_ids = {security: security_id for security_id, security in enumerate(self.securities)}
+
+    def _write_index(self):
+        index_filename = os.path.join(self.directory, INDEX_FILENAME)
+        with open(index_filename + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(index_filename + '.tmp', index_filename)
+
+    def _partition_path(self, date, filename):
+        return os.path.join(self.directory, date, filename)
+
+    def _store_ids(self, securities):
+        new_securities = [security for security in dict.fromkeys(securities) if security not in self.security_ids]
+        if new_securities:
+            with open(os.path.join(self.directory, SECURITIES_FILENAME), 'a', encoding='utf-8', newline='') as f:
+                f.write(''.join(security + '\n' for security in new_securities))
+            for security in new_securities:
+                self.security_ids[security] = len(self.securities)
+                self.securities.append(security)
+        return array('I', map(self.security_ids.__getitem__, securities))
+
+    def _column(self, date, key, type_code):
+        filename = self._partition_path(date, self.index['partitions'][date][key])
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return array(type_code)
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(type_code)
+
+    # The (store ids, pnl) of a rollup, only the securities with pnl in the month / year are kept
+    def _next_rollup(self, previous_date, date, key, prefix_length, store_ids, daily_pnl):
+        rollup = {}
+        # Carry on from the previous day's rollup while it is in the same month / year
+        if previous_date is not None and previous_date[:prefix_length] == date[:prefix_length]:
+            rollup = dict(zip(self._column(previous_date, f'{key}_ids', 'I'), self._column(previous_date, f'{key}_pnl', 'd')))
+        for security_id, pnl in zip(store_ids, daily_pnl):
+            if not math.isnan(pnl):
+                rollup[security_id] = rollup.get(security_id, 0.0) + pnl
+        return array('I', rollup), array('d', rollup.values())
+
+    """
+    Name: ingest
+    Adds one end of day holdings file to the store as the partition of its date.
+    The date must be after every date already in the store, or equal to the last one to replace it.
+
+    Returns: rows (int) - the number of holdings rows stored
+    Parameters:
+     'date' (string or date) - the date of the holdings file (YYYY-MM-DD)
+     'holdings_filename' (string) - the end of day holdings csv file
+    """
+    def ingest(self, date, holdings_filename):
+        date = _as_date_string(date)
+        if self.dates and date < self.dates[-1]:
+            raise ValueError(f'Cannot add {date}: the store already has {self.dates[-1]}, days must be added in date order')
+        previous_position = bisect.bisect_left(self.dates, date)
+        previous_date = self.dates[previous_position - 1] if previous_position else None
+        # Both days are interned in a master of their own, so the store does not grow the shared SECURITY_MASTER
+        master = module_2_solution.SecurityMaster()
+        previous_holdings = self.holdings(previous_date, master) if previous_date else None
+
+        holdings = module_2_solution.load_holdings_columns(holdings_filename, master=master)
+        checksum = module_2_solution.csv_checksum(holdings_filename)
+        daily_pnl = array('d', [math.nan]) * len(holdings)
+        if previous_holdings is not None:
+            for security_id, pnl in module_2_solution.calculate_holdings_pnl_by_id(holdings, previous_holdings).items():
+                daily_pnl[holdings.id_index[security_id]] = pnl
+        store_ids = self._store_ids(holdings.securities)
+        mtd_ids, month_to_date = self._next_rollup(previous_date, date, 'mtd', MONTH_PREFIX_LENGTH, store_ids, daily_pnl)
+        ytd_ids, year_to_date = self._next_rollup(previous_date, date, 'ytd', YEAR_PREFIX_LENGTH, store_ids, daily_pnl)
+
+        os.makedirs(os.path.join(self.directory, date), exist_ok=True)
+        module_2_solution.write_holdings_snapshot(holdings, self._partition_path(date, HOLDINGS_PARTITION_FILENAME), checksum)
+        for filename, column in ((SECURITY_IDS_PARTITION_FILENAME, store_ids), (PNL_PARTITION_FILENAME, daily_pnl),
+                                 (MTD_IDS_PARTITION_FILENAME, mtd_ids), (MTD_PNL_PARTITION_FILENAME, month_to_date),
+                                 (YTD_IDS_PARTITION_FILENAME, ytd_ids), (YTD_PNL_PARTITION_FILENAME, year_to_date)):
+            with open(self._partition_path(date, filename), 'wb') as f:
+                f.write(column.tobytes())
+        self.index['partitions'][date] = {'holdings': HOLDINGS_PARTITION_FILENAME, 'security_ids': SECURITY_IDS_PARTITION_FILENAME,
+                                          'holdings_pnl': PNL_PARTITION_FILENAME,
+                                          'mtd_ids': MTD_IDS_PARTITION_FILENAME, 'mtd_pnl': MTD_PNL_PARTITION_FILENAME,
+                                          'ytd_ids': YTD_IDS_PARTITION_FILENAME, 'ytd_pnl': YTD_PNL_PARTITION_FILENAME,
+                                          'checksum': checksum.hex(),
+                                          'rows': len(holdings), 'source': os.path.abspath(holdings_filename)}
+        self._write_index()
+        if date not in self.dates:
+            self.dates.append(date)
+        return len(holdings)
+
+    """
+    Name: holdings
+    Returns: holdings (HoldingsColumns) - the holdings stored for the date, memory mapped from its partition
+    Parameters:
+     'date' (string or date) - a date in the store
+     'master' (SecurityMaster) - the master to intern the names in, defaults to SECURITY_MASTER
+    """
+    def holdings(self, date, master=None):
+        date = _as_date_string(date)
+        partition = self.index['partitions'][date]
+        holdings = module_2_solution.read_holdings_snapshot(self._partition_path(date, partition['holdings']),
+                                                            bytes.fromhex(partition['checksum']), master)
+        if holdings is None:
+            raise ValueError(f"The holdings snapshot of {date} is missing, stale or truncated, "
+                             f"ingest {partition['source']} for {date} again")
+        return holdings
+
+    """
+    Name: daily_pnl
+    Returns: holdings_pnl (dict) - A map of security name to its holdings pnl on the date, against the previous date in the store
+    Parameters:
+     'date' (string or date) - a date in the store
+    """
+    def daily_pnl(self, date):
+        return self.cumulative_pnl(date, date)
+
+    """
+    Name: cumulative_pnl
+    Adds up the daily holdings pnl of every date in the store from start_date to end_date (both included)
+
+    Returns: holdings_pnl (dict) - A map of security name to its cumulative holdings pnl over the range
+    Parameters:
+     'start_date' (string or date) - the first date of the range
+     'end_date' (string or date) - the last date of the range
+    """
+    def cumulative_pnl(self, start_date, end_date):
+        start_date, end_date = _as_date_string(start_date), _as_date_string(end_date)
+        dates = self.dates[bisect.bisect_left(self.dates, start_date):bisect.bisect_right(self.dates, end_date)]
+        # Added up by store id, the names are only looked up for the securities with pnl in the range
+        cumulative = array('d', [0.0]) * len(self.securities)
+        has_pnl = bytearray(len(self.securities))
+        for date in dates:
+            for security_id, pnl in zip(self._column(date, 'security_ids', 'I'), self._column(date, 'holdings_pnl', 'd')):
+                if not math.isnan(pnl):
+                    cumulative[security_id] += pnl
+                    has_pnl[security_id] = 1
+        return {self.securities[security_id]: cumulative[security_id]
+                for security_id in compress(range(len(self.securities)), has_pnl)}
+
+    def _rollup_pnl(self, date, key, prefix_length):
+        date = _as_date_string(date)
+        # The rollup of the last day in the store up to the date, if that day is in the same month / year
+        position = bisect.bisect_right(self.dates, date)
+        if not position or self.dates[position - 1][:prefix_length] != date[:prefix_length]:
+            return {}
+        rollup_date = self.dates[position - 1]
+        securities = self.securities
+        return {securities[security_id]: pnl
+                for security_id, pnl in zip(self._column(rollup_date, f'{key}_ids', 'I'), self._column(rollup_date, f'{key}_pnl', 'd'))}
+
+    def month_to_date(self, date):
+        return self._rollup_pnl(date, 'mtd', MONTH_PREFIX_LENGTH)
+
+    def year_to_date(self, date):
+        return self._rollup_pnl(date, 'ytd', YEAR_PREFIX_LENGTH)
+
+def _as_date_string(date):
+    # A datetime is a date too, but its isoformat has the time of day, which would be a partition of its own
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if isinstance(date, datetime.date):
+        return date.isoformat()
+    return datetime.date.fromisoformat(date).isoformat()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Multi-day holdings PNL history store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='add one end of day holdings file')
+    ingest_parser.add_argument('store')
+    ingest_parser.add_argument('date')
+    ingest_parser.add_argument('holdings_filename')
+    query_parser = subparsers.add_parser('query', help='print the cumulative holdings pnl over a date range')
+    query_parser.add_argument('store')
+    query_range = query_parser.add_mutually_exclusive_group(required=True)
+    query_range.add_argument('--range', nargs=2, metavar=('START_DATE', 'END_DATE'))
+    query_range.add_argument('--mtd', metavar='DATE')
+    query_range.add_argument('--ytd', metavar='DATE')
+    args = parser.parse_args()
+
+    store = PnlHistoryStore(args.store)
+    if args.command == 'ingest':
+        print(f'Stored {store.ingest(args.date, args.holdings_filename)} holdings for {args.date}')
+    elif args.range:
+        module_2_solution.generate_report(store.cumulative_pnl(*args.range))
+    elif args.mtd:
+        module_2_solution.generate_report(store.month_to_date(args.mtd))
+    else:
+        module_2_solution.generate_report(store.year_to_date(args.ytd))
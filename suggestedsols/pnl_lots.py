@@ -0,0 +1,237 @@
+import heapq
+import json
+import os
+from collections import deque
+
+import module_2_solution
+
+"""
+Purpose:
+Lot matching for the PNL reports of module_2_solution.py: every fill closes open lots in FIFO, LIFO or
+highest price first (HIFO) order, which splits the day's pnl into realized and unrealized pnl.
+The open lots are saved as a json checkpoint at the end of the day, so the next day resumes from them
+instead of replaying the whole history.
+"""
+
+LOT_METHODS = ('FIFO', 'LIFO', 'HIFO') # the open lot a fill closes first: oldest, newest or highest price
+
+"""
+Name: LotBook
+Matches fills against open lots to split pnl into realized (from closed lots) and unrealized (open lots marked to the eod price).
+Every security has its own queue of open lots, all on the same side (long lots have a positive quantity, short lots a negative one).
+A fill first closes lots on the other side in the order of the book's method, and whatever is left opens a new lot.
+FIFO and LIFO queues are deques and highest price first (HIFO) is a heap, so each fill costs O(1) (O(log lots) for HIFO)
+plus one step per lot it closes, and replaying any number of fills is O(fills) overall.
+
+Attributes:
+ method (string) - one of LOT_METHODS
+ fixed_point (bool) - whether the lot prices are int64 ticks
+ lots (dict) - A map of security name to its open lots, each lot is [sort key, sequence number, quantity, price]
+ realized_pnl (dict) - A map of security name to the pnl of the lots closed since the book was created
+Parameters:
+ 'method' (string) - FIFO, LIFO or HIFO
+ 'fixed_point' (bool) - whether the portfolios and ledgers given to the book have int64 tick prices
+
+Note - use write_checkpoint and LotBook.from_checkpoint to carry the open lots over to the next day.
+A ValueError is raised if a portfolio or ledger given to the book does not have the book's kind of prices.
+"""
+class LotBook:
+    def __init__(self, method='FIFO', fixed_point=False):
+        if method not in LOT_METHODS:
+            raise ValueError(f"Lot method: {method} is not valid, it MUST be FIFO, LIFO or HIFO")
+        self.method = method
+        self.fixed_point = fixed_point
+        self.lots = {}
+        self.realized_pnl = {}
+        self._sequence = 0
+
+    def _open_lot(self, security, quantity, price):
+        lots = self.lots.get(security)
+        if lots is None:
+            lots = self.lots[security] = [] if self.method == 'HIFO' else deque()
+        self._sequence += 1
+        # The heap is ordered by the negated price so the highest price is at the top, ties close in the order they opened
+        lot = [-price, self._sequence, quantity, price]
+        if self.method == 'HIFO':
+            heapq.heappush(lots, lot)
+        else:
+            lots.append(lot)
+
+    def _check_fixed_point(self, columns):
+        if module_2_solution.is_fixed_point(columns) != self.fixed_point:
+            units = 'fixed point' if self.fixed_point else 'float'
+            raise ValueError(f"The lot book has {units} prices, portfolios and ledgers given to it MUST have {units} prices too")
+
+    def _close_lot(self, lots):
+        if self.method == 'FIFO':
+            lots.popleft()
+        elif self.method == 'LIFO':
+            lots.pop()
+        else:
+            heapq.heappop(lots)
+
+    """
+    Name: open_holdings
+    Opens one lot per position of a holdings portfolio, with the holdings price as its cost.
+    Use it with the previous eod holdings to start a book before the day's fills are applied.
+
+    Returns: nothing
+    Parameters:
+     'holdings_portfolio' (HoldingsColumns or dict) - the positions to open
+    """
+    def open_holdings(self, holdings_portfolio):
+        holdings = module_2_solution.as_holdings_columns(holdings_portfolio)
+        self._check_fixed_point(holdings)
+        quantities, prices = holdings.quantities, holdings.prices
+        for security, row in holdings.index.items():
+            if quantities[row]:
+                self._open_lot(security, quantities[row], prices[row])
+
+    """
+    Name: apply_fill
+    Closes open lots on the other side of the fill and opens a lot with whatever quantity is left.
+    The action is not case sensitive, fills with an empty or unknown action are ignored.
+
+    Returns: applied (bool) - whether the fill was applied
+    Parameters:
+     'security' (string) - the security name
+     'quantity' (int) - the transaction quantity
+     'price' (float) - the transaction price
+     'action' (string) - BUY or SELL
+    """
+    def apply_fill(self, security, quantity, price, action):
+        sign = module_2_solution.action_sign(action)
+        if sign is None:
+            return False
+        remaining = sign * quantity
+        lots = self.lots.get(security)
+        first = -1 if self.method == 'LIFO' else 0
+        if remaining and lots and (lots[first][2] > 0) != (remaining > 0):
+            realized_pnl = 0
+            while remaining and lots:
+                lot = lots[first]
+                # The signed quantity of the lot that this fill closes
+                closed = lot[2] if abs(lot[2]) <= abs(remaining) else -remaining
+                realized_pnl += closed * (price - lot[3])
+                lot[2] -= closed
+                remaining += closed
+                if not lot[2]:
+                    self._close_lot(lots)
+            self.realized_pnl[security] = self.realized_pnl.get(security, 0) + realized_pnl
+            if not lots:
+                del self.lots[security]
+        if remaining:
+            self._open_lot(security, remaining, price)
+        return True
+
+    """
+    Name: replay
+    Applies every fill of a ledger in file order
+
+    Returns: applied (int) - the number of fills applied
+    Parameters:
+     'all_transactions' (TransactionLedger or dict) - the fills
+    """
+    @module_2_solution.instrumented(rows_argument=1)
+    def replay(self, all_transactions):
+        ledger = module_2_solution.as_transaction_ledger(all_transactions)
+        self._check_fixed_point(ledger)
+        apply_fill = self.apply_fill
+        return sum(map(apply_fill, ledger.securities, ledger.quantities, ledger.prices, ledger.actions))
+
+    """
+    Name: unrealized_pnl
+    Returns: unrealized_pnl (dict) - A map of security name to the pnl of its open lots marked to the eod price.
+        Like transactions pnl, only securities with a current eod price are included.
+    Parameters:
+     'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date, its prices are the eod prices
+    """
+    def unrealized_pnl(self, current_holdings_portfolio):
+        current_holdings = module_2_solution.as_holdings_columns(current_holdings_portfolio)
+        self._check_fixed_point(current_holdings)
+        current_index, current_prices = current_holdings.index, current_holdings.prices
+        unrealized_pnl = {}
+        for security, lots in self.lots.items():
+            if security in current_index:
+                current_eod_price = current_prices[current_index[security]]
+                unrealized_pnl[security] = sum([lot[2] * (current_eod_price - lot[3]) for lot in lots])
+        return unrealized_pnl
+
+    """
+    Name: write_checkpoint
+    Saves the method, kind of prices and open lots of the book as json.
+    The lots of each security are saved oldest first for FIFO and LIFO, and highest price first for HIFO,
+    so from_checkpoint reopens them in an order that closes them the same way as this book would.
+
+    Returns: nothing
+    Parameters:
+     'filename' (string) - the checkpoint file, replaced in one step
+    """
+    def write_checkpoint(self, filename):
+        lots = {security: [[lot[2], lot[3]] for lot in (sorted(security_lots) if self.method == 'HIFO' else security_lots)]
+                for security, security_lots in self.lots.items()}
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'method': self.method, 'fixed_point': self.fixed_point, 'lots': lots}, f)
+        os.replace(filename + '.tmp', filename)
+
+    """
+    Name: from_checkpoint
+    Returns: book (LotBook) - a book with the open lots of a checkpoint and no realized pnl yet
+    Parameters:
+     'filename' (string) - a file written by write_checkpoint
+     'method' (string) - the method the book must use, None to take the one in the checkpoint
+    """
+    @classmethod
+    def from_checkpoint(cls, filename, method=None):
+        with open(filename) as f:
+            checkpoint = json.load(f)
+        if method is not None and method != checkpoint['method']:
+            raise ValueError(f"The checkpoint {filename} holds {checkpoint['method']} lots, it cannot be resumed as {method}")
+        book = cls(checkpoint['method'], checkpoint.get('fixed_point', False))
+        for security, lots in checkpoint['lots'].items():
+            for quantity, price in lots:
+                book._open_lot(security, quantity, price)
+        return book
+
+"""
+Name: calculate_lot_pnl
+Splits the day's pnl into realized and unrealized pnl with a LotBook, next to the usual holdings and total pnl.
+The book starts from the open lots of resume_filename, or from the previous holdings at their previous eod price,
+and its open lots at the end of the day are saved to checkpoint_filename for the next day.
+When the book starts from the previous holdings, realized + unrealized pnl adds up to the total pnl (up to float rounding)
+for every security with a current eod price. This does not hold when resuming from resume_filename: the resumed lots keep
+their original cost rather than the previous eod price, so their pnl also covers the days before.
+
+Returns: lot_pnl (dict) - A map of 'holdings', 'total', 'realized' and 'unrealized' to a map of security name to that pnl
+Parameters:
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
+ 'all_transactions' (TransactionLedger or dict) - the day's fills
+ 'method' (string) - FIFO, LIFO or HIFO
+ 'resume_filename' (string) - a checkpoint of the previous day's open lots, None to open the previous holdings instead
+ 'checkpoint_filename' (string) - where the open lots are saved at the end of the day, None to not save them
+"""
+def calculate_lot_pnl(current_holdings_portfolio, previous_holdings_portfolio, all_transactions, method='FIFO',
+                      resume_filename=None, checkpoint_filename=None):
+    with module_2_solution.PROFILER.stage('calculate_lot_pnl') as record:
+        master = module_2_solution.shared_master(current_holdings_portfolio, previous_holdings_portfolio, all_transactions)
+        current_holdings = module_2_solution.as_holdings_columns(current_holdings_portfolio, master)
+        previous_holdings = module_2_solution.as_holdings_columns(previous_holdings_portfolio, master)
+        ledger = module_2_solution.as_transaction_ledger(all_transactions, master)
+        fixed_point = module_2_solution.check_fixed_point(current_holdings, previous_holdings, ledger)
+        if resume_filename is not None:
+            book = LotBook.from_checkpoint(resume_filename, method)
+            if book.fixed_point != fixed_point:
+                raise ValueError(f"The checkpoint {resume_filename} and the portfolios MUST all have fixed point prices or all float prices")
+        else:
+            book = LotBook(method, fixed_point)
+            book.open_holdings(previous_holdings)
+        book.replay(ledger)
+        if checkpoint_filename is not None:
+            book.write_checkpoint(checkpoint_filename)
+
+        holdings_pnl = module_2_solution.calculate_holdings_pnl(current_holdings, previous_holdings)
+        transactions_pnl = module_2_solution.calculate_transactions_pnl(ledger, current_holdings)
+        record['rows'] = len(ledger)
+    return {'holdings': holdings_pnl, 'total': module_2_solution.calculate_total_pnl(holdings_pnl, transactions_pnl),
+            'realized': book.realized_pnl, 'unrealized': book.unrealized_pnl(current_holdings)}
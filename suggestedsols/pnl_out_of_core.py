@@ -0,0 +1,146 @@
+import argparse
+import csv
+import heapq
+import operator
+import os
+import tempfile
+from contextlib import ExitStack
+
+import module_2_solution
+
+"""
+Purpose:
+Out of core PNL for books larger than memory. Each EOD file is sorted by SecurityName on disk
+(sorted runs spilled to temporary files, then a k-way merge of the runs) and the three sorted streams
+are merged, so memory use is bounded by the rows of one run, not by the size of the files.
+
+Usage:
+ python pnl_out_of_core.py pnl.csv
+ python pnl_out_of_core.py pnl.csv --current big_current.csv --previous big_previous.csv --transactions big_transactions.csv \
+     --spill-rows 100000 --temp-dir /scratch
+"""
+
+SPILL_ROWS = 1_000_000 # rows sorted in memory and spilled to disk as one run by the out of core sort
+MERGE_FAN_IN = 64 # the most runs merged at once, more runs are merged in several passes
+OUT_OF_CORE_COLUMNS = ('SecurityName', 'HoldingsPnl', 'TransactionsPnl', 'TotalPnl')
+
+def _write_run(rows, run_directory, run_number):
+    run_filename = os.path.join(run_directory, f'run_{run_number}.csv')
+    with open(run_filename, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return run_filename
+
+def _merge_runs(run_filenames):
+    with ExitStack() as stack:
+        readers = [csv.reader(stack.enter_context(open(run_filename, 'r', newline=''))) for run_filename in run_filenames]
+        # heapq.merge keeps rows with the same name in run order, and each run is in file order, so the sort is stable
+        yield from heapq.merge(*readers, key=operator.itemgetter(0))
+
+"""
+Name: iter_external_sort
+Sorts the rows of a csv file by SecurityName without holding the file in memory. Every spill_rows rows are sorted
+in memory and spilled to a run file, then the runs are merged (at most MERGE_FAN_IN at a time) into one sorted stream.
+The runs live in a temporary directory that is removed when the generator finishes or is closed.
+
+Returns: a generator of rows (list of strings, the given columns with SecurityName first) in SecurityName order,
+    rows of the same security in file order
+Parameters:
+ 'filename' (string) - the csv file to sort
+ 'columns' (tuple) - the names of the columns to keep, the first one MUST be SecurityName
+ 'spill_rows' (int) - the number of rows sorted in memory per run, this bounds the memory used
+ 'temp_dir' (string) - where the run files are written, None for the system temporary directory
+"""
+def iter_external_sort(filename, columns, spill_rows=SPILL_ROWS, temp_dir=None):
+    with tempfile.TemporaryDirectory(prefix='pnl_runs_', dir=temp_dir) as run_directory:
+        run_filenames = []
+        for chunk in module_2_solution.iter_csv_chunks(filename, columns, (None,) * len(columns), spill_rows):
+            rows = sorted(zip(*chunk), key=operator.itemgetter(0))
+            run_filenames.append(_write_run(rows, run_directory, len(run_filenames)))
+            # Free this run before the next one is read, so only one run is in memory
+            del rows
+        # Merge the runs in groups until one pass can merge them all without opening too many files
+        run_number = len(run_filenames)
+        while len(run_filenames) > MERGE_FAN_IN:
+            merged_filenames = []
+            for group in range(0, len(run_filenames), MERGE_FAN_IN):
+                merged_filenames.append(_write_run(_merge_runs(run_filenames[group:group + MERGE_FAN_IN]), run_directory, run_number))
+                run_number += 1
+                for run_filename in run_filenames[group:group + MERGE_FAN_IN]:
+                    os.remove(run_filename)
+            run_filenames = merged_filenames
+        yield from _merge_runs(run_filenames)
+
+"""
+Name: stream_pnl_out_of_core
+Calculates the holdings, transactions and total pnl of books larger than memory. Each file is sorted by SecurityName
+on disk (see iter_external_sort) and the three sorted streams are merged, so only one security is in memory at a time.
+The pnl values match calculate_holdings_pnl, calculate_transactions_pnl and calculate_total_pnl,
+with actions read the same way as validate_transactions (not case sensitive, empty or unknown actions are left out).
+
+Returns: a generator of (security, holdings pnl, transactions pnl, total pnl) tuples in SecurityName order,
+    None for a pnl the security does not have. Only securities with a total pnl are included.
+Parameters:
+ 'current_holdings_filename' (string) - the current eod holdings file
+ 'previous_holdings_filename' (string) - the previous eod holdings file
+ 'transactions_filename' (string) - the transactions file
+ 'spill_rows' (int) - the number of rows sorted in memory per run
+ 'temp_dir' (string) - where the sorted runs are spilled, None for the system temporary directory
+"""
+def stream_pnl_out_of_core(current_holdings_filename, previous_holdings_filename, transactions_filename,
+                           spill_rows=SPILL_ROWS, temp_dir=None):
+    holdings_columns = ('SecurityName', 'Quantity', 'Price')
+    sources = (iter_external_sort(current_holdings_filename, holdings_columns, spill_rows, temp_dir),
+               iter_external_sort(previous_holdings_filename, holdings_columns, spill_rows, temp_dir),
+               iter_external_sort(transactions_filename, ('SecurityName', 'Quantity', 'TransactionPrice', 'Action'),
+                                  spill_rows, temp_dir))
+    for security, (current_rows, previous_rows, transaction_rows) in module_2_solution.merge_by_security(*sources):
+        # Both pnl need the current eod price, the last row of a holdings security counts
+        if not current_rows:
+            continue
+        current_eod_price = float(current_rows[-1][2])
+        holdings_pnl = transactions_pnl = None
+        if previous_rows:
+            _, previous_quantity, previous_price = previous_rows[-1]
+            holdings_pnl = int(previous_quantity) * (current_eod_price - float(previous_price))
+        fills_pnl = []
+        for _, quantity, price, action in transaction_rows:
+            sign = module_2_solution.action_sign(action)
+            if sign is not None:
+                fills_pnl.append(sign * int(quantity) * (current_eod_price - float(price)))
+        if fills_pnl:
+            transactions_pnl = sum(fills_pnl)
+        elif holdings_pnl is None:
+            continue
+        total_pnl = holdings_pnl if transactions_pnl is None else (holdings_pnl or 0) + transactions_pnl
+        yield security, holdings_pnl, transactions_pnl, total_pnl
+
+"""
+Name: write_out_of_core_pnl
+Returns: count (int) - the number of securities written
+Parameters:
+ 'pnl_rows' (iterable) - the rows from stream_pnl_out_of_core
+ 'filename' (string) - the csv file the pnl is written to, with the OUT_OF_CORE_COLUMNS header (empty for no pnl)
+"""
+def write_out_of_core_pnl(pnl_rows, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(OUT_OF_CORE_COLUMNS)
+        count = 0
+        for count, row in enumerate(pnl_rows, 1):
+            writer.writerow(row)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Out of core holdings, transactions and total PNL')
+    parser.add_argument('pnl_filename')
+    parser.add_argument('--current', help='the current eod holdings file, defaults to the client registry default')
+    parser.add_argument('--previous', help='the previous eod holdings file, defaults to the client registry default')
+    parser.add_argument('--transactions', help='the transactions file, defaults to the client registry default')
+    parser.add_argument('--spill-rows', type=int, default=SPILL_ROWS)
+    parser.add_argument('--temp-dir')
+    args = parser.parse_args()
+
+    filenames = list(map(module_2_solution.resolve_filename, module_2_solution.CLIENT_FILE_KEYS,
+                         (args.current, args.previous, args.transactions)))
+    pnl_rows = stream_pnl_out_of_core(*filenames, args.spill_rows, args.temp_dir)
+    print(f'Wrote the pnl of {write_out_of_core_pnl(pnl_rows, args.pnl_filename)} securities to {args.pnl_filename}')
@@ -0,0 +1,165 @@
+import argparse
+import csv
+import operator
+from itertools import repeat
+
+import module_2_solution
+
+"""
+Purpose:
+Position reconciliation for the EOD files of module_2_solution.py: the previous holdings are rolled forward
+through the transactions and compared with the current holdings, and every difference is reported as a break.
+reconcile_positions joins portfolios already in memory (a hash join), reconcile_sorted_files streams
+files sorted by SecurityName (a sort-merge join) so the files can be far larger than memory.
+
+Usage:
+ python pnl_reconcile.py breaks.csv
+ python pnl_reconcile.py breaks.csv --sorted --current sorted_current.csv --previous sorted_previous.csv \
+     --transactions sorted_transactions.csv
+"""
+
+## Break types found by reconcile_positions, comparing the previous holdings rolled forward through the transactions
+## with the current holdings
+BREAK_MISSING_CURRENT = 'MISSING_CURRENT' # an open position is expected but the security is not in the current holdings
+BREAK_UNEXPECTED_CURRENT = 'UNEXPECTED_CURRENT' # the security is held but was neither held before nor traded
+BREAK_QUANTITY = 'QUANTITY_MISMATCH'
+BREAK_TICKER = 'TICKER_MISMATCH'
+BREAK_COLUMNS = ('SecurityName', 'Break', 'ExpectedQuantity', 'CurrentQuantity', 'ExpectedTicker', 'CurrentTicker')
+
+def _position_breaks(security, expected_quantity, expected_ticker, current_quantity, current_ticker):
+    if current_quantity is None:
+        return [(security, BREAK_MISSING_CURRENT, expected_quantity, None, expected_ticker, None)] if expected_quantity else []
+    if expected_quantity is None:
+        return [(security, BREAK_UNEXPECTED_CURRENT, None, current_quantity, None, current_ticker)] if current_quantity else []
+    breaks = []
+    if expected_quantity != current_quantity:
+        breaks.append((security, BREAK_QUANTITY, expected_quantity, current_quantity, expected_ticker, current_ticker))
+    if expected_ticker != current_ticker:
+        breaks.append((security, BREAK_TICKER, expected_quantity, current_quantity, expected_ticker, current_ticker))
+    return breaks
+
+"""
+Name: reconcile_positions
+Rolls the previous holdings forward through the transactions (previous quantity + BUY quantities - SELL quantities)
+and joins the expected positions with the current holdings on security id in memory (a hash join).
+The expected ticker is the previous holdings ticker, or the ticker of the first fill for a security that was not held.
+Actions are not case sensitive, fills with an empty or unknown action are left out.
+
+Returns: breaks (list) - a tuple per break, with the fields of BREAK_COLUMNS (None where a side has no position),
+    in current holdings order followed by the expected positions missing from the current holdings
+    Ex. breaks = [('Imaginary Company', 'QUANTITY_MISMATCH', 12, 10, 'BOP', 'BOP')]
+Parameters:
+ 'current_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the current date
+ 'previous_holdings_portfolio' (HoldingsColumns or dict) - holdings data from the previous date
+ 'all_transactions' (TransactionLedger or dict) - every fill between the two dates
+"""
+@module_2_solution.instrumented()
+def reconcile_positions(current_holdings_portfolio, previous_holdings_portfolio, all_transactions):
+    master = module_2_solution.shared_master(current_holdings_portfolio, previous_holdings_portfolio, all_transactions)
+    current_holdings = module_2_solution.as_holdings_columns(current_holdings_portfolio, master)
+    previous_holdings = module_2_solution.as_holdings_columns(previous_holdings_portfolio, master)
+    ledger = module_2_solution.as_transaction_ledger(all_transactions, master)
+    master = module_2_solution.check_same_master(current_holdings, previous_holdings, ledger)
+
+    # The signed quantity of every fill, worked out column by column
+    signs = map(module_2_solution.ACTION_SIGNS.get, ledger.actions, repeat(0))
+    signed_quantities = list(map(operator.mul, signs, ledger.quantities))
+    # Tickers are compared by ticker id, which is the same for the same ticker in one master
+    previous_quantities, previous_ticker_ids = previous_holdings.quantities, previous_holdings.ticker_ids
+    expected = {security_id: [previous_quantities[row], previous_ticker_ids[row]] for security_id, row in previous_holdings.id_index.items()}
+    for security_id, rows in ledger.id_index.items():
+        traded_quantity = sum(map(signed_quantities.__getitem__, rows))
+        position = expected.get(security_id)
+        if position is None:
+            expected[security_id] = [traded_quantity, ledger.ticker_ids[rows[0]]]
+        else:
+            position[0] += traded_quantity
+
+    names, tickers = master.names, master.tickers
+    current_quantities, current_ticker_ids = current_holdings.quantities, current_holdings.ticker_ids
+    breaks = []
+    for security_id, row in current_holdings.id_index.items():
+        expected_quantity, expected_ticker_id = expected.pop(security_id, (None, None))
+        if expected_quantity != current_quantities[row] or expected_ticker_id != current_ticker_ids[row]:
+            breaks.extend(_position_breaks(names[security_id], expected_quantity,
+                                           None if expected_ticker_id is None else tickers[expected_ticker_id],
+                                           current_quantities[row], tickers[current_ticker_ids[row]]))
+    for security_id, (expected_quantity, expected_ticker_id) in expected.items():
+        if expected_quantity:
+            breaks.extend(_position_breaks(names[security_id], expected_quantity, tickers[expected_ticker_id], None, None))
+    return breaks
+
+def _iter_sorted_rows(filename, columns, converters):
+    previous_security = None
+    for chunk in module_2_solution.iter_csv_chunks(filename, columns, converters):
+        securities = chunk[0]
+        if securities[0] < (previous_security or '') or any(map(operator.gt, securities, securities[1:])):
+            raise ValueError(f"{filename} MUST be sorted by SecurityName to be reconciled with a sort-merge join")
+        previous_security = securities[-1]
+        yield from zip(*chunk)
+
+"""
+Name: reconcile_sorted_files
+The same reconciliation as reconcile_positions, as a sort-merge join that streams three files sorted by SecurityName.
+Only one security of each file is in memory at a time, so the files can be far larger than memory.
+
+Returns: a generator of breaks, with the same fields as reconcile_positions, in SecurityName order
+Parameters:
+ 'current_holdings_filename' (string) - the current eod holdings file, sorted by SecurityName
+ 'previous_holdings_filename' (string) - the previous eod holdings file, sorted by SecurityName
+ 'transactions_filename' (string) - the transactions file, sorted by SecurityName (fills of a security in time order)
+
+Note - a ValueError is raised as soon as a file is found not to be sorted
+"""
+def reconcile_sorted_files(current_holdings_filename, previous_holdings_filename, transactions_filename):
+    holdings_columns, holdings_converters = ('SecurityName', 'Quantity', 'Ticker'), (None, int, None)
+    sources = (_iter_sorted_rows(current_holdings_filename, holdings_columns, holdings_converters),
+               _iter_sorted_rows(previous_holdings_filename, holdings_columns, holdings_converters),
+               _iter_sorted_rows(transactions_filename, ('SecurityName', 'Quantity', 'Ticker', 'Action'), (None, int, None, None)))
+    for security, (current_rows, previous_rows, transaction_rows) in module_2_solution.merge_by_security(*sources):
+        traded_quantity = sum((module_2_solution.action_sign(action) or 0) * quantity
+                              for _, quantity, _, action in transaction_rows)
+        # The last row of a holdings security counts, like HoldingsColumns.index
+        if previous_rows:
+            expected_quantity, expected_ticker = previous_rows[-1][1] + traded_quantity, previous_rows[-1][2]
+        elif transaction_rows:
+            expected_quantity, expected_ticker = traded_quantity, transaction_rows[0][2]
+        else:
+            expected_quantity = expected_ticker = None
+        current_quantity, current_ticker = current_rows[-1][1:] if current_rows else (None, None)
+        yield from _position_breaks(security, expected_quantity, expected_ticker, current_quantity, current_ticker)
+
+"""
+Name: write_breaks
+Returns: count (int) - the number of breaks written
+Parameters:
+ 'breaks' (iterable) - the breaks from reconcile_positions or reconcile_sorted_files
+ 'filename' (string) - the csv file the breaks are written to, with the BREAK_COLUMNS header
+"""
+def write_breaks(breaks, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(BREAK_COLUMNS)
+        count = 0
+        for count, position_break in enumerate(breaks, 1):
+            writer.writerow(position_break)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Position reconciliation of the EOD holdings and transactions files')
+    parser.add_argument('breaks_filename')
+    parser.add_argument('--current', help='the current eod holdings file, defaults to the client registry default')
+    parser.add_argument('--previous', help='the previous eod holdings file, defaults to the client registry default')
+    parser.add_argument('--transactions', help='the transactions file, defaults to the client registry default')
+    parser.add_argument('--sorted', action='store_true', help='stream files sorted by SecurityName (sort-merge join)')
+    args = parser.parse_args()
+
+    filenames = list(map(module_2_solution.resolve_filename, module_2_solution.CLIENT_FILE_KEYS,
+                         (args.current, args.previous, args.transactions)))
+    if args.sorted:
+        breaks = reconcile_sorted_files(*filenames)
+    else:
+        breaks = reconcile_positions(module_2_solution.load_holdings_columns(filenames[0]),
+                                     module_2_solution.load_holdings_columns(filenames[1]),
+                                     module_2_solution.load_transactions_ledger(filenames[2]))
+    print(f'Wrote {write_breaks(breaks, args.breaks_filename)} breaks to {args.breaks_filename}')
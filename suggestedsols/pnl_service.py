@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib.parse import parse_qs, urlsplit
+
+import module_2_solution
+
+"""
+Purpose:
+A local HTTP/JSON service that serves the PNL reports of module_2_solution.py on demand.
+
+GET /pnl?client=Client_A                 - the first report the client wants (see clients.json)
+GET /pnl?client=Client_A&report=total    - a specific report type (holdings, transactions or total)
+
+The EOD files are loaded on a worker thread so the event loop keeps serving other requests.
+The client registry and file versions are read on a second thread, so cached reports are served while a report is calculated.
+Results are kept in an LRU cache keyed by (client, report, file versions), so a new EOD file
+is picked up on the next request. Identical requests that arrive while a report is being
+calculated wait for that calculation instead of starting their own.
+The pnl values are json numbers, except for a fixed point context whose exact Decimal amounts are sent as strings.
+
+Usage:
+ python pnl_service.py serve --port 8080
+ python pnl_service.py load-test --concurrency 50 --requests 5000
+"""
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+CACHE_SIZE = 1024 # number of reports kept in the LRU cache
+
+# Sends a Decimal pnl as its exact string, anything else json cannot serialize is still an error
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+"""
+Name: PnlService
+Parameters:
+ 'context' (ReportContext) - where the EOD files and pnl maps come from,
+    defaults to the shared context of each client's files in the client registry
+ 'cache_size' (int) - the number of reports kept in the LRU cache
+"""
+class PnlService:
+    def __init__(self, context=None, cache_size=CACHE_SIZE):
+        self.context = context
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        # One worker thread: the report context is not shared between threads, and the work is cpu bound anyway
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # The registry read and file stats run on their own thread, so a cache hit never waits behind a calculation
+        self.lookup_executor = ThreadPoolExecutor(max_workers=1)
+        self.calculations = 0
+
+    def _context(self, client_name):
+        if self.context is not None:
+            return self.context
+        client = module_2_solution.get_client_registry()[client_name]
+        return module_2_solution.get_report_context(*(client[key] for key in module_2_solution.CLIENT_FILE_KEYS))
+
+    # The report type, context and file versions of a request, the cache key is built from them
+    def _lookup(self, client_name, report):
+        registry = module_2_solution.get_client_registry()
+        if client_name not in registry:
+            raise KeyError(f'Unknown client: {client_name}')
+        if report is None:
+            report = registry[client_name]['reports'][0]
+        if report not in module_2_solution.REPORT_TYPES:
+            raise KeyError(f'Unknown report type: {report}')
+        context = self._context(client_name)
+        return report, context, context.file_versions()
+
+    def _calculate(self, context, client_name, report):
+        self.calculations += 1
+        pnl = context.pnl(report)
+        return {'client': client_name, 'report': report,
+                'pnl': {security: round(gain_loss, module_2_solution.ROUNDING_DECIMAL) for security, gain_loss in pnl.items()}}
+
+    """
+    Name: get_report
+    Returns: report (dict) - the client name, report type and pnl map of one client report
+    Parameters:
+     'client_name' (string) - the client the report is for
+     'report' (string) - the report type, defaults to the report the client wants
+    """
+    async def get_report(self, client_name, report=None):
+        loop = asyncio.get_running_loop()
+        report, context, file_versions = await loop.run_in_executor(self.lookup_executor, self._lookup, client_name, report)
+        key = (client_name, report, file_versions)
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.in_flight:
+            return await self.in_flight[key]
+
+        calculation = loop.run_in_executor(self.executor, self._calculate, context, client_name, report)
+        self.in_flight[key] = calculation
+        try:
+            result = await calculation
+        finally:
+            del self.in_flight[key]
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers, the service only needs the request line
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            status, body = await self.respond(request_line.decode('latin-1'))
+            try:
+                payload = json.dumps(body, default=_json_default).encode('utf-8')
+            except (TypeError, ValueError) as error:
+                status, payload = '500 Internal Server Error', json.dumps({'error': str(error)}).encode('utf-8')
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, request_line):
+        parts = request_line.split()
+        if len(parts) != 3 or parts[0] != 'GET':
+            return '405 Method Not Allowed', {'error': 'only GET is supported'}
+        url = urlsplit(parts[1])
+        if url.path != '/pnl':
+            return '404 Not Found', {'error': f'unknown path {url.path}'}
+        query = parse_qs(url.query)
+        if 'client' not in query:
+            return '400 Bad Request', {'error': 'the client parameter is required'}
+        try:
+            return '200 OK', await self.get_report(query['client'][0], query.get('report', [None])[0])
+        except KeyError as error:
+            return '404 Not Found', {'error': error.args[0]}
+        except OSError as error:
+            return '503 Service Unavailable', {'error': str(error)}
+        except Exception as error:
+            # Anything else (ex. a malformed EOD file) still gets an answer instead of a dropped connection
+            return '500 Internal Server Error', {'error': f'{type(error).__name__}: {error}'}
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+"""
+Name: fetch_report
+Returns: (status, body) (tuple) - the http status line and the response body (bytes) of one GET request
+Parameters:
+ 'host' (string), 'port' (int) - where the service is listening
+ 'path' (string) - the path and query to request
+"""
+async def fetch_report(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head.split(b'\r\n', 1)[0].decode('latin-1'), body
+
+"""
+Name: load_test
+Sends requests from many concurrent clients and prints the latency percentiles.
+If no service is listening on host:port, one is started in this process for the duration of the test.
+
+Returns: latencies (list) - the latency of every request in seconds
+Parameters:
+ 'host' (string), 'port' (int) - where the service is listening
+ 'concurrency' (int) - the number of clients sending requests at the same time
+ 'requests' (int) - the total number of requests
+"""
+async def load_test(host, port, concurrency, requests):
+    server = None
+    try:
+        await fetch_report(host, port, '/pnl?client=Client_A')
+    except OSError:
+        server = await PnlService().start(host, port)
+
+    paths = [f'/pnl?client={client_name}' for client_name in module_2_solution.get_client_registry()]
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for number in remaining:
+            start = time.perf_counter()
+            status, _ = await fetch_report(host, port, paths[number % len(paths)])
+            latencies.append(time.perf_counter() - start)
+            if not status.endswith('200 OK'):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if server:
+        server.close()
+        await server.wait_closed()
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f'{len(latencies)} requests from {concurrency} concurrent clients in {elapsed:.2f}s '
+          f'({len(latencies) / elapsed:,.0f} requests/sec, {errors} errors)')
+    print(f'p50 {percentiles[49] * 1000:.2f} ms   p99 {percentiles[98] * 1000:.2f} ms   max {max(latencies) * 1000:.2f} ms')
+    return latencies
+
+async def serve(host, port):
+    server = await PnlService().start(host, port)
+    print(f'Serving PNL reports on http://{host}:{port}/pnl')
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PNL report service')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the service')
+    load_test_parser = subparsers.add_parser('load-test', help='measure latency under concurrent clients')
+    for command_parser in (serve_parser, load_test_parser):
+        command_parser.add_argument('--host', default=DEFAULT_HOST)
+        command_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    load_test_parser.add_argument('--concurrency', type=int, default=50)
+    load_test_parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        asyncio.run(serve(args.host, args.port))
+    elif args.command == 'load-test':
+        asyncio.run(load_test(args.host, args.port, args.concurrency, args.requests))
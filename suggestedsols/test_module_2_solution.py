@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import module_2_solution
+
+"""
+Purpose:
+Unit tests of the report context and incremental reports in module_2_solution.py
+
+Usage:
+ python test_module_2_solution.py
+"""
+
+
+class TestDeltaReport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filenames = []
+        for key in module_2_solution.CLIENT_FILE_KEYS:
+            filename = os.path.join(self.directory, os.path.basename(module_2_solution.resolve_filename(key)))
+            shutil.copyfile(module_2_solution.resolve_filename(key), filename)
+            self.filenames.append(filename)
+        self.current_holdings_filename = self.filenames[module_2_solution.CLIENT_FILE_KEYS.index('current_holdings_filename')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Rewrites the rows of a csv file and moves its modification time on, so the new version is seen even on a coarse clock
+    def rewrite(self, filename, rewrite_rows):
+        with open(filename, newline='') as f:
+            header, *rows = f.read().splitlines()
+        with open(filename, 'w', newline='') as f:
+            f.write('\n'.join([header] + rewrite_rows(rows)) + '\n')
+        file_stat = os.stat(filename)
+        os.utime(filename, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1_000_000_000))
+
+    def assert_matches_report_context(self, delta_report):
+        context = module_2_solution.ReportContext(*self.filenames)
+        assert delta_report.holdings_pnl == context.holdings_pnl()
+        assert delta_report.transactions_pnl == context.transactions_pnl()
+        assert delta_report.total_pnl == context.total_pnl()
+
+    """
+    Unit Test 1 - The first refresh reports every security and matches a ReportContext on the same files
+    """
+    def test_first_refresh_matches_report_context(self):
+        # given
+        delta_report = module_2_solution.DeltaReport(*self.filenames)
+        # when
+        changes = delta_report.refresh()
+        # then
+        assert set(changes['moved']) == set(delta_report.total_pnl)
+        self.assert_matches_report_context(delta_report)
+
+    """
+    Unit Test 2 - An unchanged file is not read again and nothing moves
+    """
+    def test_refresh_without_changes(self):
+        # given
+        delta_report = module_2_solution.DeltaReport(*self.filenames)
+        delta_report.refresh()
+        # when
+        changes = delta_report.refresh()
+        # then
+        assert changes == {'changed': {'current_holdings': [], 'previous_holdings': [], 'transactions': []}, 'moved': {}}
+
+    """
+    Unit Test 3 - A changed row only recalculates its security
+    """
+    def test_changed_row(self):
+        # given
+        delta_report = module_2_solution.DeltaReport(*self.filenames)
+        delta_report.refresh()
+        previous_total_pnl = delta_report.total_pnl['WALTDISNEYCO/THE']
+        # when
+        self.rewrite(self.current_holdings_filename,
+                     lambda rows: [row.replace('1000,103.25', '1000,104.25') for row in rows])
+        changes = delta_report.refresh()
+        # then
+        assert changes['changed']['current_holdings'] == ['WALTDISNEYCO/THE']
+        assert list(changes['moved']) == ['WALTDISNEYCO/THE']
+        assert changes['moved']['WALTDISNEYCO/THE'][0] == previous_total_pnl
+        self.assert_matches_report_context(delta_report)
+
+    """
+    Unit Test 4 - A security removed from the current holdings loses its pnl
+    """
+    def test_removed_security(self):
+        # given
+        delta_report = module_2_solution.DeltaReport(*self.filenames)
+        delta_report.refresh()
+        # when
+        self.rewrite(self.current_holdings_filename, lambda rows: [row for row in rows if not row.startswith('WALTDISNEYCO/THE,')])
+        changes = delta_report.refresh()
+        # then
+        assert changes['changed']['current_holdings'] == ['WALTDISNEYCO/THE']
+        assert changes['moved']['WALTDISNEYCO/THE'][1] is None
+        assert 'WALTDISNEYCO/THE' not in delta_report.total_pnl
+        self.assert_matches_report_context(delta_report)
+
+    """
+    Unit Test 5 - A malformed row raises, leaves the report unchanged and is read again on the next refresh
+    """
+    def test_malformed_row_is_retried(self):
+        # given
+        delta_report = module_2_solution.DeltaReport(*self.filenames)
+        delta_report.refresh()
+        total_pnl = dict(delta_report.total_pnl)
+        self.rewrite(self.current_holdings_filename,
+                     lambda rows: [row.replace('1000,103.25', 'many,104.25') for row in rows])
+        # when / then
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                delta_report.refresh()
+            assert delta_report.total_pnl == total_pnl
+        # when
+        self.rewrite(self.current_holdings_filename,
+                     lambda rows: [row.replace('many,104.25', '1000,104.25') for row in rows])
+        changes = delta_report.refresh()
+        # then
+        assert changes['changed']['current_holdings'] == ['WALTDISNEYCO/THE']
+        self.assert_matches_report_context(delta_report)
+
+
+class TestReportContext(unittest.TestCase):
+
+    """
+    Unit Test 6 - A file that changes part way through a calculation does not mix two masters
+    """
+    def test_file_changes_during_calculation(self):
+        # given
+        context = module_2_solution.ReportContext()
+        load_holdings = context._load_holdings
+        loaded = []
+
+        def load_and_change_versions(filename):
+            loaded.append(filename)
+            if len(loaded) == 1:
+                context.file_versions = lambda: ('new versions',)
+            return load_holdings(filename)
+        context._load_holdings = load_and_change_versions
+        # when
+        holdings_pnl = context.pnl('holdings')
+        # then
+        assert len(loaded) == 2
+        assert holdings_pnl == module_2_solution.ReportContext().pnl('holdings')
+        # the next call sees the new versions and loads the files again
+        context.pnl('holdings')
+        assert len(loaded) == 4
+
+
+if __name__ == '__main__':
+    unittest.main()
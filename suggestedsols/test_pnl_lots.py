@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import module_2_solution
+from pnl_lots import LOT_METHODS, LotBook, calculate_lot_pnl
+
+"""
+Purpose:
+Unit tests of the lot matching in pnl_lots.py
+
+Usage:
+ python test_pnl_lots.py
+"""
+
+
+class TestLotBook(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    """
+    Unit Test 1 - FIFO closes the oldest lot first
+    """
+    def test_fifo_closes_oldest_lot(self):
+        # given
+        book = LotBook('FIFO')
+        book.apply_fill('Imaginary Company', 10, 100.0, 'BUY')
+        book.apply_fill('Imaginary Company', 10, 110.0, 'BUY')
+        # when
+        book.apply_fill('Imaginary Company', 15, 120.0, 'SELL')
+        # then
+        assert book.realized_pnl == {'Imaginary Company': 10 * (120.0 - 100.0) + 5 * (120.0 - 110.0)} # 250.0
+        assert [(lot[2], lot[3]) for lot in book.lots['Imaginary Company']] == [(5, 110.0)]
+
+    """
+    Unit Test 2 - LIFO closes the newest lot first
+    """
+    def test_lifo_closes_newest_lot(self):
+        # given
+        book = LotBook('LIFO')
+        book.apply_fill('Imaginary Company', 10, 100.0, 'BUY')
+        book.apply_fill('Imaginary Company', 10, 110.0, 'BUY')
+        # when
+        book.apply_fill('Imaginary Company', 15, 120.0, 'SELL')
+        # then
+        assert book.realized_pnl == {'Imaginary Company': 10 * (120.0 - 110.0) + 5 * (120.0 - 100.0)} # 200.0
+        assert [(lot[2], lot[3]) for lot in book.lots['Imaginary Company']] == [(5, 100.0)]
+
+    """
+    Unit Test 3 - HIFO closes the highest priced lot first
+    """
+    def test_hifo_closes_highest_price_lot(self):
+        # given
+        book = LotBook('HIFO')
+        for price in (100.0, 130.0, 110.0):
+            book.apply_fill('Imaginary Company', 10, price, 'BUY')
+        # when
+        book.apply_fill('Imaginary Company', 15, 120.0, 'SELL')
+        # then
+        assert book.realized_pnl == {'Imaginary Company': 10 * (120.0 - 130.0) + 5 * (120.0 - 110.0)} # -50.0
+        assert sorted((lot[2], lot[3]) for lot in book.lots['Imaginary Company']) == [(5, 110.0), (10, 100.0)]
+
+    """
+    Unit Test 4 - A fill larger than the long lots closes them and opens a short lot
+    """
+    def test_fill_past_zero_opens_short_lot(self):
+        # given
+        book = LotBook('FIFO')
+        book.apply_fill('Imaginary Company', 10, 100.0, 'BUY')
+        # when
+        book.apply_fill('Imaginary Company', 25, 90.0, 'sell')
+        book.apply_fill('Imaginary Company', 5, 80.0, 'SELL')
+        # then
+        assert book.realized_pnl == {'Imaginary Company': 10 * (90.0 - 100.0)} # -100.0
+        assert [(lot[2], lot[3]) for lot in book.lots['Imaginary Company']] == [(-15, 90.0), (-5, 80.0)]
+        current_holdings = {'Imaginary Company': {'ticker': 'BOP', 'quantity': -20, 'price': 85.0}}
+        assert book.unrealized_pnl(current_holdings) == {'Imaginary Company': -15 * (85.0 - 90.0) + -5 * (85.0 - 80.0)} # 50.0
+
+    """
+    Unit Test 5 - BUY fills close short lots, and fills with an empty or unknown action are ignored
+    """
+    def test_buy_closes_short_lot_and_invalid_actions_are_ignored(self):
+        # given
+        book = LotBook('FIFO')
+        book.apply_fill('Imaginary Company', 10, 100.0, 'SELL')
+        # when
+        applied = [book.apply_fill('Imaginary Company', 10, 90.0, action) for action in ('', 'HOLD', ' buy ')]
+        # then
+        assert applied == [False, False, True]
+        assert book.realized_pnl == {'Imaginary Company': -10 * (90.0 - 100.0)} # 100.0
+        assert book.lots == {}
+
+    """
+    Unit Test 6 - A checkpoint reopens the lots so they close in the same order, for every method
+    """
+    def test_checkpoint_round_trip(self):
+        for method in LOT_METHODS:
+            # given
+            book = LotBook(method)
+            for quantity, price in ((10, 100.0), (10, 130.0), (10, 110.0), (10, 130.0)):
+                book.apply_fill('Imaginary Company', quantity, price, 'BUY')
+            book.apply_fill('Other Company', 5, 50.0, 'SELL')
+            checkpoint_filename = os.path.join(self.directory, f'{method}.json')
+            # when
+            book.write_checkpoint(checkpoint_filename)
+            resumed_book = LotBook.from_checkpoint(checkpoint_filename)
+            # then
+            assert resumed_book.method == method
+            assert resumed_book.realized_pnl == {}
+            for current_book in (book, resumed_book):
+                current_book.apply_fill('Imaginary Company', 25, 120.0, 'SELL')
+                current_book.apply_fill('Other Company', 5, 40.0, 'BUY')
+            assert resumed_book.realized_pnl == book.realized_pnl, method
+            assert {security: [(lot[2], lot[3]) for lot in lots] for security, lots in resumed_book.lots.items()} == \
+                   {security: [(lot[2], lot[3]) for lot in lots] for security, lots in book.lots.items()}, method
+
+    """
+    Unit Test 7 - A checkpoint cannot be resumed with another method
+    """
+    def test_checkpoint_with_other_method(self):
+        # given
+        checkpoint_filename = os.path.join(self.directory, 'FIFO.json')
+        LotBook('FIFO').write_checkpoint(checkpoint_filename)
+        # when / then
+        with self.assertRaises(ValueError):
+            LotBook.from_checkpoint(checkpoint_filename, 'LIFO')
+
+    """
+    Unit Test 8 - Realized + unrealized pnl adds up to the total pnl on the module 3 transactions (lower case, unknown and empty actions)
+    """
+    def test_realized_and_unrealized_add_up_to_total(self):
+        # given
+        data_dir = os.path.dirname(module_2_solution.resolve_filename('current_holdings_filename'))
+        master = module_2_solution.SecurityMaster()
+        current_holdings = module_2_solution.load_holdings_columns(
+            module_2_solution.resolve_filename('current_holdings_filename'), master=master)
+        previous_holdings = module_2_solution.load_holdings_columns(
+            module_2_solution.resolve_filename('previous_holdings_filename'), master=master)
+        ledger = module_2_solution.load_transactions_ledger(os.path.join(data_dir, 'transactions_module3.csv'), master=master)
+        for method in LOT_METHODS:
+            # when
+            lot_pnl = calculate_lot_pnl(current_holdings, previous_holdings, ledger, method)
+            # then
+            self.assertAlmostEqual(lot_pnl['total']['WALTDISNEYCO/THE'], 130.0) # -120 holdings + 250 transactions pnl
+            for security, total_pnl in lot_pnl['total'].items():
+                self.assertAlmostEqual(lot_pnl['realized'].get(security, 0) + lot_pnl['unrealized'].get(security, 0), total_pnl,
+                                       msg=f'{method} {security}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmarks
+import module_2_solution
+import pnl_out_of_core
+from pnl_out_of_core import iter_external_sort, stream_pnl_out_of_core
+
+"""
+Purpose:
+Unit tests of the out of core pnl in pnl_out_of_core.py
+
+Usage:
+ python test_pnl_out_of_core.py
+"""
+
+
+class TestOutOfCorePnl(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.temp_dir = os.path.join(self.directory, 'runs')
+        os.makedirs(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # The in memory holdings, transactions and total pnl of the files, laid out like the rows of stream_pnl_out_of_core
+    def in_memory_pnl(self, current_holdings_filename, previous_holdings_filename, transactions_filename):
+        master = module_2_solution.SecurityMaster()
+        current_holdings = module_2_solution.load_holdings_columns(current_holdings_filename, master=master)
+        previous_holdings = module_2_solution.load_holdings_columns(previous_holdings_filename, master=master)
+        ledger, _ = module_2_solution.validate_transactions(transactions_filename, master=master)
+        holdings_pnl = module_2_solution.calculate_holdings_pnl(current_holdings, previous_holdings)
+        transactions_pnl = module_2_solution.calculate_transactions_pnl(ledger, current_holdings)
+        total_pnl = module_2_solution.calculate_total_pnl(holdings_pnl, transactions_pnl)
+        return sorted((security, holdings_pnl.get(security), transactions_pnl.get(security), pnl)
+                      for security, pnl in total_pnl.items())
+
+    def assert_matches_in_memory_pnl(self, filenames, spill_rows):
+        pnl_rows = list(stream_pnl_out_of_core(*filenames, spill_rows=spill_rows, temp_dir=self.temp_dir))
+        expected_rows = self.in_memory_pnl(*filenames)
+        assert [row[0] for row in pnl_rows] == [row[0] for row in expected_rows]
+        for row, expected_row in zip(pnl_rows, expected_rows):
+            for pnl, expected_pnl in zip(row[1:], expected_row[1:]):
+                if expected_pnl is None:
+                    assert pnl is None, row
+                else:
+                    self.assertAlmostEqual(pnl, expected_pnl, msg=str(row))
+        # Every run file is removed once the streams are done
+        assert os.listdir(self.temp_dir) == []
+
+    """
+    Unit Test 1 - The external sort keeps every row, in SecurityName order with the rows of a security in file order,
+    when there are more runs than MERGE_FAN_IN
+    """
+    def test_external_sort_with_several_merge_passes(self):
+        # given
+        filenames = benchmarks.generate_portfolio_files(self.directory, 300, lots_per_security=3)
+        columns = ('SecurityName', 'Quantity', 'TransactionPrice', 'Action')
+        rows = [list(row) for row in zip(*next(module_2_solution.iter_csv_chunks(filenames['transactions'], columns,
+                                                                                 (None,) * len(columns), 10 ** 6)))]
+        # when
+        with mock.patch.object(pnl_out_of_core, 'MERGE_FAN_IN', 4):
+            sorted_rows = list(iter_external_sort(filenames['transactions'], columns, spill_rows=7, temp_dir=self.temp_dir))
+        # then
+        assert len(rows) // 7 > 4 * 4 # at least two merge passes before the last one
+        assert sorted_rows == sorted(rows, key=lambda row: row[0])
+        assert os.listdir(self.temp_dir) == []
+
+    """
+    Unit Test 2 - Small runs over the workshop files give the in memory pnl, including the module 3 actions
+    """
+    def test_workshop_files_match_in_memory_pnl(self):
+        # given
+        filenames = list(map(module_2_solution.resolve_filename, module_2_solution.CLIENT_FILE_KEYS))
+        module3_filenames = filenames[:2] + [os.path.join(os.path.dirname(filenames[2]), 'transactions_module3.csv')]
+        # when / then
+        with mock.patch.object(pnl_out_of_core, 'MERGE_FAN_IN', 2):
+            for current_filenames in (filenames, module3_filenames):
+                self.assert_matches_in_memory_pnl(current_filenames, spill_rows=1)
+
+    """
+    Unit Test 3 - Generated files with more runs than MERGE_FAN_IN give the in memory pnl
+    """
+    def test_more_runs_than_fan_in_match_in_memory_pnl(self):
+        # given
+        filenames = benchmarks.generate_portfolio_files(self.directory, 2000, lots_per_security=4, malformed_action_rate=0.1)
+        spill_rows = 25
+        assert 2000 // spill_rows > pnl_out_of_core.MERGE_FAN_IN
+        # when / then
+        self.assert_matches_in_memory_pnl((filenames['current_holdings'], filenames['previous_holdings'],
+                                           filenames['transactions']), spill_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmarks
+import module_2_solution
+from pnl_reconcile import (BREAK_MISSING_CURRENT, BREAK_QUANTITY, BREAK_TICKER, BREAK_UNEXPECTED_CURRENT,
+                           reconcile_positions, reconcile_sorted_files)
+
+"""
+Purpose:
+Unit tests of the position reconciliation in pnl_reconcile.py
+
+Usage:
+ python test_pnl_reconcile.py
+"""
+
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Writes a copy of a csv file with its rows sorted by SecurityName, rows of the same security stay in file order
+    def sorted_copy(self, filename):
+        with open(filename, newline='') as f:
+            header, *rows = csv.reader(f)
+        sorted_filename = os.path.join(self.directory, 'sorted_' + os.path.basename(filename))
+        with open(sorted_filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(sorted(rows, key=lambda row: row[0]))
+        return sorted_filename
+
+    def write_csv(self, name, header, rows):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return filename
+
+    # The breaks of the hash join and of the sort-merge join on the same files, both in SecurityName order
+    def both_joins(self, current_holdings_filename, previous_holdings_filename, transactions_filename):
+        master = module_2_solution.SecurityMaster()
+        hash_join_breaks = reconcile_positions(module_2_solution.load_holdings_columns(current_holdings_filename, master=master),
+                                               module_2_solution.load_holdings_columns(previous_holdings_filename, master=master),
+                                               module_2_solution.load_transactions_ledger(transactions_filename, master=master))
+        sort_merge_breaks = list(reconcile_sorted_files(*map(self.sorted_copy, (current_holdings_filename, previous_holdings_filename,
+                                                                              transactions_filename))))
+        return sorted(hash_join_breaks, key=lambda position_break: position_break[:2]), sort_merge_breaks
+
+    """
+    Unit Test 1 - Both joins find the same breaks on the workshop files
+    """
+    def test_joins_agree_on_workshop_files(self):
+        # given
+        filenames = list(map(module_2_solution.resolve_filename, module_2_solution.CLIENT_FILE_KEYS))
+        # when
+        hash_join_breaks, sort_merge_breaks = self.both_joins(*filenames)
+        # then
+        assert hash_join_breaks
+        assert sort_merge_breaks == hash_join_breaks
+
+    """
+    Unit Test 2 - Both joins find the same breaks on generated files with several fills per security and malformed actions
+    """
+    def test_joins_agree_on_generated_files(self):
+        # given
+        filenames = benchmarks.generate_portfolio_files(os.path.join(self.directory, 'generated'), 2000, lots_per_security=4,
+                                                        malformed_action_rate=0.1)
+        # when
+        hash_join_breaks, sort_merge_breaks = self.both_joins(filenames['current_holdings'], filenames['previous_holdings'],
+                                                              filenames['transactions'])
+        # then
+        assert any(position_break[1] == BREAK_QUANTITY for position_break in hash_join_breaks)
+        assert sort_merge_breaks == hash_join_breaks
+
+    """
+    Unit Test 3 - Every break type, break for break in both joins
+    """
+    def test_every_break_type(self):
+        # given
+        holdings_header = module_2_solution.HOLDINGS_COLUMNS
+        current_holdings_filename = self.write_csv('current.csv', holdings_header, [
+            ('Held Company', 'HELD', 10, 1.0), ('Renamed Company', 'NEW', 5, 1.0), ('New Company', 'NEWCO', 7, 1.0),
+            ('Traded Company', 'TRD', 3, 1.0)])
+        previous_holdings_filename = self.write_csv('previous.csv', holdings_header, [
+            ('Held Company', 'HELD', 10, 1.0), ('Renamed Company', 'OLD', 5, 1.0), ('Sold Company', 'SOLD', 4, 1.0),
+            ('Traded Company', 'TRD', 1, 1.0)])
+        transactions_filename = self.write_csv('transactions.csv', module_2_solution.TRANSACTIONS_COLUMNS, [
+            ('Traded Company', 'TRD', 3, 1.0, 'buy'), ('Traded Company', 'TRD', 9, 1.0, 'HOLD'), ('Held Company', 'HELD', 2, 1.0, '')])
+        # when
+        hash_join_breaks, sort_merge_breaks = self.both_joins(current_holdings_filename, previous_holdings_filename, transactions_filename)
+        # then
+        assert sort_merge_breaks == hash_join_breaks == [
+            ('New Company', BREAK_UNEXPECTED_CURRENT, None, 7, None, 'NEWCO'),
+            ('Renamed Company', BREAK_TICKER, 5, 5, 'OLD', 'NEW'),
+            ('Sold Company', BREAK_MISSING_CURRENT, 4, None, 'SOLD', None),
+            ('Traded Company', BREAK_QUANTITY, 4, 3, 'TRD', 'TRD')]
+
+    """
+    Unit Test 4 - The sort-merge join raises when a file is not sorted by SecurityName
+    """
+    def test_unsorted_file_raises(self):
+        # given
+        filenames = list(map(module_2_solution.resolve_filename, module_2_solution.CLIENT_FILE_KEYS))
+        sorted_filenames = [self.sorted_copy(filename) for filename in filenames]
+        for position in range(len(filenames)):
+            unsorted_filenames = sorted_filenames[:position] + [filenames[position]] + sorted_filenames[position + 1:]
+            # when / then
+            with self.assertRaises(ValueError):
+                list(reconcile_sorted_files(*unsorted_filenames))
+
+
+if __name__ == '__main__':
+    unittest.main()